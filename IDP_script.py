@@ -11,7 +11,8 @@
 
 import numpy as np
 from nanosims_analysis.importer import Importer
-from nanosims_analysis.data_structures import RatioData
+from nanosims_analysis.cache import CubeCache
+from nanosims_analysis.data_structures import RatioData, qsa_beta
 #from src.hl import gridToVTK 
 
 # Set the filename
@@ -19,21 +20,25 @@ filename  = "Chim05_SC_Olivine_FIB_2_1.im"
 
 print("Masked IDP analysis for file: " + str(filename))
 
-# Create importer to import data, and import the data
-importer = Importer()
-importer.import_file(filename)
-
 # Ask user for primary current
 primary_current = int(input("Please input primary current (in pA): "))
 
-# Perform deadtime correction on all isotope data
-importer.deadtime_correct_all(dead_time = 44*10**-9)
-
+# Create importer to import data, import the data and perform deadtime
+# correction on all isotope data.
+#
 # For this dataset, there is one pixel at the END of the x-range and y-range
 # that need to be moved to the front of the data set (this is an issue with the
 # .im file), so we set x_roll and y_roll to 1. Negative values will move that
 # number of pixels from the front to the end, the reverse operation.
-importer.roll_all(x_roll = 1, y_roll = 1)
+#
+# Each isotope is only read from the file, and corrected, when it is first
+# used. Set cache_directory, e.g. to "./nanosims_cache", to keep the corrected
+# data there, so the next run with the same file loads it from there.
+cache_directory = None
+cache = CubeCache(cache_directory) if cache_directory else None
+importer = Importer()
+importer.process_file(filename, dead_time = 44*10**-9, x_roll = 1, y_roll = 1,
+                      cache = cache, lazy = True)
 
 # # Assign IsotopeData objects to each isotope
 O16  = importer.get_isotope("16O")
@@ -53,19 +58,31 @@ trimb = input("Trim back of dataset? [y/n] ")
 if str(trimb) == 'y':
     trimb_amount = input("Please input number of cycles to trim from back: ")
     importer.trim_back_all(trimb_amount)
+
+# Align the cycles, shifts between cycles are found from the 16O images
+drift = input("Correct drift between cycles? [y/n] ")
+if str(drift) == 'y':
+    importer.correct_drift("16O")
     
 # return number of cycles
 ncycles = O16.n_cycles()
     
-# Makes a RatioData object
+# Makes a RatioData object. Lazy ratios are computed a few cycles at a time
+# for sums and standard deviations, and only stored when the data is needed.
 O18_to_O16 = RatioData("O18 to O16", numerator_isotope = O18,
-                       denominator_isotope = O16)
+                       denominator_isotope = O16, lazy = True)
 O17_to_O16 = RatioData("O17 to O16", numerator_isotope = O17,
-                       denominator_isotope = O16)
+                       denominator_isotope = O16, lazy = True)
 
 
-# TO DO: Correct for QSA on RatioData object 
-# TO DO: Add reduced resolution option for imaging
+# Point by point QSA correction of a RatioData object, with beta from
+# data_structures.QSA_BETA for the isotopes of the ratio (0.75 for 17O/16O):
+# O17_to_O16.perform_qsa_correction(O16, primary_current, dwell_time)
+
+# Reduced resolution data for imaging: O16.binned(n = 4) sums the counts over
+# 4 by 4 pixels, O16.pyramid() gives several resolutions. Ratios of binned
+# isotopes, e.g. RatioData("O17 to O16", O17.binned(n = 4), O16.binned(n = 4)),
+# are ratios of summed counts.
 
 # Generate mask from O16 data
 maskQ = input("Mask data in 16O? [y/n] ")
@@ -79,68 +96,29 @@ O16mask = O16.get_mask(lower = mask_low)
 # Return number of pixels in mask
 pixels = O16.n_pixels(O16mask)
 
-# Calculate total counts by sums
-O16tot = O16.sum(O16mask)
-O17tot = O17.sum(O16mask)
-O18tot = O18.sum(O16mask)
-
-# Calculate the ratio using the masked sums
-R17init = O17tot/O16tot
-R18init = O18tot/O16tot
-
-
-# Correct for QSA on bulk Ratio using methods of Hillion et al., 2008
-# Corrected Ratio = ratio_measured/(1+beta*K)
-# where K = O16tot / (primary current * 6.2415e6 * dwell time * N pixels)   
-
-dwell_time = 3000  # TO DO: edit so that it reads dwell time, instead of being hard wired into script
-beta = 0.75
-K = O16tot / (primary_current * 6.2415*10**6 * dwell_time * pixels)
-R17 = R17init / (1 + beta*K)
-R18 = R18init / (1 + beta*K)
-print("QSA correction using beta value: " + str(beta) + " (Hillion et al., 2008)")
-
-# Calculate uncertainties 
-# Instrumental statistical uncertainty for isotope = root(N) where N is total counts
-rootN16 = np.sqrt(O16tot)
-rootN17 = np.sqrt(O17tot)
-rootN18 = np.sqrt(O18tot)
-
-# Statistical uncertainty for ratio
-sigR17 = R17 * np.sqrt((rootN17/O17tot)**2 + (rootN16/O16tot)**2)
-sigR18 = R18 * np.sqrt((rootN18/O18tot)**2 + (rootN16/O16tot)**2)
-
-# For a more conservative estimate, use standard error -- stdev / sqrt(n) for Ratio data where n is number of analyses
-stdev17 = np.std(O17_to_O16.get_data(O16mask))
-stdev18 = np.std(O18_to_O16.get_data(O16mask))
-
-sig17 = stdev17 / np.sqrt(pixels)
-sig18 = stdev18 / np.sqrt(pixels)
-
-# Quadratically combined Ratio error - maybe overcounts the error? Will probably not use this value
-Qsig17 = np.sqrt(sig17**2 + sigR17**2)
-Qsig18 = np.sqrt(sig18**2 + sigR18**2)
-
 # define standard ratio values for VSMOW (Baertschi, 1976; Fahey et al., 1987)
 R17smow = 0.00038288
 R18smow = 0.0020052
 
-# Calculate the delta values for ratio and uncertainties
-delta17O = ((R17/R17smow)-1)*1000  # For bulk ratio
-delta18O = ((R18/R18smow)-1)*1000  # For bulk ratio
-
-RDatad17O = ((O17_to_O16.get_data(O16mask)/R17smow)-1)*1000  # For RatioData object
-RDatad18O = ((O18_to_O16.get_data(O16mask)/R18smow)-1)*1000  # For RatioData object
-
-dstdev17 = np.std(RDatad17O)
-dstdev18 = np.std(RDatad18O)
-
-dsig17 = (sig17/R17smow)*1000
-dsig18 = (sig18/R18smow)*1000
-
-
-d2sig17 = 2*dsig17
-d2sig18 = 2*dsig18
+# Statistics of both ratios from one pass over the masked pixels:
+# - bulk ratios from the total counts, QSA corrected using methods of
+#   Hillion et al., 2008: Corrected Ratio = ratio_measured/(1+beta*K)
+#   where K = O16tot / (primary current * 6.2415e6 * dwell time * N pixels)
+# - root N uncertainties and standard errors -- stdev / sqrt(n) for Ratio
+#   data where n is number of analyses
+# - delta values for ratio and uncertainties
+dwell_time = 3000  # TO DO: edit so that it reads dwell time, instead of being hard wired into script
+statistics = importer.ratio_statistics([("17O", "16O", R17smow),
+                                        ("18O", "16O", R18smow)], O16mask,
+                                       primary_current = primary_current,
+                                       dwell_time = dwell_time)
+print("QSA correction using beta value: " + str(qsa_beta("17O", "16O")) + " (Hillion et al., 2008)")
+
+R17, R18 = statistics["ratio"]
+delta17O, delta18O = statistics["delta"]  # For bulk ratio
+dstdev17, dstdev18 = statistics["delta_std"]  # standard deviation in delta values
+dsig17, dsig18 = statistics["delta_sigma"]  # convert error to delta values
+d2sig17, d2sig18 = statistics["delta_2sigma"]  # 2 sigma
 
 # Correct for instrumental mass fractionation (IMF)
 # Input standard (std) delta values, as measured by SIMS (M), and literature values (L) in units of permil
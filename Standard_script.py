@@ -9,9 +9,9 @@
 
 # Import the required objects
 
-import numpy as np
 from nanosims_analysis.importer import Importer
-from nanosims_analysis.data_structures import RatioData
+from nanosims_analysis.cache import CubeCache
+from nanosims_analysis.data_structures import qsa_beta
 
 # Set the filename
 filename  = "./Chim06 SC olivine FIB_5_1.im"
@@ -21,12 +21,16 @@ print("Standard analysis for file: " + str(filename))
 # Ask for primary current
 primary_current = int(input("Please input primary current (in pA): "))
 
-# Create importer to import data, and import the data
+# Create importer to import data, import the data and perform deadtime
+# correction on all isotope data. Each isotope is only read from the file, and
+# corrected, when it is first used. Set cache_directory, e.g. to
+# "./nanosims_cache", to keep the corrected data there, so the next run with
+# the same file loads it from there.
+cache_directory = None
+cache = CubeCache(cache_directory) if cache_directory else None
 importer = Importer()
-importer.import_file(filename)
-
-# Perform deadtime correction on all isotope data
-importer.deadtime_correct_all(dead_time = 44*10**-9)
+importer.process_file(filename, dead_time = 44*10**-9, cache = cache,
+                      lazy = True)
 
 # # Assign IsotopeData objects to each isotope
 O16  = importer.get_isotope("16O")
@@ -46,27 +50,17 @@ trimb = input("Trim back of dataset? [y/n] ")
 if str(trimb) == 'y':
     trimb_amount = input("Please input number of cycles to trim from back: ")
     importer.trim_back_all(trimb_amount)    
+
+# Align the cycles, shifts between cycles are found from the 16O images
+drift = input("Correct drift between cycles? [y/n] ")
+if str(drift) == 'y':
+    importer.correct_drift("16O")
     
-# Makes a RatioData object
-O18_to_O16 = RatioData("O18 to O16", numerator_isotope = O18,
-                       denominator_isotope = O16)
-O17_to_O16 = RatioData("O17 to O16", numerator_isotope = O17,
-                       denominator_isotope = O16)
-
-
-# TO DO: Correct for QSA on RatioData object (point by point ratios)
-#    if ratio_label in ['17O/16O', '18O/16O', '32S/33S', '32S/34S', '32S/36S' ]:
-#        beta = 0.75
-#    elif ratio_label in ['12C/13C', '12C2/13C12C']:
-#        beta = 1
-#    elif ratio_label in ['28Si/29Si', '28Si/30Si']:
-#        beta =0.6
-#    else:
-#        # Theoretical value for Poisson stats
-#        beta = 0.5
-# Need to make QSA corrected RatioData object, where value is adjusted to
-# beta = 0.75
-# ratio_corr = ratio_measured/(1+beta*K)
+# Per-pixel ratios, e.g. to map or QSA correct them point by point with beta
+# from data_structures.QSA_BETA (0.75 for 17O/16O), are RatioData objects:
+# O17_to_O16 = RatioData("O17 to O16", numerator_isotope = O17,
+#                        denominator_isotope = O16, lazy = True)
+# O17_to_O16.perform_qsa_correction(O16, primary_current, dwell_time)
 
 # Generate mask from O16 data
 maskQ = input("Mask data in 16O? [y/n] ")
@@ -79,66 +73,29 @@ O16mask = O16.get_mask(lower = mask_low)
 # Return number of pixels in mask
 pixels = O16.n_pixels(O16mask)
 
-# Calculate total counts by sums
-O16tot = O16.sum(O16mask)
-O17tot = O17.sum(O16mask)
-O18tot = O18.sum(O16mask)
-
-# Calculate the ratio using the masked sums
-R17init = O17tot/O16tot
-R18init = O18tot/O16tot
-
-# Correct for QSA on bulk Ratio using methods of Hillion et al., 2008
-# Corrected Ratio = ratio_measured/(1+beta*K)
-# where K = O16tot / (primary current * 6.2415e6 * dwell time * N pixels)   
-
-dwell_time = 3000  # TO DO: edit so that it reads dwell time, instead of being hard wired into script
-beta = 0.75
-K = O16tot / (primary_current * 6.2415*10**6 * dwell_time * pixels)
-R17 = R17init / (1 + beta*K)
-R18 = R18init / (1 + beta*K)
-print("QSA correction using beta value: " + str(beta) + " (Hillion et al., 2008)")
-
-# Calculate uncertainties 
-# Instrumental statistical uncertainty for isotope = root(N) where N is total counts
-rootN16 = np.sqrt(O16tot)
-rootN17 = np.sqrt(O17tot)
-rootN18 = np.sqrt(O18tot)
-
-# Statistical uncertainty for ratio
-sigR17 = R17 * np.sqrt((rootN17/O17tot)**2 + (rootN16/O16tot)**2)
-sigR18 = R18 * np.sqrt((rootN18/O18tot)**2 + (rootN16/O16tot)**2)
-
-# For a more conservative estimate, use standard error -- stdev / sqrt(n) for Ratio data where n is number of analyses
-stdev17 = np.std(O17_to_O16.get_data(O16mask))
-stdev18 = np.std(O18_to_O16.get_data(O16mask))
-
-sig17 = stdev17 / np.sqrt(pixels)
-sig18 = stdev18 / np.sqrt(pixels)
-
-# Quadratically combined Ratio error - maybe overcounts the error? Will probably not use this value
-Qsig17 = np.sqrt(sig17**2 + sigR17**2)
-Qsig18 = np.sqrt(sig18**2 + sigR18**2)
-
 # define standard ratio values for VSMOW (Baertschi, 1976; Fahey et al., 1987)
 R17smow = 0.00038288
 R18smow = 0.0020052
 
-# Calculate the delta values for ratio and uncertainties
-delta17O = ((R17/R17smow)-1)*1000  # For bulk ratio
-delta18O = ((R18/R18smow)-1)*1000  # For bulk ratio
-
-RDatad17O = ((O17_to_O16.get_data(O16mask)/R17smow)-1)*1000  # delta values for RatioData object
-RDatad18O = ((O18_to_O16.get_data(O16mask)/R18smow)-1)*1000  # delta values for RatioData object
-
-dstdev17 = np.std(RDatad17O)  # standard deviation in delta values
-dstdev18 = np.std(RDatad18O)  # standard deviation in delta values
-
-dsig17 = (sig17/R17smow)*1000  # convert error to delta values
-dsig18 = (sig18/R18smow)*1000  # convert error to delta values
-
-d2sig17 = 2*dsig17  # 2 sigma
-d2sig18 = 2*dsig18  # 2 sigma
+# Statistics of both ratios from one pass over the masked pixels:
+# - bulk ratios from the total counts, QSA corrected using methods of
+#   Hillion et al., 2008: Corrected Ratio = ratio_measured/(1+beta*K)
+#   where K = O16tot / (primary current * 6.2415e6 * dwell time * N pixels)
+# - root N uncertainties and standard errors -- stdev / sqrt(n) for Ratio
+#   data where n is number of analyses
+# - delta values for ratio and uncertainties
+dwell_time = 3000  # TO DO: edit so that it reads dwell time, instead of being hard wired into script
+statistics = importer.ratio_statistics([("17O", "16O", R17smow),
+                                        ("18O", "16O", R18smow)], O16mask,
+                                       primary_current = primary_current,
+                                       dwell_time = dwell_time)
+print("QSA correction using beta value: " + str(qsa_beta("17O", "16O")) + " (Hillion et al., 2008)")
+
+R17, R18 = statistics["ratio"]
+delta17O, delta18O = statistics["delta"]  # For bulk ratio
+dstdev17, dstdev18 = statistics["delta_std"]  # standard deviation in delta values
+dsig17, dsig18 = statistics["delta_sigma"]  # convert error to delta values
+d2sig17, d2sig18 = statistics["delta_2sigma"]  # 2 sigma
 
 # Print results 
 print("The d17O value is: " + str(delta17O) + " +/- " + str(d2sig17) + " permil (2 sigma)" + "\nThe d18O value is: " + str(delta18O) + " +/- " + str(d2sig18) + " permil (2 sigma)")
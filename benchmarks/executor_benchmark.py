@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+#####################
+# IMPORTER EXECUTOR BENCHMARK
+#
+# Times importer-wide operations on synthetic data with an increasing number
+# of worker threads, and prints the speed up over a single worker: applying
+# deadtime correction and rolls to every isotope, masks and masked sums of
+# every isotope, and the same corrections on a single large isotope, which is
+# split by blocks of cycles.
+#
+# Usage: python3 executor_benchmark.py [isotopes] [cycles] [size] [workers]
+#        (default 7 isotopes of 100 cycles of 256 by 256 pixels, up to one
+#        worker per CPU)
+#
+
+import os
+import sys
+import time
+
+import numpy as np
+from nanosims_analysis.data_structures import IsotopeData
+from nanosims_analysis.importer import Importer
+
+def best_time(function, repeat=3):
+    """ Returns the best wall time of repeat calls of function, in seconds. """
+    times = []
+    for n in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+arguments = [int(arg) for arg in sys.argv[1:]]
+n_isotopes, n_cycles, size, max_workers = (
+    arguments + [7, 100, 256, os.cpu_count() or 1][len(arguments):])
+rng = np.random.default_rng(0)
+data = [rng.poisson(100, size=(n_cycles, size, size)).astype(float)
+        for i in range(n_isotopes)]
+
+def make_importer(workers, isotopes=n_isotopes):
+    importer = Importer(workers = workers)
+    for i in range(isotopes):
+        importer.add_isotope(IsotopeData(str(i), data[i], lazy = True))
+    return importer
+
+def corrections(workers):
+    importer = make_importer(workers)
+    importer.deadtime_correct_all(dead_time = 44e-9, dwell_time = 0.001)
+    importer.roll_all(x_roll = 1, y_roll = 1)
+    importer.load_all()
+
+def single_isotope(workers):
+    importer = make_importer(workers, isotopes = 1)
+    importer.deadtime_correct_all(dead_time = 44e-9, dwell_time = 0.001)
+    importer.roll_all(x_roll = 1, y_roll = 1)
+    importer.get_isotope("0").get_data()
+
+def masks_and_sums(workers):
+    importer = make_importer(workers)
+    masks = importer.map(lambda isotope: isotope.get_mask(lower = 90))
+    importer.sum_all(masks["0"])
+    importer.masked_statistics(masks["0"])
+
+print("Isotopes: " + str(n_isotopes) + "; cycles: " + str(n_cycles) +
+      "; size: " + str(size) + "; CPUs: " + str(os.cpu_count()))
+worker_counts = [1]
+while worker_counts[-1] < max_workers:
+    worker_counts.append(min(2*worker_counts[-1], max_workers))
+
+for name, function in [("deadtime and roll, all isotopes", corrections),
+                       ("deadtime and roll, one isotope", single_isotope),
+                       ("masks and masked sums", masks_and_sums)]:
+    print(name)
+    serial = None
+    for workers in worker_counts:
+        seconds = best_time(lambda: function(workers))
+        serial = serial or seconds
+        print("\t{:3d} workers{:10.4f} s{:8.2f}x".format(workers, seconds,
+                                                         serial / seconds))
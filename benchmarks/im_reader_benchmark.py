@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+#####################
+# .IM READER BENCHMARK
+#
+# Compares reading NanoSIMS image files with the sims package against the
+# native ImReader: header only, all masses and a subset of masses.
+#
+# Usage: python3 im_reader_benchmark.py file1.im [file2.im ...]
+#
+
+import sys
+import time
+import warnings
+
+import sims
+from nanosims_analysis.importer import ImReader
+
+def best_time(function, repeat=3):
+    """ Returns the best wall time of repeat calls of function, in seconds. """
+    times = []
+    for n in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+warnings.simplefilter("ignore")
+
+for filename in sys.argv[1:]:
+    reader = ImReader(filename)
+    labels = reader.labels()
+    print("File: " + filename + "; masses: " + str(len(labels)) +
+          "; shape: " + str(reader.shape()))
+
+    results = [
+        ("sims.SIMS (header and data)", lambda: sims.SIMS(filename)),
+        ("ImReader header only", lambda: ImReader(filename)),
+        ("ImReader all masses",
+         lambda: ImReader(filename).read_data()),
+        ("ImReader first 3 masses",
+         lambda: ImReader(filename).read_data(labels[:3])),
+    ]
+    for name, function in results:
+        print("\t{:<30s}{:10.4f} s".format(name, best_time(function)))
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+#####################
+# IMPORT TIME BENCHMARK
+#
+# Times importing each module of the package in a fresh interpreter, as a
+# batch or shared memory worker process does when it starts, and lists the
+# modules loaded by it that are only needed for plots, VTK files or the sims
+# reader. Exits with status 1 if a module takes longer than the budget to
+# import, or loads one of those modules.
+#
+# Usage: python3 import_benchmark.py [budget in seconds] [repeat]
+#        (default 0.5 s, best of 5 imports)
+#
+
+import os
+import subprocess
+import sys
+
+# Budget for importing any module of the package, including numpy (about
+# 0.1 s), in seconds
+IMPORT_TIME_BUDGET = 0.5
+
+MODULES = ["nanosims_analysis.data_structures", "nanosims_analysis.importer",
+           "nanosims_analysis.shared", "nanosims_analysis.batch",
+           "nanosims_analysis.chunked"]
+
+# Loaded on first use only
+DEFERRED = ["matplotlib", "mpl_toolkits", "pyevtk", "sims", "pandas",
+            "scipy"]
+
+SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(" ".join(name for name in {deferred} if name in sys.modules))
+"""
+
+def import_time(module, repeat=5):
+    """ Returns the best time to import module in a fresh interpreter, in \
+    seconds, and the deferred modules it loaded. """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = dict(os.environ, PYTHONPATH=root)
+    times = []
+    for n in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", SCRIPT.format(module=module,
+                                                 deferred=DEFERRED)],
+            env=environment, capture_output=True, text=True,
+            check=True).stdout.splitlines()
+        times.append(float(output[0]))
+    return min(times), output[1].split() if len(output) > 1 else []
+
+if __name__ == "__main__":
+    arguments = sys.argv[1:]
+    budget = float(arguments[0]) if arguments else IMPORT_TIME_BUDGET
+    repeat = int(arguments[1]) if len(arguments) > 1 else 5
+    failed = False
+    for module in MODULES:
+        seconds, loaded = import_time(module, repeat)
+        over = seconds > budget or loaded
+        failed = failed or over
+        print("{:40s}{:8.3f} s {}".format(module, seconds,
+                                          " ".join(loaded) or "") +
+              ("  OVER BUDGET" if over else ""))
+    print("Budget: " + str(budget) + " s")
+    sys.exit(1 if failed else 0)
@@ -1 +1,2 @@
-__all__ = ["importer", "isotopedata"]
+__all__ = ["importer", "isotopedata", "cache", "chunked", "rendering",
+           "registration", "batch", "shared"]
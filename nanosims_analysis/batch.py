@@ -0,0 +1,259 @@
+"""
+
+.. module:: batch
+    :synopsis: Runs the analysis of every NanoSIMS file in a directory.
+
+.. moduleauthor:: Joshua Rehak <jsrehak@berkeley.edu>
+
+"""
+
+import argparse
+import concurrent.futures
+import csv
+import os
+from pathlib import Path
+
+import numpy as np
+
+from nanosims_analysis.cache import CubeCache
+from nanosims_analysis.data_structures import _process_context
+from nanosims_analysis.importer import Importer, RATIO_STATISTICS_DTYPE
+
+# Oxygen isotope ratios of VSMOW (Baertschi, 1976; Fahey et al., 1987)
+VSMOW_RATIOS = (("17O", "16O", 0.00038288), ("18O", "16O", 0.0020052))
+
+# Parameters of the analysis of each file, and their defaults, see
+# analyse_file
+DEFAULT_PARAMETERS = {"primary_current": None,
+                      "dead_time": 44*10**-9,
+                      "x_roll": 1,
+                      "y_roll": 1,
+                      "trim_front": 0,
+                      "trim_back": 0,
+                      "mask_isotope": "16O",
+                      "mask_lower": 0,
+                      "qsa_dwell_time": 3000}
+
+# Fields of the records returned by run_batch
+BATCH_DTYPE = np.dtype([("file", "U256")] + RATIO_STATISTICS_DTYPE.descr +
+                       [("error", "U256")])
+
+def find_im_files(directory):
+    """ Returns the NanoSIMS image (.im) files in a directory and its \
+    subdirectories, sorted by path.
+
+    :param directory: directory to search.
+    :type directory: string
+    """
+    return sorted(str(path) for path in Path(directory).rglob("*")
+                  if path.suffix.lower() == ".im" and path.is_file())
+
+def read_manifest(filename):
+    """ Reads the parameters of the analysis of each file from a CSV file \
+    with a header row. The "file" column holds the path of each file, \
+    relative to the directory of the manifest or absolute; the other columns \
+    are parameters of :func:`analyse_file`, e.g. "primary_current", \
+    "trim_front", "trim_back" and "mask_lower". Empty cells and missing \
+    columns take the default parameters.
+
+    :param filename: manifest file.
+    :type filename: string
+
+    :returns: the parameters given for each file, by resolved path.
+    :rtype: dict
+    """
+    directory = Path(filename).parent
+    manifest = {}
+    with open(filename, newline="") as f:
+        for row in csv.DictReader(f):
+            path = row.pop("file", None)
+            if not path:
+                raise RuntimeError("Manifest row without a file: " + str(row))
+            parameters = {}
+            for name, value in row.items():
+                if name not in DEFAULT_PARAMETERS:
+                    raise RuntimeError("Unknown manifest column: " + str(name))
+                if value is None or value.strip() == "":
+                    continue
+                if name == "mask_isotope":
+                    parameters[name] = value.strip()
+                elif name in ("x_roll", "y_roll", "trim_front", "trim_back"):
+                    parameters[name] = int(value)
+                else:
+                    parameters[name] = float(value)
+            manifest[str((directory / path).resolve())] = parameters
+    return manifest
+
+def analyse_file(filename, ratios=VSMOW_RATIOS, cache_directory=None,
+                 **parameters):
+    """ Runs the analysis of the scripts on one file, without prompts: \
+    import, deadtime correction, rolls and trims, a mask of the counts of \
+    one isotope, then the statistics of each ratio, see \
+    :meth:`~nanosims_analysis.importer.Importer.ratio_statistics`.
+
+    :param filename: NanoSIMS file.
+    :type filename: string
+
+    :param ratios: ratios, as (numerator label, denominator label, standard \
+                   ratio) tuples (default the oxygen isotope ratios to VSMOW).
+    :type ratios: list of tuples
+
+    :param cache_directory: directory of a \
+                            :class:`~nanosims_analysis.cache.CubeCache` of \
+                            corrected data (default None, no cache).
+    :type cache_directory: string
+
+    :param parameters: parameters of the analysis, see DEFAULT_PARAMETERS: \
+                       "primary_current" in pA for the QSA correction (none \
+                       if not given), "dead_time" in seconds, "x_roll", \
+                       "y_roll", "trim_front", "trim_back", "mask_isotope" \
+                       and "mask_lower", the isotope and the counts per pixel \
+                       at or below which pixels are masked, and \
+                       "qsa_dwell_time", the dwell time of the QSA correction.
+
+    :returns: one record per ratio, see BATCH_DTYPE.
+    :rtype: `numpy` structured array
+    """
+    unknown = set(parameters) - set(DEFAULT_PARAMETERS)
+    if unknown:
+        raise RuntimeError("Unknown parameters: " + str(sorted(unknown)))
+    parameters = dict(DEFAULT_PARAMETERS, **parameters)
+    cache = None
+    if cache_directory is not None:
+        cache = CubeCache(cache_directory)
+
+    # Files already run in parallel, each is analysed on a single thread
+    importer = Importer(workers = 1)
+    importer.process_file(filename, dead_time = parameters["dead_time"],
+                          x_roll = parameters["x_roll"],
+                          y_roll = parameters["y_roll"],
+                          trim_front = parameters["trim_front"],
+                          trim_back = parameters["trim_back"],
+                          cache = cache)
+    mask = importer.get_isotope(parameters["mask_isotope"]).get_mask(
+        lower = parameters["mask_lower"])
+    statistics = importer.ratio_statistics(
+        ratios, mask, primary_current = parameters["primary_current"],
+        dwell_time = parameters["qsa_dwell_time"])
+
+    records = np.zeros(len(statistics), dtype=BATCH_DTYPE)
+    records["file"] = filename
+    for name in RATIO_STATISTICS_DTYPE.names:
+        records[name] = statistics[name]
+    return records
+
+def _analyse(arguments):
+    """ Runs analyse_file in a worker process, returning a record holding \
+    the error instead of raising it, so one bad file does not stop a batch. """
+    filename, ratios, cache_directory, parameters = arguments
+    try:
+        return analyse_file(filename, ratios, cache_directory, **parameters)
+    except Exception as error:
+        record = np.zeros(1, dtype=BATCH_DTYPE)
+        record["file"] = filename
+        record["error"] = type(error).__name__ + ": " + str(error)
+        return record
+
+def run_batch(directory, manifest=None, ratios=VSMOW_RATIOS, processes=None,
+              output=None, cache_directory=None, **parameters):
+    """ Analyses every .im file in a directory tree with \
+    :func:`analyse_file`, one file per worker process, and collects the \
+    statistics of every ratio of every file into one table. Files that \
+    cannot be analysed get a single record holding the error.
+
+    :param directory: directory searched for .im files.
+    :type directory: string
+
+    :param manifest: CSV file of parameters for each file, see \
+                     :func:`read_manifest`.
+    :type manifest: string
+
+    :param ratios: ratios, see :func:`analyse_file`.
+    :type ratios: list of tuples
+
+    :param processes: number of worker processes (default the number of \
+                      CPUs). Workers are started by a fork server, or \
+                      spawned, not forked.
+    :type processes: int
+
+    :param output: CSV file the table is also written to.
+    :type output: string
+
+    :param cache_directory: directory of a cache of corrected data, see \
+                            :func:`analyse_file`.
+    :type cache_directory: string
+
+    :param parameters: parameters of files not in the manifest, or not given \
+                       in it, see :func:`analyse_file`.
+
+    :returns: one record per ratio per file, in order of the files, see \
+              BATCH_DTYPE.
+    :rtype: `numpy` structured array
+    """
+    filenames = find_im_files(directory)
+    file_parameters = read_manifest(manifest) if manifest else {}
+    tasks = [(filename, tuple(ratios), cache_directory,
+              dict(parameters,
+                   **file_parameters.get(str(Path(filename).resolve()), {})))
+             for filename in filenames]
+    print("Batch: " + str(len(tasks)) + " files in " + str(directory))
+
+    processes = min(processes or os.cpu_count() or 1, max(1, len(tasks)))
+    if processes == 1:
+        results = [_analyse(task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                processes, mp_context=_process_context()) as executor:
+            results = list(executor.map(_analyse, tasks))
+    table = np.concatenate(results) if results else np.zeros(0, BATCH_DTYPE)
+
+    for record in table:
+        if record["error"]:
+            print("Error: " + record["file"] + ": " + record["error"])
+    if output is not None:
+        write_table(output, table)
+    return table
+
+def write_table(filename, table):
+    """ Writes a table of :func:`run_batch` to a CSV file.
+
+    :param filename: CSV file to write.
+    :type filename: string
+
+    :param table: records to write.
+    :type table: `numpy` structured array
+    """
+    with open(filename, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(table.dtype.names)
+        for record in table:
+            writer.writerow([record[name] for name in table.dtype.names])
+
+def main(arguments=None):
+    """ Command line entry point, see ``python -m nanosims_analysis.batch \
+    --help``. """
+    parser = argparse.ArgumentParser(
+        description="Analyse every NanoSIMS .im file in a directory tree.")
+    parser.add_argument("directory", help="directory searched for .im files")
+    parser.add_argument("--manifest", help="CSV file of parameters per file")
+    parser.add_argument("--output", default="batch_results.csv",
+                        help="CSV file of results (default %(default)s)")
+    parser.add_argument("--processes", type=int,
+                        help="number of worker processes (default all CPUs)")
+    parser.add_argument("--cache", help="directory of cached corrected data")
+    parser.add_argument("--primary-current", type=float,
+                        help="primary current in pA, for files not in the "
+                             "manifest")
+    parser.add_argument("--mask-lower", type=float,
+                        default=DEFAULT_PARAMETERS["mask_lower"],
+                        help="16O counts per pixel at or below which pixels "
+                             "are masked (default %(default)s)")
+    arguments = parser.parse_args(arguments)
+    run_batch(arguments.directory, manifest=arguments.manifest,
+              processes=arguments.processes, output=arguments.output,
+              cache_directory=arguments.cache,
+              primary_current=arguments.primary_current,
+              mask_lower=arguments.mask_lower)
+
+if __name__ == "__main__":
+    main()
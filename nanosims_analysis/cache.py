@@ -0,0 +1,172 @@
+"""
+
+.. module:: cache
+    :synopsis: On-disk cache of imported and corrected isotope data.
+
+.. moduleauthor:: Joshua Rehak <jsrehak@berkeley.edu>
+
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+
+class CubeCache(object):
+    """ A directory of imported and corrected isotope data, see \
+    :meth:`~nanosims_analysis.importer.Importer.process_file`. Each entry is \
+    identified by a key made from the hash of the file content and the \
+    parameters used to correct it, and holds one `numpy` .npy file per \
+    isotope, which is memory-mapped when the entry is loaded. When the \
+    entries take more than max_size bytes, the least recently used entries \
+    are removed.
+
+    :param directory: directory of the cache, created if it does not exist.
+    :type directory: string
+
+    :param max_size: maximum size of the cache in bytes (default 4 GiB).
+    :type max_size: int
+    """
+    def __init__(self, directory, max_size=2**32):
+        self._directory = Path(directory)
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._max_size = max_size
+
+    def file_digest(self, filename):
+        """ Returns the SHA-256 hash of the content of a file. Hashes are \
+        remembered in the cache directory by path, size and modification time, \
+        so an unchanged file is only read the first time.
+
+        :param filename: file to hash.
+        :type filename: string
+        """
+        stat = os.stat(filename)
+        path = str(Path(filename).resolve())
+        index_file = self._directory / "digests.json"
+        index = {}
+        if index_file.is_file():
+            with open(index_file) as f:
+                index = json.load(f)
+        if (path in index and index[path]["size"] == stat.st_size and
+            index[path]["mtime"] == stat.st_mtime_ns):
+            return index[path]["digest"]
+
+        digest = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                digest.update(chunk)
+        index[path] = {"size": stat.st_size, "mtime": stat.st_mtime_ns,
+                       "digest": digest.hexdigest()}
+        _write_json(index_file, index)
+        return index[path]["digest"]
+
+    def key(self, filename, parameters):
+        """ Returns the key of the entry for a file corrected with the given \
+        parameters.
+
+        :param filename: NanoSIMS file.
+        :type filename: string
+
+        :param parameters: parameters of the import and corrections, must be \
+                           serializable to JSON.
+        :type parameters: dict
+        """
+        text = self.file_digest(filename) + json.dumps(parameters,
+                                                       sort_keys=True)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def load(self, key):
+        """ Returns the metadata and a dictionary of read-only memory-mapped \
+        arrays by label of an entry, or None if there is no entry for key.
+
+        :param key: key of the entry, see :meth:`key`.
+        :type key: string
+        """
+        entry = self._directory / key
+        try:
+            with open(entry / "entry.json") as f:
+                metadata = json.load(f)
+            data = {label: np.load(entry / (str(i) + ".npy"), mmap_mode="r")
+                    for i, label in enumerate(metadata["labels"])}
+        except FileNotFoundError:
+            return None
+        _touch(entry)
+        return metadata, data
+
+    def store(self, key, metadata, data):
+        """ Stores an entry, then removes least recently used entries until \
+        the cache is no larger than its maximum size.
+
+        :param key: key of the entry, see :meth:`key`.
+        :type key: string
+
+        :param metadata: information stored with the data, must be \
+                         serializable to JSON.
+        :type metadata: dict
+
+        :param data: arrays to store, by label.
+        :type data: dict
+        """
+        # Written to a temporary directory first, so that an entry is either
+        # complete or missing
+        entry = self._directory / key
+        temporary = self._directory / (key + ".tmp-" + str(os.getpid()))
+        temporary.mkdir()
+        metadata = dict(metadata, labels=list(data))
+        for i, array in enumerate(data.values()):
+            np.save(temporary / (str(i) + ".npy"), array)
+        _write_json(temporary / "entry.json", metadata)
+        try:
+            os.rename(temporary, entry)
+        except OSError:
+            # Stored in the meantime by another process
+            shutil.rmtree(temporary)
+        _touch(entry)
+        self.evict()
+
+    def _entries(self):
+        """ Returns (last use, size, path) of every entry. """
+        entries = []
+        for entry in self._directory.iterdir():
+            if not (entry / "entry.json").is_file() or ".tmp-" in entry.name:
+                continue
+            size = sum(path.stat().st_size for path in entry.iterdir())
+            entries.append(((entry / "entry.json").stat().st_mtime_ns,
+                            size, entry))
+        return entries
+
+    def size(self):
+        """ Returns the total size of the entries in bytes. """
+        return sum(size for last_use, size, entry in self._entries())
+
+    def evict(self):
+        """ Removes least recently used entries until the cache is no larger \
+        than its maximum size. """
+        entries = sorted(self._entries())
+        total = sum(size for last_use, size, entry in entries)
+        while entries and total > self._max_size:
+            last_use, size, entry = entries.pop(0)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """ Removes every entry. """
+        for last_use, size, entry in self._entries():
+            shutil.rmtree(entry, ignore_errors=True)
+
+def _touch(entry):
+    """ Marks an entry as recently used. The time is set explicitly, as the \
+    file system may only update modification times every few milliseconds. """
+    now = time.time_ns()
+    os.utime(entry / "entry.json", ns=(now, now))
+
+def _write_json(filename, value):
+    """ Writes value to filename as JSON, replacing the file at once. """
+    temporary = str(filename) + ".tmp-" + str(os.getpid())
+    with open(temporary, "w") as f:
+        json.dump(value, f)
+    os.replace(temporary, filename)
@@ -0,0 +1,238 @@
+"""
+
+.. module:: chunked
+    :synopsis: Chunked, compressed storage of isotope data.
+
+.. moduleauthor:: Joshua Rehak <jsrehak@berkeley.edu>
+
+"""
+
+import json
+
+import numpy as np
+
+from nanosims_analysis.data_structures import IsotopeData, _as_mask
+from nanosims_analysis.importer import Importer
+
+def _chunk_slices(shape, chunk_shape):
+    """ Yields the index of each chunk and the slices of the data it holds. """
+    counts = [-(-n // c) for n, c in zip(shape, chunk_shape)]
+    for index in np.ndindex(*counts):
+        yield index, tuple(slice(i*c, (i + 1)*c)
+                           for i, c in zip(index, chunk_shape))
+
+def _chunk_key(isotope, index):
+    return "data_" + "_".join(str(i) for i in (isotope,) + index)
+
+def save_chunked(filename, importer, cycles_per_chunk=16, tile_size=64):
+    """ Saves the isotopes of an importer to a chunked file. The data of each \
+    isotope is split into chunks of cycles_per_chunk cycles and tiles of \
+    tile_size by tile_size pixels, each compressed on its own and stored with \
+    its minimum, maximum and sum, see :class:`ChunkedFile`. The data is saved \
+    as returned by \
+    :meth:`~nanosims_analysis.data_structures.IsotopeData.get_data`, in its \
+    current dtype: integer counts, e.g. imported with dtype "compact", \
+    compress best.
+
+    :param filename: file to write, usually ending in .npz.
+    :type filename: string
+
+    :param importer: importer holding the isotopes, all with the same shape.
+    :type importer: :class:`~nanosims_analysis.importer.Importer`
+
+    :param cycles_per_chunk: number of cycles in each chunk (default 16).
+    :type cycles_per_chunk: int
+
+    :param tile_size: size of each chunk in x and y in pixels (default 64).
+    :type tile_size: int
+    """
+    isotopes = list(importer._isotopes.values())
+    shapes = set(isotope._shape() for isotope in isotopes)
+    if len(shapes) != 1:
+        raise RuntimeError("Isotopes must have the same shape to be saved")
+    shape = shapes.pop()
+    chunk_shape = (cycles_per_chunk, tile_size, tile_size)
+    counts = tuple(-(-n // c) for n, c in zip(shape, chunk_shape))
+
+    header = getattr(importer, "_header", None)
+    if header is not None:
+        header = {"label list": list(header["label list"]),
+                  "BFields": [{"time per pixel": float(
+                      header["BFields"][0]["time per pixel"])}]}
+    arrays = {"labels": np.array([isotope.get_label()
+                                  for isotope in isotopes]),
+              "shape": np.array(shape),
+              "chunk_shape": np.array(chunk_shape),
+              "header": np.array(json.dumps(header)),
+              "corrections": np.array(json.dumps([
+                  [isotope._is_deadtime_corrected,
+                   getattr(isotope, "_dwell_time", None),
+                   getattr(isotope, "_dead_time", None)]
+                  for isotope in isotopes]))}
+    for i, isotope in enumerate(isotopes):
+        data = isotope.get_data()
+        minimum = np.empty(counts, dtype=data.dtype)
+        maximum = np.empty(counts, dtype=data.dtype)
+        total = np.empty(counts)
+        for index, slices in _chunk_slices(shape, chunk_shape):
+            chunk = data[slices]
+            minimum[index] = chunk.min()
+            maximum[index] = chunk.max()
+            total[index] = chunk.sum(dtype=np.float64)
+            arrays[_chunk_key(i, index)] = chunk
+        arrays["min_" + str(i)] = minimum
+        arrays["max_" + str(i)] = maximum
+        arrays["sum_" + str(i)] = total
+    np.savez_compressed(filename, **arrays)
+
+class ChunkedFile(object):
+    """ A file written by :func:`save_chunked`. Only the chunk statistics are \
+    read when the file is opened, chunks are read and decompressed when they \
+    are needed, see :class:`ChunkedIsotope`.
+
+    :param filename: file to open.
+    :type filename: string
+    """
+    def __init__(self, filename):
+        self._filename = filename
+        self._archive = np.load(filename)
+        self._labels = [str(label) for label in self._archive["labels"]]
+        self._shape = tuple(int(n) for n in self._archive["shape"])
+        self._chunk_shape = tuple(int(n) for n in self._archive["chunk_shape"])
+
+    def labels(self):
+        """ Returns the labels of the isotopes in the file. """
+        return list(self._labels)
+
+    def get_isotope(self, label):
+        """ Get the isotope identified by label
+
+        :param label: isotope label
+        :type label: string
+        """
+        if label not in self._labels:
+            raise RuntimeError("Isotope " + label + " not found in file")
+        return ChunkedIsotope(self, self._labels.index(label))
+
+    def to_importer(self):
+        """ Reads every isotope into a new \
+        :class:`~nanosims_analysis.importer.Importer`. """
+        importer = Importer()
+        importer._filename = self._filename
+        header = json.loads(str(self._archive["header"]))
+        if header is not None:
+            importer._header = header
+        for label in self._labels:
+            importer.add_isotope(self.get_isotope(label).to_isotope())
+        return importer
+
+    def close(self):
+        self._archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class ChunkedIsotope(object):
+    """ An isotope in a :class:`ChunkedFile`. Masks and sums use the \
+    statistics of each chunk to skip chunks that are entirely selected or \
+    entirely masked, only the other chunks are decompressed.
+
+    Use :meth:`to_isotope` for the other operations of \
+    :class:`~nanosims_analysis.data_structures.IsotopeData`.
+    """
+    def __init__(self, chunked_file, index):
+        self._file = chunked_file
+        self._index = index
+        self._label = chunked_file._labels[index]
+        archive = chunked_file._archive
+        self._min = archive["min_" + str(index)]
+        self._max = archive["max_" + str(index)]
+        self._sum = archive["sum_" + str(index)]
+        # Number of chunks decompressed so far
+        self._chunks_read = 0
+
+    def _chunks(self):
+        return _chunk_slices(self._file._shape, self._file._chunk_shape)
+
+    def _read(self, index):
+        self._chunks_read += 1
+        return self._file._archive[_chunk_key(self._index, index)]
+
+    def get_label(self):
+        return self._label
+
+    def n_cycles(self):
+        return self._file._shape[0]
+
+    def get_data(self):
+        """ Returns the data of the isotope, reading every chunk. """
+        data = np.empty(self._file._shape, dtype=self._min.dtype)
+        for index, slices in self._chunks():
+            data[slices] = self._read(index)
+        return data
+
+    def to_isotope(self):
+        """ Reads the isotope into an \
+        :class:`~nanosims_analysis.data_structures.IsotopeData` object. """
+        data = self.get_data()
+        isotope = IsotopeData(self._label, data, dtype=data.dtype)
+        corrected, dwell_time, dead_time = json.loads(
+            str(self._file._archive["corrections"]))[self._index]
+        if corrected:
+            isotope._is_deadtime_corrected = True
+            isotope._dwell_time = dwell_time
+            isotope._dead_time = dead_time
+        return isotope
+
+    def get_mask(self, lower=0, upper=np.Inf):
+        """ Returns the same mask as \
+        :meth:`~nanosims_analysis.data_structures.IsotopeData.get_mask`. \
+        Chunks with all values outside or all values inside the bounds are \
+        not read.
+
+        :param lower: lower bound for mask (default 0), values less than or \
+                      equal to this will be masked.
+        :type type: float
+
+        :param upper: upper bound for mask (default infinity) , values more \
+                      than this will be masked.
+        :type upper: float
+        """
+        mask = np.empty(self._file._shape, dtype=bool)
+        for index, slices in self._chunks():
+            if self._max[index] <= lower or self._min[index] > upper:
+                mask[slices] = True
+            elif self._min[index] > lower and self._max[index] <= upper:
+                mask[slices] = False
+            else:
+                data = self._read(index)
+                mask[slices] = np.logical_or(data <= lower, data > upper)
+        return _as_mask(mask)
+
+    def sum(self, mask=None):
+        """ Returns the sum of all the data, with optional masking. Chunks \
+        that are entirely masked or entirely selected are not read.
+
+        :param mask: numpy mask array.
+        :type mask: numpy array, optional)
+        """
+        if mask is None:
+            return self._sum.sum()
+        mask = np.asarray(mask)
+        if mask.shape != self._file._shape:
+            raise RuntimeError("Mask shape " + str(mask.shape) +
+                               " does not match data shape " +
+                               str(self._file._shape))
+        total = 0.0
+        for index, slices in self._chunks():
+            chunk_mask = mask[slices]
+            if chunk_mask.all():
+                continue
+            elif not chunk_mask.any():
+                total += self._sum[index]
+            else:
+                total += self._read(index)[~chunk_mask].sum(dtype=np.float64)
+        return total
@@ -7,43 +7,767 @@
 
 """
 
+import collections
+import concurrent.futures
+import copy
+import multiprocessing
+import os
+import threading
+import weakref
+
 import numpy as np
 import numpy.ma as ma
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
 
-try:
-    from pyevtk.hl import gridToVTK
-except ImportError:
-    print("Unable to load pvevtk, output to VTK will be disabled")
+# matplotlib and pyevtk are imported when plots or VTK files are first made,
+# so that importing the package, e.g. in batch workers, stays fast
+from nanosims_analysis import registration, rendering, shared
+
+# Approximate number of values processed at once by the in-place kernels
+# below, sets the size of their scratch buffers (512 kB of float64).
+BLOCK_SIZE = 2**16
+
+def _cycle_blocks(data):
+    """ Yields views of data, shaped (..., cycle, x, y), of whole cycles of a \
+    single isotope, holding about BLOCK_SIZE values each. """
+    n_cycles, nx, ny = np.shape(data)[-3:]
+    n = max(1, BLOCK_SIZE // max(1, nx*ny))
+    for index in np.ndindex(*np.shape(data)[:-3]):
+        for start in range(0, n_cycles, n):
+            yield data[index + (slice(start, start + n),)]
+
+# Scratch buffers of the kernels below, reused between calls, one set per
+# thread.
+_scratch = threading.local()
+
+# Marks the threads running tasks of _parallel_map
+_worker = threading.local()
+
+def _parallel_map(executor, function, items):
+    """ Returns the list of function applied to each item, run concurrently \
+    on executor if one is given. Maps started from within a task run \
+    serially, so tasks never wait for tasks queued behind them. Results are \
+    in the order of items, so reductions combined from them do not depend on \
+    the number of workers. """
+    items = list(items)
+    if executor is None or len(items) < 2 or getattr(_worker, "busy", False):
+        return [function(item) for item in items]
+
+    def task(item):
+        _worker.busy = True
+        try:
+            return function(item)
+        finally:
+            _worker.busy = False
+    return list(executor.map(task, items))
+
+def _scratch_buffer(name, shape, dtype=float):
+    """ Returns a reusable scratch array with the given shape and dtype. \
+    Buffers with different names may be used at the same time. """
+    size = int(np.prod(shape))
+    key = (name, np.dtype(dtype))
+    buffers = _scratch.__dict__.setdefault("buffers", {})
+    if key not in buffers or buffers[key].size < size:
+        buffers[key] = np.empty(size, dtype=dtype)
+    return buffers[key][:size].reshape(shape)
+
+def _compact_dtype(data):
+    """ Returns the smallest integer dtype that holds integer data, float64 \
+    for any other data. """
+    data = np.asarray(data)
+    if data.dtype.kind not in "ui":
+        return np.dtype(float)
+    if data.size == 0:
+        return data.dtype
+    return np.result_type(np.min_scalar_type(data.min()),
+                          np.min_scalar_type(data.max()))
+
+def _deadtime_correct_inplace(data, dwell_time, dead_time, executor=None):
+    """ Deadtime corrects data in place, block by block, see \
+    :meth:`IsotopeData.perform_deadtime_correction`. Gives the same result as \
+    the out of place expression, using one block sized scratch buffer per \
+    thread. Blocks are corrected concurrently on executor if one is given. """
+    def correct(block):
+        scratch = _scratch_buffer("deadtime", block.shape)
+        np.divide(block, dwell_time, out=block)
+        np.multiply(block, dead_time, out=scratch)
+        np.subtract(1, scratch, out=scratch)
+        np.divide(block, scratch, out=block)
+        np.multiply(block, dwell_time, out=block)
+    _parallel_map(executor, correct, _cycle_blocks(data))
+
+# Beta of the QSA correction of Hillion et al. (2008) for each ratio, by
+# "numerator/denominator" isotope labels, see qsa_beta
+QSA_BETA = {"17O/16O": 0.75, "18O/16O": 0.75,
+            "32S/33S": 0.75, "32S/34S": 0.75, "32S/36S": 0.75,
+            "12C/13C": 1.0, "12C2/13C12C": 1.0,
+            "28Si/29Si": 0.6, "28Si/30Si": 0.6}
+
+# Theoretical beta for Poisson statistics, used for other ratios
+QSA_DEFAULT_BETA = 0.5
+
+# Primary ions per second per pA of primary current
+IONS_PER_PICOAMPERE = 6.2415*10**6
+
+def qsa_beta(numerator_label, denominator_label):
+    """ Returns the beta of the QSA correction for a ratio of two isotopes, \
+    from QSA_BETA, or QSA_DEFAULT_BETA for ratios not in the table.
+
+    :param numerator_label: label of the numerator isotope, e.g. "17O".
+    :type numerator_label: string
+
+    :param denominator_label: label of the denominator isotope, e.g. "16O".
+    :type denominator_label: string
+    """
+    return QSA_BETA.get(numerator_label + "/" + denominator_label,
+                        QSA_DEFAULT_BETA)
+
+def _qsa_correct_inplace(ratio, denominator, primary_ions, beta):
+    """ QSA corrects ratio in place, block by block: \
+    ratio / (1 + beta*(denominator / primary_ions)), with the same rounding \
+    as that expression, using one block sized scratch buffer. """
+    for block, denominator_block in zip(_cycle_blocks(ratio),
+                                        _cycle_blocks(denominator)):
+        scratch = _scratch_buffer("qsa", block.shape)
+        np.divide(denominator_block, primary_ions, out=scratch)
+        np.multiply(scratch, beta, out=scratch)
+        np.add(1, scratch, out=scratch)
+        np.divide(block, scratch, out=block)
+
+def _roll_into(source, out, x_roll, y_roll):
+    """ Writes source rolled by x_roll and y_roll along its last two axes into \
+    out, equivalent to np.roll without the intermediate copies. """
+    nx, ny = np.shape(source)[-2:]
+    x_roll %= nx
+    y_roll %= ny
+    for x_from, x_to in _roll_slices(nx, x_roll):
+        for y_from, y_to in _roll_slices(ny, y_roll):
+            out[..., x_to, y_to] = source[..., x_from, y_from]
+
+def _roll_slices(n, shift):
+    """ Pairs of (source, destination) slices that roll an axis of length n \
+    by shift, with 0 <= shift < n. """
+    if shift == 0:
+        return [(slice(None), slice(None))]
+    return [(slice(0, n - shift), slice(shift, n)),
+            (slice(n - shift, n), slice(0, shift))]
+
+def _roll_inplace(data, x_roll, y_roll, executor=None):
+    """ Rolls data in place along its last two axes, block by block, \
+    concurrently on executor if one is given. """
+    if not _is_rolled(data, x_roll, y_roll):
+        return
+
+    def roll(block):
+        scratch = _scratch_buffer("roll", block.shape, block.dtype)
+        scratch[...] = block
+        _roll_into(scratch, block, x_roll, y_roll)
+    _parallel_map(executor, roll, _cycle_blocks(data))
+
+def _is_rolled(data, x_roll, y_roll):
+    """ Returns True if rolling data by x_roll and y_roll changes it. """
+    return (x_roll % np.shape(data)[-2] != 0 or
+            y_roll % np.shape(data)[-1] != 0)
+
+def _rolled(data, x_roll, y_roll):
+    """ Returns data rolled along its last two axes, data itself if the roll \
+    does not change it. """
+    if not _is_rolled(data, x_roll, y_roll):
+        return data
+    out = np.empty_like(data)
+    _roll_into(data, out, x_roll, y_roll)
+    return out
+
+def _block_moments(values):
+    """ Returns the count, and the sums, means and sums of squared deviations \
+    of the rows of a 2D float64 array. values is overwritten. """
+    count = np.shape(values)[1]
+    sums = values.sum(axis=1)
+    if count == 0:
+        return 0, sums, sums.copy(), sums.copy()
+    means = sums / count
+    values -= means[:, np.newaxis]
+    np.square(values, out=values)
+    return count, sums, means, values.sum(axis=1)
+
+def _combine_moments(a, b):
+    """ Combines two results of _block_moments with the pairwise update of \
+    Chan et al. """
+    count_a, sums_a, means_a, m2_a = a
+    count_b, sums_b, means_b, m2_b = b
+    count = count_a + count_b
+    if count == 0:
+        return a
+    delta = means_b - means_a
+    means = means_a + delta * (count_b / count)
+    m2 = m2_a + m2_b + delta**2 * (count_a * count_b / count)
+    return count, sums_a + sums_b, means, m2
+
+def _finish_moments(moments):
+    """ Returns the sums, means and variances of combined moments, means and \
+    variances are nan when no values were selected. """
+    count, sums, means, m2 = moments
+    if count == 0:
+        return sums, np.full(len(sums), np.nan), np.full(len(sums), np.nan)
+    return sums, means, m2 / count
+
+def _masked_moments(rows, indices, executor=None):
+    """ Returns the sums, means and variances of the values at the flat \
+    indices of each array in rows, as float64 arrays with one entry per row. \
+    The values are gathered for all rows at once, block by block, so each \
+    block of indices is read once. Blocks are reduced concurrently on \
+    executor if one is given, and combined in order. """
+    def reduce(start):
+        block = indices[start:start + BLOCK_SIZE]
+        values = _scratch_buffer("moments", (len(rows), len(block)))
+        for i, row in enumerate(rows):
+            values[i] = row[block]
+        return _block_moments(values)
+
+    moments = (0, np.zeros(len(rows)), np.zeros(len(rows)), np.zeros(len(rows)))
+    for block_moments in _parallel_map(executor, reduce,
+                                       range(0, len(indices), BLOCK_SIZE)):
+        moments = _combine_moments(moments, block_moments)
+    return _finish_moments(moments)
+
+def label_regions(mask, connectivity=1):
+    """ Labels the connected regions of the values selected by a mask, e.g. \
+    the grains of a mask from :meth:`IsotopeData.get_mask`, for \
+    :meth:`IsotopeData.region_statistics`. Needs `scipy`.
+
+    :param mask: values that are True are masked and belong to no region. A \
+                 3D mask gives regions connected across cycles, a 2D mask \
+                 (x, y), e.g. ``mask.all(axis=0)``, gives regions of pixels \
+                 that apply to every cycle.
+    :type mask: numpy bool array
+
+    :param connectivity: 1 (default) for regions connected by faces, up to \
+                         the number of dimensions of the mask to also \
+                         connect regions by edges and corners.
+    :type connectivity: int
+
+    :returns: the label image, holding the region of each value from 1 to \
+              the number of regions, and 0 for masked values, and the \
+              number of regions.
+    :rtype: tuple
+    """
+    try:
+        from scipy import ndimage
+    except ImportError:
+        raise RuntimeError("scipy is needed to label regions")
+    selected = ~np.asarray(mask, dtype=bool)
+    structure = ndimage.generate_binary_structure(selected.ndim, connectivity)
+    return ndimage.label(selected, structure=structure)
+
+def _check_region_labels(labels, shape):
+    """ Returns a label image as a flat-indexable integer array and the \
+    number of labels, including 0, checking it against a data shape. """
+    labels = np.asarray(labels)
+    if labels.dtype.kind not in "ui":
+        raise RuntimeError("Region labels must be integers")
+    if labels.shape != tuple(shape) and labels.shape != tuple(shape)[1:]:
+        raise RuntimeError("Label image shape " + str(labels.shape) +
+                           " does not match data shape " + str(shape))
+    if labels.size and labels.min() < 0:
+        raise RuntimeError("Region labels must not be negative")
+    labels = labels.astype(np.intp, copy=False)
+    return labels, (int(labels.max()) + 1 if labels.size else 1)
+
+def _region_sums(blocks, labels, n_labels):
+    """ Returns the sums of the values of blocks of cycles, as given by \
+    _stored_blocks, for each label of a label image of the stored data, 2D \
+    for the same labels in every cycle, or 3D. """
+    if labels.ndim == 2:
+        # Sum the cycles first, then a single bincount of the image
+        image = np.zeros(labels.shape)
+        for start, block in blocks:
+            image += block.sum(axis=0, dtype=np.float64)
+        return np.bincount(labels.reshape(-1), weights=image.reshape(-1),
+                           minlength=n_labels)
+    sums = np.zeros(n_labels)
+    for start, block in blocks:
+        block_labels = labels[start:start + len(block)].reshape(-1)
+        sums += np.bincount(block_labels, weights=block.reshape(-1),
+                            minlength=n_labels)
+    return sums
+
+def _region_counts(labels, n_labels, n_cycles):
+    """ Returns the number of values of the data with each label. """
+    counts = np.bincount(labels.reshape(-1), minlength=n_labels)
+    if labels.ndim == 2:
+        counts *= n_cycles
+    return counts
+
+def _load_pyevtk():
+    """ Imports pyevtk, the first time a VTK file is written. """
+    try:
+        import pyevtk.evtk
+        import pyevtk.hl
+        import pyevtk.vtk
+    except ImportError:
+        raise RuntimeError("Unable to load pyevtk, output to VTK is disabled")
+    return pyevtk
+
+def _write_vtk(filename, fields, shape, first_cycle=0):
+    """ Writes cycles of one or more fields, shaped (cycle, x, y), to a VTK \
+    rectilinear grid file with one cell data array per field, as gridToVTK \
+    does for the fields swapped to (y, x, cycle). The fields are written a \
+    block of cycles at a time, without copying them, and with the raw bytes \
+    of each block rather than value by value.
+
+    :param filename: file to write, without extension.
+    :param fields: list of (name, dtype, blocks), where blocks() yields the \
+                   consecutive blocks of cycles of the field.
+    :param shape: shape of the fields, (cycle, x, y).
+    :param first_cycle: index of the first cycle within the whole grid, \
+                        for pieces of a partitioned grid.
+    :returns: name of the file written.
+    """
+    n_cycles, nx, ny = shape
+    start = (0, 0, first_cycle)
+    end = (ny, nx, first_cycle + n_cycles)
+    coordinates = [np.arange(first, last + 1, dtype='float64')
+                   for first, last in zip(start, end)]
+
+    pyevtk = _load_pyevtk()
+    vtk_file = pyevtk.vtk.VtkFile(filename, pyevtk.vtk.VtkRectilinearGrid)
+    vtk_file.openGrid(start=start, end=end)
+    vtk_file.openPiece(start=start, end=end)
+    vtk_file.openElement("Coordinates")
+    for name, coordinate in zip(["x_coordinates", "y_coordinates",
+                                 "z_coordinates"], coordinates):
+        vtk_file.addData(name, coordinate)
+    vtk_file.closeElement("Coordinates")
+    vtk_file.openData("Cell", scalars=fields[0][0])
+    for name, dtype, blocks in fields:
+        vtk_file.addHeader(name, np.dtype(dtype).name, n_cycles*nx*ny, 1)
+    vtk_file.closeData("Cell")
+    vtk_file.closePiece()
+    vtk_file.closeGrid()
+
+    for coordinate in coordinates:
+        vtk_file.appendData(coordinate)
+    stream = vtk_file.xml.stream
+    for name, dtype, blocks in fields:
+        dtype = np.dtype(dtype).newbyteorder("=")
+        pyevtk.evtk.writeBlockSize(stream, n_cycles*nx*ny*dtype.itemsize)
+        for block in blocks():
+            stream.write(np.ascontiguousarray(block, dtype=dtype).data)
+    vtk_file.save()
+    return vtk_file.getFileName()
+
+def _bin(data, n, k, reduction="sum"):
+    """ Sums, or averages with reduction "mean", data shaped (cycle, x, y) \
+    over blocks of k cycles by n by n pixels, without loops. Cycles and \
+    pixels left over at the ends are dropped. Integer data is summed in \
+    int64. """
+    n_cycles, nx, ny = np.shape(data)
+    n_cycles, nx, ny = n_cycles // k, nx // n, ny // n
+    blocks = np.reshape(data[:n_cycles*k, :nx*n, :ny*n],
+                        (n_cycles, k, nx, n, ny, n))
+    if reduction == "mean":
+        return blocks.mean(axis=(1, 3, 5))
+    dtype = np.int64 if np.dtype(data.dtype).kind in "ui" else None
+    return blocks.sum(axis=(1, 3, 5), dtype=dtype)
+
+def _blocks_of(data):
+    """ Yields the index of the first cycle and blocks of cycles of data, \
+    shaped (cycle, x, y), holding about BLOCK_SIZE values each. """
+    n_cycles, nx, ny = np.shape(data)
+    n = max(1, BLOCK_SIZE // max(1, nx*ny))
+    for start in range(0, n_cycles, n):
+        yield start, data[start:start + n]
+
+def _vtk_dtype(dtype, mask):
+    """ dtype of a field written to VTK: the stored dtype, made signed when \
+    a mask is given, so that masked values can be written as -1. """
+    if isinstance(mask, np.ndarray):
+        return np.result_type(dtype, np.int8)
+    return np.dtype(dtype)
+
+def _vtk_blocks(stored_blocks, data_roll, mask, mask_roll):
+    """ Yields the blocks of a field for :func:`_write_vtk`: the stored \
+    blocks rolled by data_roll, with the values selected by mask rolled by \
+    mask_roll set to -1. """
+    for start, block in stored_blocks:
+        out = _scratch_buffer("vtk", block.shape,
+                              _vtk_dtype(block.dtype, mask))
+        _roll_into(block, out, *data_roll)
+        if isinstance(mask, np.ndarray):
+            out[_rolled(mask[start:start + len(block)], *mask_roll)] = -1
+        yield out
+
+def _piece_arrays(datasets, x_roll, y_roll, mask, first, last):
+    """ Returns (name, stored data, data roll, mask, mask roll) of each \
+    dataset, for cycles first to last. """
+    arrays = []
+    for dataset in datasets:
+        arrays.append((dataset._label,
+                       dataset._stored_cycles(first, last),
+                       (x_roll + dataset._virtual_roll[0],
+                        y_roll + dataset._virtual_roll[1]),
+                       mask[first:last] if isinstance(mask, np.ndarray)
+                       else None,
+                       (x_roll, y_roll)))
+    return arrays
+
+def _write_vtk_piece(filename, first, arrays):
+    """ Writes a piece of a partitioned VTK grid, starting at cycle first, \
+    run by worker processes. arrays are those of :func:`_piece_arrays`. """
+    fields = []
+    for name, data, data_roll, mask, mask_roll in arrays:
+        blocks = (lambda data=data, data_roll=data_roll, mask=mask,
+                  mask_roll=mask_roll:
+                  _vtk_blocks(_blocks_of(data), data_roll, mask, mask_roll))
+        fields.append((name, _vtk_dtype(data.dtype, mask), blocks))
+    return _write_vtk(filename, fields, np.shape(data), first)
+
+def _process_context():
+    """ Multiprocessing context of worker pools. Forking while threads of the \
+    importer executors hold locks can deadlock the workers, so they are \
+    started by a fork server, or spawned where there is none. """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+def _write_partitioned_vtk(filename, datasets, x_roll, y_roll, mask, pieces,
+                           processes=None):
+    """ Writes datasets to pieces of consecutive cycles, each a VTK \
+    rectilinear grid file written by a pool of worker processes, and a \
+    parallel VTK (.pvtr) file that ties the pieces together. Returns the \
+    name of the .pvtr file.
+
+    The workers are not forked, see :func:`_process_context`, so each piece \
+    is sent to them with its arguments. """
+    n_cycles, nx, ny = datasets[0]._shape()
+    bounds = np.linspace(0, n_cycles, min(pieces, n_cycles) + 1).astype(int)
+    name = os.path.basename(filename)
+    # Applies pending corrections once, before the workers start
+    dtypes = {dataset._label: (_vtk_dtype(dataset._stored_dtype(), mask), 1)
+              for dataset in datasets}
+
+    processes = processes or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(
+            processes, mp_context=_process_context()) as executor:
+        # Only a few pieces are copied to the workers at a time
+        running = set()
+        for i, (first, last) in enumerate(zip(bounds[:-1], bounds[1:])):
+            arrays = _piece_arrays(datasets, x_roll, y_roll, mask, first, last)
+            running.add(executor.submit(_write_vtk_piece,
+                                        filename + "_" + str(i), first,
+                                        arrays))
+            if len(running) >= 2*processes:
+                done, running = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+        for future in running:
+            future.result()
+
+    return _load_pyevtk().hl.writeParallelVTKGrid(
+        filename, coordsData=((ny + 1, nx + 1, n_cycles + 1),
+                              np.dtype('float64')),
+        starts=[(0, 0, first) for first in bounds[:-1]],
+        ends=[(ny, nx, last) for last in bounds[1:]],
+        sources=[name + "_" + str(i) + ".vtr" for i in range(len(bounds) - 1)],
+        cellData=dtypes)
+
+class Mask(np.ndarray):
+    """ A mask for isotope data. As for `numpy` masks, values that *will* be \
+    masked are True. A Mask can be used anywhere a `numpy` bool array is \
+    accepted. The flat indices of the selected (unmasked) values are found \
+    once and reused for every isotope the mask is applied to, and reductions \
+    of an isotope over a Mask are memoized until the data of the isotope \
+    changes. Results of operations on a Mask are plain arrays.
+
+    A Mask can be changed like any array, e.g. ``mask[0] = True`` or \
+    ``mask |= other``, which drops its indices and memoized reductions. \
+    Changes made through plain views of it, e.g. ``np.asarray(mask)``, are \
+    not seen.
+
+    :param mask: mask values, copied into the Mask.
+    :type mask: `numpy` bool array
+    """
+    def __new__(cls, mask):
+        return _as_mask(np.array(mask, dtype=bool))
+
+    def __array_finalize__(self, obj):
+        self._indices = None
+        self._version = 0
+
+    def __array_wrap__(self, array, context=None, return_scalar=False):
+        if array.shape == ():
+            return array[()]
+        return array.view(np.ndarray)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, out=None, **kwargs):
+        inputs = [x.view(np.ndarray) if isinstance(x, Mask) else x
+                  for x in inputs]
+        if out is not None:
+            for array in out:
+                if isinstance(array, Mask):
+                    array._modified()
+            kwargs["out"] = tuple(array.view(np.ndarray)
+                                  if isinstance(array, Mask) else array
+                                  for array in out)
+        result = getattr(ufunc, method)(*inputs, **kwargs)
+        # In place operations, e.g. mask |= other, keep the Mask
+        if out is not None and len(out) == 1 and isinstance(out[0], Mask):
+            return out[0]
+        return result
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._modified()
+
+    def fill(self, value):
+        super().fill(value)
+        self._modified()
+
+    def _modified(self):
+        """ Drops the indices of this Mask, and of the Masks it is a view \
+        of, after their values change. """
+        mask = self
+        while isinstance(mask, Mask):
+            mask._indices = None
+            mask._version += 1
+            mask = mask.base
+
+    def indices(self):
+        """ Returns the flat indices of the selected (unmasked) values. """
+        if self._indices is None:
+            indices = np.flatnonzero(~self.view(np.ndarray))
+            if self.size < 2**31:
+                indices = indices.astype(np.int32)
+            self._indices = indices
+        return self._indices
+
+    def count(self):
+        """ Returns the number of selected (unmasked) values. """
+        return len(self.indices())
+
+def _as_mask(array):
+    """ Makes a Mask of a bool array without copying it. """
+    return np.asarray(array, dtype=bool).view(Mask)
 
 class IsotopeData(object):
     """ Create an IsotopeData file for an isotope with given name, and data.
+
+    Trims, rolls and deadtime correction are recorded when they are requested \
+    and applied together, in a single pass over the data, the next time the \
+    data is needed.
     
     :param isotope_label: Name of the isotope.
     :type isotope_label: string
 
     :param isotope_data: The data for the given isotope.
     :type isotope_data: 3D `numpy` array
+
+    :param lazy: If True, isotope_data (e.g. a memory-mapped array) is only \
+                 read and converted the first time the data is needed.
+    :type lazy: bool
+
+    :param dtype: dtype the data is stored in until it is deadtime corrected \
+                  (default float64). "compact" keeps integer counts in the \
+                  smallest integer dtype that holds them, lazily loaded data \
+                  keeps the integer dtype of the file.
+    :type dtype: `numpy` dtype or "compact"
+
+    :param corrected_dtype: dtype of deadtime corrected data (default \
+                            float64), e.g. float32 to halve its memory. Sums \
+                            are always accumulated in float64.
+    :type corrected_dtype: `numpy` dtype
     """
 
-    def __init__(self, isotope_label, isotope_data):
+    # Name of the values, e.g. for colour bars
+    _value_label = "Counts"
+
+    # Counts are summed when they are binned
+    _bin_reduction = "sum"
+
+    # Executor running blocks of cycles concurrently, set by the Importer
+    # holding the isotope, None to run them serially
+    _executor = None
+
+    # True once the stored data has been handed out, e.g. by get_data, after
+    # which corrections are applied to a copy instead of in place
+    _exported = False
+
+    def __init__(self, isotope_label, isotope_data, lazy=False, dtype=float,
+                 corrected_dtype=float):
         self._label = isotope_label
-        self._data = np.array(isotope_data, dtype=float)
+        self._dtype = dtype
+        self._corrected_dtype = np.dtype(corrected_dtype)
         self._is_deadtime_corrected = False
+        if lazy:
+            self._source = isotope_data
+            self._owns_source = False
+            self._cube = None
+        elif dtype == "compact":
+            self._data = np.array(isotope_data,
+                                  dtype=_compact_dtype(isotope_data))
+        else:
+            self._data = np.array(isotope_data, dtype=dtype)
+        self._pending_roll = (0, 0)
+        self._pending_deadtime = False
+        self._virtual_roll = (0, 0)
+        self._changed()
+
+    @property
+    def _data(self):
+        # Apply pending corrections on first access
+        if self._cube is None:
+            source = self._source
+            self._cube = self._apply_pending()
+            # A new array has not been handed out yet
+            self._exported = self._exported and self._cube is source
+            self._source = None
+            self._owns_source = False
+            self._pending_roll = (0, 0)
+            self._pending_deadtime = False
+        return self._cube
+
+    @_data.setter
+    def _data(self, value):
+        self._changed()
+        self._cube = value
+        self._source = None
+        self._owns_source = False
+        self._pending_roll = (0, 0)
+        self._pending_deadtime = False
+        self._exported = False
+
+    def _defer(self):
+        """ Makes the current data the source for the next pending corrections. """
+        self._changed()
+        if self._cube is not None:
+            self._source = self._cube
+            self._owns_source = True
+            self._cube = None
+
+    def _changed(self):
+        """ Drops memoized reductions and binned data, called whenever the \
+        data changes. """
+        self._reductions = {}
+        self._binned = {}
+
+    def _reduce(self, mask, reduction):
+        """ Returns the memoized sum, mean or std of the values selected by a \
+        Mask. """
+        if np.shape(mask) != self._shape():
+            raise RuntimeError("Mask shape " + str(np.shape(mask)) +
+                               " does not match data shape " +
+                               str(self._shape()))
+        reference, version, results = self._reductions.get(
+            id(mask), (None, None, None))
+        if (reference is None or reference() is not mask or
+                version != mask._version):
+            # Forget masks that no longer exist
+            self._reductions = {key: entry for key, entry in
+                                self._reductions.items()
+                                if entry[0]() is not None}
+            results = {}
+            self._reductions[id(mask)] = (weakref.ref(mask), mask._version,
+                                          results)
+
+        if "moments" not in results:
+            if self._virtual_roll != (0, 0):
+                mask = _as_mask(self._unview(mask))
+            results["moments"] = self._moments(mask)
+        total, mean, variance = results["moments"]
+        if reduction == "sum":
+            return total
+        elif reduction == "mean":
+            return mean
+        return np.sqrt(variance)
+
+    def _moments(self, mask):
+        """ Returns the sum, mean and variance of the values selected by a \
+        Mask of the stored data. """
+        sums, means, variances = _masked_moments([self._data.reshape(-1)],
+                                                 mask.indices(), self._executor)
+        return sums[0], means[0], variances[0]
+
+    def _target_dtype(self, source):
+        """ dtype of the data once pending corrections are applied. """
+        if self._is_deadtime_corrected:
+            return self._corrected_dtype
+        if self._dtype == "compact":
+            if source.dtype.kind in "ui":
+                return source.dtype.newbyteorder("=")
+            return np.dtype(float)
+        return np.dtype(self._dtype)
+
+    def _apply_pending(self):
+        """ Returns the source with the pending roll and deadtime correction \
+        applied, block by block in one pass. Data owned by this object is \
+        corrected in place when its dtype does not change, unless it has been \
+        handed out, e.g. by :meth:`get_data`, so that arrays returned earlier \
+        keep their values. Other sources are converted while they are \
+        copied. """
+        source = np.asarray(self._source)
+        x_roll, y_roll = self._pending_roll
+        rolled = _is_rolled(source, x_roll, y_roll)
+        dtype = self._target_dtype(source)
+        # A ratio source computes a new array that can be corrected in place
+        owned = self._owns_source or isinstance(self._source, _RatioSource)
+        if owned and source.dtype == dtype:
+            if not rolled and not self._pending_deadtime:
+                return source
+        # Read only data, e.g. in shared memory, is copied when corrected
+        if (owned and source.dtype == dtype and source.flags.writeable and
+                not self._exported):
+            out = source
+        else:
+            out = np.empty(np.shape(source), dtype=dtype)
+
+        def correct(blocks):
+            block, source_block = blocks
+            if out is source:
+                if rolled:
+                    scratch = _scratch_buffer("roll", block.shape, block.dtype)
+                    scratch[...] = block
+                    _roll_into(scratch, block, x_roll, y_roll)
+            else:
+                _roll_into(source_block, block, x_roll, y_roll)
+            if self._pending_deadtime:
+                _deadtime_correct_inplace(block, self._dwell_time,
+                                          self._dead_time)
+        _parallel_map(self._executor, correct,
+                      zip(_cycle_blocks(out), _cycle_blocks(source)))
+        return out
+
+    def _view(self, array):
+        """ Applies the virtual roll to an array shaped like the stored data. """
+        return _rolled(array, *self._virtual_roll)
+
+    def _unview(self, mask):
+        """ Undoes the virtual roll on a mask, giving a mask that can be used \
+        with the stored data. """
+        if not isinstance(mask, np.ndarray):
+            return mask
+        return _rolled(mask, -self._virtual_roll[0], -self._virtual_roll[1])
+
+    def _shape(self):
+        """ Shape of the data, without applying pending corrections. """
+        if self._cube is None:
+            return np.shape(self._source)
+        return np.shape(self._cube)
 
     def get_label(self):
         return self._label
 
+    def is_loaded(self):
+        """ Returns True if the data has been read into memory. """
+        return self._cube is not None or self._owns_source
+
     def __leq__(self, value):
-        return self._data <= value
+        return self._view(self._data <= value)
     
     def __lt__(self, value):
-        return self._data < value
+        return self._view(self._data < value)
 
     def __gt__(self, value):
-        return self._data > value
+        return self._view(self._data > value)
 
     def get_data(self, mask=None):
         """ Return the isotope's data. Optionally include a mask to return a \
@@ -52,10 +776,16 @@ class IsotopeData(object):
         :param mask: mask to apply to the data.
         :type mask: numpy bool array.
         """
-        if type(mask) is np.ndarray:
-            return ma.array(self._data, mask = mask)
+        data = self._data
+        # The caller may keep the data, later corrections must not change it
+        self._exported = True
+        if isinstance(mask, Mask):
+            # Copy, so that changes to the masked array leave the Mask alone
+            return ma.array(self._view(data), mask = np.array(mask))
+        elif isinstance(mask, np.ndarray):
+            return ma.array(self._view(data), mask = mask)
         else:
-            return self._data
+            return self._view(data)
 
     def get_mask(self, lower=0, upper=np.Inf):
         """Return a mask that will mask all data outside of the bounds given. \
@@ -70,10 +800,19 @@ class IsotopeData(object):
         :type upper: float
         
         """
-        return np.logical_or(self._data <= lower, self._data > upper)
+        data = self._data
+        mask = np.empty(np.shape(data), dtype=bool)
+
+        def compare(blocks):
+            block, mask_block = blocks
+            np.less_equal(block, lower, out=mask_block)
+            mask_block |= block > upper
+        _parallel_map(self._executor, compare,
+                      zip(_cycle_blocks(data), _cycle_blocks(mask)))
+        return _as_mask(self._view(mask))
 
     def n_cycles(self):
-        return np.shape(self._data)[0]
+        return self._shape()[0]
     
     def n_pixels(self, mask = None):
         """Returns the total number of pixels in the dataset. Optionally masked \
@@ -82,10 +821,12 @@ class IsotopeData(object):
         :param mask: mask to apply to the data.
         :type mask: numpy bool array
         """
-        if type(mask) == np.ndarray:
+        if isinstance(mask, Mask):
+            return mask.count()
+        elif isinstance(mask, np.ndarray):
             return ma.array(self._data, mask = mask).count()
         else:
-            return self._data.size
+            return int(np.prod(self._shape()))
     
     def perform_deadtime_correction(self, dwell_time, dead_time):
         r""" Perform deadtime correction on the count data:\
@@ -107,6 +848,12 @@ class IsotopeData(object):
         :param dead_time: Dead time.
         :type dead_time: float
         """
+        self._record_deadtime_correction(dwell_time, dead_time)
+        self._defer()
+        self._pending_deadtime = True
+
+    def _record_deadtime_correction(self, dwell_time, dead_time):
+        """ Checks and records a deadtime correction, without applying it. """
         # Prevent applying deadtime correction twice
         if self._is_deadtime_corrected:
             raise RuntimeError("Error: Isotope " + self._label +
@@ -117,12 +864,6 @@ class IsotopeData(object):
 
         self._dwell_time = dwell_time
         self._dead_time = dead_time
-        
-        # Perform deadtime correction
-        count_rate = np.divide(self._data, dwell_time)
-        self._data = np.divide(count_rate,
-                               1 - np.multiply(count_rate, dead_time))
-        self._data *= dwell_time
         self._is_deadtime_corrected = True
 
     def plot(self, mask=None):
@@ -131,14 +872,17 @@ class IsotopeData(object):
         :param mask: Mask to be used.
         :type mask: numpy bool array
         """
+        import matplotlib.pyplot as plt
+        # Registers the 3d projection
+        from mpl_toolkits.mplot3d import Axes3D
 
         # Get plot data
-        if type(mask) is np.ndarray:
-            plot_data = ma.masked_array(self._data, mask = mask)
+        if isinstance(mask, np.ndarray):
+            plot_data = self.get_data(mask)
             vmin = ma.min(plot_data)
             vmax = ma.max(plot_data)
         else:
-            plot_data = self._data
+            plot_data = self.get_data()
             vmin = np.min(plot_data)
             vmax = np.max(plot_data)
             
@@ -175,17 +919,104 @@ class IsotopeData(object):
         
         plt.show()
 
+    def binned(self, n=1, k=1):
+        """ Returns the data summed over blocks of n by n pixels and k \
+        cycles, as a new IsotopeData object with the same label and \
+        corrections. Pixels and cycles left over at the ends are dropped. \
+        Binned data is cached until the data changes, so each binning is \
+        only computed once. Ratios of binned isotopes are ratios of summed \
+        counts, more meaningful for low count isotopes than binned ratios. \
+        The dwell time of summed counts is the total over each bin, as used \
+        by :meth:`RatioData.perform_qsa_correction`.
+
+        :param n: number of pixels to bin in x and y (default 1).
+        :type n: int
+
+        :param k: number of cycles to bin (default 1).
+        :type k: int
+        """
+        n, k = int(n), int(k)
+        if n < 1 or k < 1:
+            raise RuntimeError("Bin sizes must be at least 1")
+        if (n, k) == (1, 1):
+            return self
+        if (n, k) not in self._binned:
+            data = _bin(self.get_data(), n, k, self._bin_reduction)
+            # Same class as this dataset, a ratio stays a ratio
+            binned = object.__new__(type(self))
+            IsotopeData.__init__(binned, self._label, data, dtype=data.dtype,
+                                 corrected_dtype=self._corrected_dtype)
+            for name in ["_is_deadtime_corrected", "_dwell_time",
+                         "_dead_time", "_isotope_labels", "_is_qsa_corrected"]:
+                if hasattr(self, name):
+                    setattr(binned, name, getattr(self, name))
+            # Summed counts are counted over n*n*k times the dwell time
+            if (self._bin_reduction == "sum" and
+                    getattr(self, "_dwell_time", None) is not None):
+                binned._dwell_time = self._dwell_time*n*n*k
+            self._binned[(n, k)] = binned
+        return self._binned[(n, k)]
+
+    def pyramid(self, levels=4, k=1):
+        """ Returns a multi-resolution pyramid of the data: a list of levels, \
+        level i binned over 2**i by 2**i pixels, see :meth:`binned`. Each \
+        level is binned from the one before it, and cached.
+
+        :param levels: number of levels, the first is this dataset.
+        :type levels: int
+
+        :param k: number of cycles binned in every level but the first.
+        :type k: int
+        """
+        pyramid = [self]
+        if levels > 1:
+            pyramid.append(self.binned(2, k))
+        while len(pyramid) < levels:
+            pyramid.append(pyramid[-1].binned(2))
+        return pyramid
+
+    def render(self, filename, view="montage", mask=None, downsample=1,
+               columns=None, dpi=100):
+        """ Renders the data to an image file, e.g. a PNG, without a display, \
+        as orthogonal slices, summed projections or a montage of every \
+        cycle. Much faster than :meth:`plot` for many cycles, and can be \
+        used in batch runs. See :func:`~nanosims_analysis.rendering.render`.
+
+        :param filename: image file to write, its extension sets the format.
+        :type filename: string
+
+        :param view: "slices", "projection" or "montage" (default).
+        :type view: string
+
+        :param mask: masked values are left out.
+        :type mask: numpy bool array
+
+        :param downsample: average each downsample by downsample pixels \
+                           before rendering (default 1).
+        :type downsample: int
+
+        :param columns: number of columns of the montage.
+        :type columns: int
+
+        :param dpi: resolution of the image file.
+        :type dpi: int
+        """
+        rendering.render(self.get_data(), filename, view=view, mask=mask,
+                         downsample=downsample, label=self._value_label,
+                         title=self._label, columns=columns, dpi=dpi)
+
     def trim_back(self, n):
         """ Removes the last n cycles from the dataset
 
         :param n: number of cycles to remove.
         :type n: int
         """
-        z_max = np.shape(self._data)[0]
+        z_max = self.n_cycles()
         if n > z_max:
             raise RuntimeError("trim amount: " + str(n) +
                                " exceeds number of cycles: " + str(z_max))
-        self._data = self._data[:z_max-n]
+        self._defer()
+        self._source = self._source[:z_max-n]
         
     def trim_front(self, n):
         """ Removes the first n cycles from the dataset
@@ -193,13 +1024,14 @@ class IsotopeData(object):
         :param n: number of cycles to remove.
         :type n: int
         """
-        z_max = np.shape(self._data)[0]
+        z_max = self.n_cycles()
         if n > z_max:
             raise RuntimeError("trim amount: " + str(n) +
                                " exceeds number of cycles: " + str(z_max))
-        self._data = self._data[n:]       
+        self._defer()
+        self._source = self._source[n:]
 
-    def roll_data(self, x_roll=0, y_roll=0):
+    def roll_data(self, x_roll=0, y_roll=0, virtual=False):
         """ Rolls the data in the dataset: moves a given number of rows of data
             in the specified direction from the end of the dataset to the front,
             or vice-versa. For example, setting x_roll=1 will move one row from
@@ -211,47 +1043,288 @@ class IsotopeData(object):
 
         :param y_roll: amount to roll in the y-direction
         :type y_roll: int
+
+        :param virtual: If True, the stored data is not changed, the roll is \
+                        applied whenever data or masks are returned or \
+                        exported. Sums and pixel counts then need no copy of \
+                        the data.
+        :type virtual: bool
         """        
-        for i, cycle in enumerate(self._data):
-            self._data[i] = np.roll(cycle, [x_roll, y_roll], axis = [0, 1])
+        if virtual:
+            self._changed()
+            self._virtual_roll = (self._virtual_roll[0] + x_roll,
+                                  self._virtual_roll[1] + y_roll)
+            return
+        self._defer()
+        self._pending_roll = (self._pending_roll[0] + x_roll,
+                              self._pending_roll[1] + y_roll)
         
+    def estimate_drift(self, reference_cycle=0, upsample=20):
+        """ Estimates the drift of each cycle relative to a reference cycle, \
+        including sub-pixel drift, by FFT cross-correlation, see \
+        :func:`~nanosims_analysis.registration.estimate_drift`.
+
+        :param reference_cycle: cycle the others are aligned to (default 0).
+        :type reference_cycle: int
+
+        :param upsample: the shifts are found to 1/upsample of a pixel \
+                         (default 20), 1 gives whole pixel shifts.
+        :type upsample: int
+
+        :returns: x and y shifts of each cycle, for :meth:`correct_drift`.
+        :rtype: float `numpy` array, shaped (cycle, 2)
+        """
+        return registration.estimate_drift(self._data, reference_cycle,
+                                           upsample)
+
+    def correct_drift(self, shifts):
+        """ Shifts each cycle of the data, e.g. by the shifts of \
+        :meth:`estimate_drift`. Whole pixel shifts roll each cycle as \
+        :meth:`roll_data` does, sub-pixel shifts interpolate the data in \
+        Fourier space, converting integer data to floats.
+
+        :param shifts: x and y shifts of each cycle.
+        :type shifts: `numpy` array, shaped (cycle, 2)
+        """
+        registration.shift_cycles([self._drift_target(shifts)], shifts)
+        self._changed()
+
+    def _drift_target(self, shifts):
+        """ Returns the stored data, made writable and float for sub-pixel \
+        shifts, for shifting in place. Data that has been handed out is \
+        copied first. """
+        data = self._data
+        subpixel = not np.array_equal(shifts, np.round(shifts))
+        if subpixel and data.dtype.kind != "f":
+            self._data = np.array(data, dtype=self._corrected_dtype)
+        elif not data.flags.writeable or self._exported:
+            self._data = np.array(data)
+        return self._data
+
     def sum(self, mask=None):
         """ Returns the sum of all the data in the dataset, with optional masking.
 
         :param mask: numpy mask array.
         :type mask: numpy array, optional)
         """
-        masked_array = np.ma.array(self._data, mask=mask)
-        return masked_array.sum()
+        if isinstance(mask, Mask):
+            return self._reduce(mask, "sum")
+        masked_array = np.ma.array(self._data, mask=self._unview(mask))
+        return masked_array.sum(dtype=np.float64)
 
-    def to_VTK(self, filename, x_roll=0, y_roll=0, mask=None): #pragma: no cover
+    def mean(self, mask=None):
+        """ Returns the mean of the data in the dataset, with optional masking.
 
-        to_output = np.ma.array(self._data, mask=mask, fill_value=-1).filled()
-        
-        output_data = np.zeros_like(self._data)
+        :param mask: numpy mask array.
+        :type mask: numpy array, optional)
+        """
+        if isinstance(mask, Mask):
+            return self._reduce(mask, "mean")
+        masked_array = np.ma.array(self._data, mask=self._unview(mask))
+        return masked_array.mean(dtype=np.float64)
 
-        for i, cycle in enumerate(to_output):
-            output_data[i] = np.roll(cycle, [x_roll,y_roll], axis=[0,1])
-        output_data = np.swapaxes(output_data, 0, 2)
-        
-        (nx, ny, nz) = np.shape(output_data)
+    def std(self, mask=None):
+        """ Returns the standard deviation of the data in the dataset, with \
+        optional masking.
+
+        :param mask: numpy mask array.
+        :type mask: numpy array, optional)
+        """
+        if isinstance(mask, Mask):
+            return self._reduce(mask, "std")
+        masked_array = np.ma.array(self._data, mask=self._unview(mask))
+        return masked_array.std(dtype=np.float64)
 
-        # Coordinates 
-        X = np.arange(0, nx + 1, 1, dtype='float64') 
-        Y = np.arange(0, ny + 1, 1, dtype='float64') 
-        Z = np.arange(0, nz + 1, 1, dtype='float64') 
+    def region_statistics(self, labels):
+        """ Returns the number of values, sum and mean of the data in each \
+        region of a label image, found with one `np.bincount` pass over the \
+        data rather than one masked sum per region.
+
+        :param labels: label image, with the region of each value, either \
+                       user supplied or from :func:`label_regions`. A 2D \
+                       image (x, y) applies to every cycle, a 3D image has \
+                       the shape of the data.
+        :type labels: numpy integer array
+
+        :returns: dictionary with keys "pixels", "sum" and "mean", each an \
+                  array indexed by region label, entry 0 holding the \
+                  unlabeled values.
+        :rtype: dict
+        """
+        labels, n_labels = _check_region_labels(labels, self._shape())
+        labels = self._unview(labels)
+        counts = _region_counts(labels, n_labels, self._shape()[0])
+        sums = _region_sums(self._stored_blocks(), labels, n_labels)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = sums / counts
+        return {"pixels": counts, "sum": sums, "mean": means}
+
+    def _stored_blocks(self):
+        """ Yields the index of the first cycle and the stored data of blocks \
+        of cycles holding about BLOCK_SIZE values each. """
+        return _blocks_of(self._data)
+
+    def _stored_cycles(self, first, last):
+        """ Returns the stored data of cycles first to last. """
+        return self._data[first:last]
+
+    def _stored_dtype(self):
+        return self._data.dtype
+
+    def _vtk_field(self, x_roll=0, y_roll=0, mask=None):
+        """ Returns the field of this dataset for :func:`_write_vtk`, rolled \
+        and with masked values set to -1, a block of cycles at a time. """
+        data_roll = (x_roll + self._virtual_roll[0],
+                     y_roll + self._virtual_roll[1])
+        blocks = lambda: _vtk_blocks(self._stored_blocks(), data_roll, mask,
+                                     (x_roll, y_roll))
+        return self._label, _vtk_dtype(self._stored_dtype(), mask), blocks
+
+    def to_VTK(self, filename, x_roll=0, y_roll=0, mask=None, pieces=1,
+               processes=None):
+        """ Writes the data to a VTK rectilinear grid file, with the cycles \
+        along z, e.g. for ParaView.
+
+        :param filename: file to write, without extension.
+        :type filename: string
+
+        :param x_roll: amount to roll the output in the x-direction.
+        :type x_roll: int
+
+        :param y_roll: amount to roll the output in the y-direction.
+        :type y_roll: int
+
+        :param mask: masked values are written as -1.
+        :type mask: numpy bool array
+
+        :param pieces: If more than 1, the cycles are split into this many \
+                       pieces, written at the same time by worker processes \
+                       to files named filename_0.vtr, filename_1.vtr, ..., \
+                       and a parallel VTK file, filename.pvtr, that ParaView \
+                       opens as one grid.
+        :type pieces: int
+
+        :param processes: number of worker processes writing pieces \
+                          (default the number of CPUs). The workers import \
+                          the main module, so scripts writing pieces must \
+                          guard their code with \
+                          ``if __name__ == "__main__":``.
+        :type processes: int
+
+        :returns: name of the file written, the .pvtr file for pieces.
+        """
+        if pieces > 1:
+            return _write_partitioned_vtk(filename, [self], x_roll, y_roll,
+                                          mask, pieces, processes)
+        return _write_vtk(filename, [self._vtk_field(x_roll, y_roll, mask)],
+                          self._shape())
+
+    def share(self):
+        """ Moves the data, with any pending corrections applied, into \
+        shared memory, and returns a handle to it that can be sent to other \
+        processes, e.g. the workers of a \
+        `concurrent.futures.ProcessPoolExecutor`, much faster than the data \
+        itself. :meth:`~nanosims_analysis.shared.SharedIsotope.attach` then \
+        gives the isotope in the worker without copying its data.
+
+        Changes made to the data in place by this process are seen by the \
+        workers, corrections made later are not recorded in the handle. The \
+        shared memory is freed by the handle's \
+        :meth:`~nanosims_analysis.shared.SharedIsotope.release`, or when \
+        this process exits.
+
+        :returns: handle of the shared isotope.
+        :rtype: :class:`~nanosims_analysis.shared.SharedIsotope`
+        """
+        data = self._data
+        array = shared.SharedArray.create(np.shape(data), data.dtype)
+        shared_data = array.array()
+        shared_data[...] = data
+        self._data = shared_data
+        return shared.SharedIsotope(self, array)
 
-        gridToVTK(filename, X, Y, Z, cellData = {self._label : output_data})
-            
-    
     def __str__(self):
         return_string = "label: " + self._label + "; "
-        return_string += "\tData size: " + str(np.shape(self._data))
+        return_string += "\tData size: " + str(self._shape())
+        if self._cube is not None:
+            return_string += "; dtype: " + str(self._cube.dtype)
         return_string += "\n\t Corrections: "
         if self._is_deadtime_corrected:
             return_string += "deadtime"
         return return_string
 
+class _RatioSource(object):
+    """ Ratio of two isotopes, see :class:`RatioData`, computed block of \
+    cycles by block of cycles when it is read. Slicing along the cycles gives \
+    a new source without computing anything. Computed blocks are kept in a \
+    least recently used cache of at most cache_size bytes, shared with the \
+    slices of the source. """
+    def __init__(self, numerator_isotope, denominator_isotope, dtype,
+                 cache_size=0):
+        # Keep the data as it is now, as an eager ratio would: the data is
+        # marked as handed out, so later corrections of the isotopes are
+        # applied to copies of it
+        self._numerator = (numerator_isotope._data,
+                           numerator_isotope._virtual_roll)
+        self._denominator = (denominator_isotope._data,
+                             denominator_isotope._virtual_roll)
+        numerator_isotope._exported = True
+        denominator_isotope._exported = True
+        if np.shape(self._numerator[0]) != np.shape(self._denominator[0]):
+            raise RuntimeError("Numerator and denominator shapes differ")
+        self.dtype = np.dtype(dtype)
+        self._cycles = range(np.shape(self._numerator[0])[0])
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+
+    @property
+    def shape(self):
+        return (len(self._cycles),) + np.shape(self._numerator[0])[1:]
+
+    def __len__(self):
+        return len(self._cycles)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise RuntimeError("Ratio sources can only be sliced along cycles")
+        source = copy.copy(self)
+        source._cycles = self._cycles[key]
+        return source
+
+    def _ratio(self, start, stop):
+        """ Returns the ratio of the cycles start to stop of the isotopes. """
+        key = (start, stop)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        numerator = _rolled(self._numerator[0][start:stop], *self._numerator[1])
+        denominator = _rolled(self._denominator[0][start:stop],
+                              *self._denominator[1])
+        ratio = np.divide(numerator, denominator,
+                          out=np.zeros(np.shape(denominator), dtype=self.dtype),
+                          where=denominator!=0)
+        if ratio.nbytes <= self._cache_size:
+            self._cache[key] = ratio
+            while sum(block.nbytes for block in self._cache.values()) > \
+                  self._cache_size:
+                self._cache.popitem(last=False)
+        return ratio
+
+    def blocks(self):
+        """ Yields the index of the first cycle and the ratio of blocks of \
+        cycles holding about BLOCK_SIZE values each. """
+        n_cycles, nx, ny = self.shape
+        n = max(1, BLOCK_SIZE // max(1, nx*ny))
+        for start in range(0, n_cycles, n):
+            cycles = self._cycles[start:start + n]
+            yield start, self._ratio(cycles.start, cycles.stop)
+
+    def __array__(self, dtype=None, copy=None):
+        out = np.empty(self.shape, dtype=self.dtype)
+        for start, block in self.blocks():
+            out[start:start + len(block)] = block
+        return out if dtype is None else out.astype(dtype)
+
 class RatioData(IsotopeData):
     r""" Create a datafile containing the ratios of two isotope data sets.\
 
@@ -263,17 +1336,327 @@ class RatioData(IsotopeData):
     
     where :math:`I_n` is the numerator isotope, and :math:`I_d` is the \
     denominator isotope.
+
+    :param dtype: dtype of the ratio data (default float64).
+    :type dtype: `numpy` dtype
+
+    :param lazy: If True, the ratio is not stored. Sums, means, standard \
+                 deviations and delta values are computed from the isotopes \
+                 a block of cycles at a time, the full ratio is only \
+                 computed and stored when the data itself is needed, e.g. by \
+                 :meth:`get_data` or :meth:`to_VTK`.
+    :type lazy: bool
+
+    :param cache_size: For a lazy ratio, the number of bytes of computed \
+                       blocks kept for later reductions (default 0, no \
+                       blocks are kept).
+    :type cache_size: int
     """
     
-    def __init__(self, label, numerator_isotope, denominator_isotope):
+    _value_label = "Ratio"
+
+    # Ratios are averaged when they are binned
+    _bin_reduction = "mean"
+
+    # Labels of the numerator and denominator isotopes, if known
+    _isotope_labels = None
+
+    _is_qsa_corrected = False
+
+    def __init__(self, label, numerator_isotope, denominator_isotope,
+                 dtype=float, lazy=False, cache_size=0):
         self._label = label
+        self._dtype = dtype
+        self._corrected_dtype = np.dtype(dtype)
+        self._virtual_roll = (0, 0)
+        self._changed()
+        self._is_deadtime_corrected = False
+        self._isotope_labels = (numerator_isotope.get_label(),
+                                denominator_isotope.get_label())
+        self._executor = numerator_isotope._executor
+        if lazy:
+            self._source = _RatioSource(numerator_isotope, denominator_isotope,
+                                        dtype, cache_size)
+            self._owns_source = False
+            self._cube = None
+            self._pending_roll = (0, 0)
+            self._pending_deadtime = False
+            return
         numerator_data = numerator_isotope.get_data()
         denominator_data = denominator_isotope.get_data()
         self._data = np.divide(numerator_data, denominator_data,
-                               out=np.zeros_like(denominator_data),
+                               out=np.zeros(np.shape(denominator_data),
+                                            dtype=dtype),
                                where=denominator_data!=0)
     
     def perform_deadtime_correction(self, dwell_time, dead_time):
         """ Should not be run on RatioData, returns a Runtimeerror, perform\
         deadtime correction prior to calculating the ratio"""
         raise RuntimeError("Deadtime correction cannot be performed on a ratio")
+
+    def perform_qsa_correction(self, denominator_isotope, primary_current,
+                               dwell_time=None, beta=None):
+        r""" Perform the quasi-simultaneous arrival (QSA) correction of \
+        Hillion et al. (2008) on every pixel of the ratio:\
+
+        .. math:: R_{corr} = \frac{R}{1 + \beta K}, \qquad \
+                  K = \frac{n_d}{I_p T}
+
+        where :math:`n_d` is the count of the denominator isotope in the \
+        pixel, :math:`I_p` the primary current in ions per second and \
+        :math:`T` the dwell time. The correction is applied in place, a \
+        block of cycles at a time, without temporary copies of the data.
+
+        :param denominator_isotope: denominator isotope of the ratio, with \
+                                    the same shape, trims and rolls.
+        :type denominator_isotope: IsotopeData
+
+        :param primary_current: primary current in pA.
+        :type primary_current: float
+
+        :param dwell_time: dwell time in seconds, by default the dwell time \
+                           of the deadtime correction of the denominator.
+        :type dwell_time: float
+
+        :param beta: beta of the correction, by default from the table of \
+                     :func:`qsa_beta` for the isotopes of the ratio.
+        :type beta: float
+        """
+        if self._is_qsa_corrected:
+            raise RuntimeError("Error: Ratio " + self._label +
+                               " is already QSA corrected")
+        if denominator_isotope._shape() != self._shape():
+            raise RuntimeError("Denominator shape " +
+                               str(denominator_isotope._shape()) +
+                               " does not match ratio shape " +
+                               str(self._shape()))
+        if dwell_time is None:
+            dwell_time = getattr(denominator_isotope, "_dwell_time", None)
+            if dwell_time is None:
+                raise RuntimeError("Dwell time is needed for QSA correction")
+        if beta is None:
+            if self._isotope_labels is None:
+                beta = QSA_DEFAULT_BETA
+            else:
+                beta = qsa_beta(*self._isotope_labels)
+
+        print("QSA correction: ratio: " + self._label + ";\tbeta: " +
+              str(beta) + ";\tprimary current: " + str(primary_current) +
+              " pA")
+
+        # Denominator counts aligned with the stored ratio
+        if denominator_isotope._virtual_roll == self._virtual_roll:
+            denominator = denominator_isotope._data
+        else:
+            denominator = self._unview(denominator_isotope.get_data())
+        self._defer()
+        ratio = self._data
+        # Ratios handed out, e.g. by get_data, keep their values
+        if (self._exported or not ratio.flags.writeable or
+                ratio.dtype.kind != "f"):
+            ratio = np.array(ratio, dtype=float)
+        _qsa_correct_inplace(ratio, denominator,
+                             primary_current*IONS_PER_PICOAMPERE*dwell_time,
+                             beta)
+        self._data = ratio
+        self._is_qsa_corrected = True
+
+    def _is_streamed(self):
+        """ Returns True if reductions are computed from the isotopes. """
+        return self._cube is None and isinstance(self._source, _RatioSource)
+
+    def _moments(self, mask):
+        if not self._is_streamed():
+            return IsotopeData._moments(self, mask)
+        # Pick the selected values of each block out of the indices of mask
+        indices = mask.indices() if mask is not None else None
+        block_moments = (0, np.zeros(1), np.zeros(1), np.zeros(1))
+        pixels = int(np.prod(self._shape()[1:]))
+        for start, block in self._source.blocks():
+            block = _rolled(block, *self._pending_roll).reshape(1, -1)
+            if indices is not None:
+                bounds = np.array([start*pixels, start*pixels + block.size],
+                                  dtype=indices.dtype)
+                first, last = np.searchsorted(indices, bounds)
+                block = block[:, indices[first:last] - start*pixels]
+            values = _scratch_buffer("moments", np.shape(block))
+            values[...] = block
+            block_moments = _combine_moments(block_moments,
+                                             _block_moments(values))
+        sums, means, variances = _finish_moments(block_moments)
+        return sums[0], means[0], variances[0]
+
+    def _stored_blocks(self):
+        if not self._is_streamed():
+            yield from IsotopeData._stored_blocks(self)
+            return
+        for start, block in self._source.blocks():
+            yield start, _rolled(block, *self._pending_roll)
+
+    def _stored_cycles(self, first, last):
+        if not self._is_streamed():
+            return IsotopeData._stored_cycles(self, first, last)
+        return _rolled(np.asarray(self._source[first:last]),
+                       *self._pending_roll)
+
+    def _stored_dtype(self):
+        if not self._is_streamed():
+            return IsotopeData._stored_dtype(self)
+        return self._source.dtype
+
+    def _streamed_reduction(self, mask, reduction):
+        """ Returns a reduction of a lazy ratio, without storing the ratio. """
+        if mask is None:
+            total, mean, variance = self._moments(None)
+            return {"sum": total, "mean": mean, "std": np.sqrt(variance)}[
+                reduction]
+        if not isinstance(mask, Mask):
+            mask = Mask(mask)
+        return self._reduce(mask, reduction)
+
+    def sum(self, mask=None):
+        if self._is_streamed():
+            return self._streamed_reduction(mask, "sum")
+        return IsotopeData.sum(self, mask)
+    sum.__doc__ = IsotopeData.sum.__doc__
+
+    def mean(self, mask=None):
+        if self._is_streamed():
+            return self._streamed_reduction(mask, "mean")
+        return IsotopeData.mean(self, mask)
+    mean.__doc__ = IsotopeData.mean.__doc__
+
+    def std(self, mask=None):
+        if self._is_streamed():
+            return self._streamed_reduction(mask, "std")
+        return IsotopeData.std(self, mask)
+    std.__doc__ = IsotopeData.std.__doc__
+
+    def delta_statistics(self, standard_ratio, mask=None):
+        r""" Returns the mean and standard deviation of the delta values of \
+        the ratio, in permil:\
+
+        .. math:: \delta = \left(\frac{R}{R_{std}} - 1\right) \times 1000
+
+        :param standard_ratio: ratio of the standard, :math:`R_{std}`.
+        :type standard_ratio: float
+
+        :param mask: numpy mask array.
+        :type mask: numpy array, optional)
+
+        :returns: dictionary with keys "mean" and "std".
+        :rtype: dict
+        """
+        return {"mean": (self.mean(mask)/standard_ratio - 1)*1000,
+                "std": self.std(mask)/standard_ratio*1000}
+
+def corrected_ratio(label, numerator_isotope, denominator_isotope,
+                    dwell_time=None, dead_time=None, primary_current=None,
+                    beta=None, standard_ratio=None, dtype=float):
+    r""" Computes a corrected ratio, or delta values, from the raw counts of \
+    two isotopes in a single pass over blocks of cycles. Each block of counts \
+    is deadtime corrected, divided, QSA corrected and converted to delta \
+    values while it is in cache, without correcting the isotopes themselves \
+    or storing intermediate cubes. The result is identical to:
+
+    .. code-block:: python
+
+       numerator_isotope.perform_deadtime_correction(dwell_time, dead_time)
+       denominator_isotope.perform_deadtime_correction(dwell_time, dead_time)
+       ratio = RatioData(label, numerator_isotope, denominator_isotope, dtype)
+       ratio.perform_qsa_correction(denominator_isotope, primary_current,
+                                    dwell_time, beta)
+       delta = (ratio.get_data()/standard_ratio - 1)*1000
+
+    :param label: label of the ratio.
+    :type label: string
+
+    :param numerator_isotope: numerator isotope.
+    :type numerator_isotope: IsotopeData
+
+    :param denominator_isotope: denominator isotope, with the same shape.
+    :type denominator_isotope: IsotopeData
+
+    :param dwell_time: dwell time, for the deadtime and QSA corrections.
+    :type dwell_time: float
+
+    :param dead_time: dead time, in the units of the dwell time. If None \
+                      (default), the counts are not deadtime corrected.
+    :type dead_time: float
+
+    :param primary_current: primary current in pA. If None (default), the \
+                            ratio is not QSA corrected.
+    :type primary_current: float
+
+    :param beta: beta of the QSA correction, by default from \
+                 :func:`qsa_beta`.
+    :type beta: float
+
+    :param standard_ratio: if given, the delta values of the ratio relative \
+                           to this standard ratio are returned, in permil.
+    :type standard_ratio: float
+
+    :param dtype: dtype of the result (default float64).
+    :type dtype: `numpy` dtype
+
+    :returns: the corrected ratio, or delta values.
+    :rtype: RatioData
+    """
+    isotopes = (numerator_isotope, denominator_isotope)
+    if numerator_isotope._shape() != denominator_isotope._shape():
+        raise RuntimeError("Numerator and denominator shapes differ")
+    if dead_time is not None or primary_current is not None:
+        if dwell_time is None:
+            raise RuntimeError("Dwell time is needed for corrections")
+    if dead_time is not None:
+        for isotope in isotopes:
+            if isotope._is_deadtime_corrected:
+                raise RuntimeError("Error: Isotope " + isotope.get_label() +
+                                   " is already deadtime corrected")
+    if primary_current is not None:
+        if beta is None:
+            beta = qsa_beta(numerator_isotope.get_label(),
+                            denominator_isotope.get_label())
+        primary_ions = primary_current*IONS_PER_PICOAMPERE*dwell_time
+
+    sources = [(isotope._data, isotope._virtual_roll) for isotope in isotopes]
+    out = np.empty(numerator_isotope._shape(), dtype=dtype)
+    n_cycles, nx, ny = np.shape(out)
+    n = max(1, BLOCK_SIZE // max(1, nx*ny))
+    for start in range(0, n_cycles, n):
+        block = out[start:start + n]
+        # Counts of the block, as the isotopes would store them
+        counts = []
+        for name, isotope, (data, roll) in zip(("numerator", "denominator"),
+                                               isotopes, sources):
+            if dead_time is not None:
+                scratch_dtype = isotope._corrected_dtype
+            else:
+                scratch_dtype = data.dtype
+            scratch = _scratch_buffer(name, block.shape, scratch_dtype)
+            _roll_into(data[start:start + len(block)], scratch, *roll)
+            if dead_time is not None:
+                _deadtime_correct_inplace(scratch, dwell_time, dead_time)
+            counts.append(scratch)
+        numerator, denominator = counts
+
+        block[...] = 0
+        np.divide(numerator, denominator, out=block, where=denominator!=0)
+        if primary_current is not None:
+            _qsa_correct_inplace(block, denominator, primary_ions, beta)
+        if standard_ratio is not None:
+            np.divide(block, standard_ratio, out=block)
+            np.subtract(block, 1, out=block)
+            np.multiply(block, 1000, out=block)
+
+    # The result is owned by the ratio, so it is not copied
+    ratio = object.__new__(RatioData)
+    IsotopeData.__init__(ratio, label, out, lazy=True, dtype=dtype,
+                         corrected_dtype=dtype)
+    ratio._owns_source = True
+    ratio._isotope_labels = (numerator_isotope.get_label(),
+                             denominator_isotope.get_label())
+    ratio._is_qsa_corrected = primary_current is not None
+    if standard_ratio is not None:
+        ratio._value_label = "Delta (permil)"
+    return ratio
@@ -7,16 +7,287 @@
 
 """
 
-from nanosims_analysis.data_structures import IsotopeData
+from nanosims_analysis.data_structures import IsotopeData, Mask
+from nanosims_analysis.data_structures import _masked_moments
+from nanosims_analysis.data_structures import _block_moments
+from nanosims_analysis.data_structures import _combine_moments
+from nanosims_analysis.data_structures import _finish_moments
+from nanosims_analysis.data_structures import _scratch_buffer
+from nanosims_analysis.data_structures import _check_region_labels
+from nanosims_analysis.data_structures import _region_counts, _region_sums
+from nanosims_analysis.data_structures import qsa_beta, IONS_PER_PICOAMPERE
+from nanosims_analysis import data_structures, registration, shared
+from nanosims_analysis.data_structures import _write_vtk
+from nanosims_analysis.data_structures import _write_partitioned_vtk
+from nanosims_analysis.data_structures import _deadtime_correct_inplace
+from nanosims_analysis.data_structures import _roll_inplace
+from nanosims_analysis.data_structures import _parallel_map
+import concurrent.futures
+import os
+import threading
 import numpy as np
 from pathlib import Path
-import sims
+from struct import unpack, unpack_from
+
+# File types of image files that can be read by ImReader
+_IMAGE_FILE_TYPES = (27, 29, 39)
+
+# Thread pools shared by the importers, by number of workers, created when
+# they are first needed
+_shared_executors = {}
+_shared_executor_lock = threading.Lock()
+
+def _shared_executor(workers=None):
+    """ Returns the thread pool shared by the importers with this number of \
+    workers (default one per CPU), or None for a single worker. Pools are \
+    reused, so creating importers does not start threads, and isotopes that \
+    outlive their importer can still use its pool. """
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1:
+        return None
+    with _shared_executor_lock:
+        if workers not in _shared_executors:
+            _shared_executors[workers] = concurrent.futures.ThreadPoolExecutor(
+                workers, thread_name_prefix="nanosims")
+        return _shared_executors[workers]
+
+# Fields of the records returned by Importer.ratio_statistics
+RATIO_STATISTICS_DTYPE = np.dtype([("label", "U32"),
+                                   ("numerator_sum", float),
+                                   ("denominator_sum", float),
+                                   ("pixels", np.int64),
+                                   ("ratio", float),
+                                   ("ratio_sigma", float),
+                                   ("std", float),
+                                   ("standard_error", float),
+                                   ("combined_sigma", float),
+                                   ("delta", float),
+                                   ("delta_std", float),
+                                   ("delta_sigma", float),
+                                   ("delta_2sigma", float)])
+
+class ImReader(object):
+    """ Reader for NanoSIMS image (.im) files that does not need the `sims` \
+    package. Only the header is read when the object is created, image data \
+    is read on request. The header holds the same keys as a `sims` header for \
+    the information used by the analysis: "byte order", "file version", \
+    "file type", "header size", "label list", "Image" and "BFields" (holding \
+    "time per pixel" for each b field).
+
+    Only uncompressed image files (file types 27, 29 and 39) are supported.
+
+    :param filename: NanoSIMS image file to open.
+    :type filename: string
+    """
+    def __init__(self, filename):
+        self._filename = filename
+        with open(filename, "rb") as fh:
+            byte_order, version, file_type, header_size = self._peek(fh)
+            if file_type not in _IMAGE_FILE_TYPES:
+                raise RuntimeError("File type " + str(file_type) +
+                                   " is not supported by ImReader")
+            fh.seek(0)
+            hdr = fh.read(header_size)
+
+        self.header = {"byte order": byte_order,
+                       "file version": version,
+                       "file type": file_type,
+                       "header size": header_size}
+        self._read_header(hdr)
+
+    @staticmethod
+    def _peek(fh):
+        """ Returns byte order, file version, file type and header size. """
+        snip = fh.read(12)
+        if len(snip) < 12:
+            raise RuntimeError("File is too short to be a NanoSIMS file")
+        for byte_order in ("<", ">"):
+            version, file_type, header_size = unpack(byte_order + "3i", snip)
+            if 0 < file_type <= 41:
+                return byte_order, version, file_type, header_size
+        raise RuntimeError("Cannot determine byte order of file")
+
+    @classmethod
+    def is_supported(cls, filename):
+        """ Returns True if filename is an uncompressed image file that can be \
+        read by ImReader.
+
+        :param filename: NanoSIMS file.
+        :type filename: string
+        """
+        try:
+            with open(filename, "rb") as fh:
+                file_type = cls._peek(fh)[2]
+        except (OSError, RuntimeError):
+            return False
+        return file_type in _IMAGE_FILE_TYPES
+
+    def _read_header(self, hdr):
+        """ Reads the labels, b field dwell times and image header from the \
+        raw header bytes. Offsets follow the layout used by the `sims` package.
+        """
+        bo = self.header["byte order"]
+        version = self.header["file version"]
+
+        # Main header, AutoCal and SigRef
+        analysis_type = hdr[28:60].split(b"\x00")[0].decode("latin-1")
+        pos = 12 + 112 + 48 + 76 + 160
+        masses = unpack_from(bo + "i", hdr, pos)[0]
+        pos += 4 + (60 if version >= 4108 else 10)*4
+
+        # Mass table, 192 bytes per mass with the label at byte 65
+        labels = []
+        for m in range(masses):
+            trolley_index = unpack_from(bo + "i", hdr, pos)[0]
+            label = hdr[pos + 65:pos + 129].split(b"\x00")[0]
+            if trolley_index == 8:
+                labels.append("SE")
+            else:
+                labels.append(label.decode("latin-1").strip())
+            pos += 192
+        self.header["label list"] = tuple(labels)
+
+        # The NanoSIMS header follows the last of the Poly/Champs/Offset lists
+        list_pos = max(hdr.rfind(b"Poly_list\x00"),
+                       hdr.rfind(b"Champs_list\x00"),
+                       hdr.rfind(b"Offset_list\x00"))
+        if list_pos >= 0:
+            length = unpack_from(bo + "i", hdr, list_pos + 16)[0]
+            nanosims_pos = list_pos + 16 + 4 + 144*length + 4
+        elif analysis_type.lower().endswith("rti"):
+            nanosims_pos = pos + 216
+        else:
+            raise RuntimeError("No Poly_list marker found in header")
+
+        # B fields, 2648 bytes each, 3128 for file version 4108 and later
+        b_fields = unpack_from(bo + "25i", hdr, nanosims_pos)[24]
+        b_field_size = 56 + 12*(192 + 24)
+        if version >= 4108:
+            b_field_size += 12*(16 + 24)
+        pos = nanosims_pos + 604 + 948
+        self.header["BFields"] = []
+        for b in range(b_fields):
+            time_per_pixel = unpack_from(bo + "4i", hdr, pos)[3]/1e6
+            self.header["BFields"].append({"time per pixel": time_per_pixel})
+            pos += b_field_size
+
+        # Image header, last 84 bytes of the header
+        (size, image_type, width, height, bytes_per_pixel, n_masses, planes,
+         raster) = unpack_from(bo + "i 6h i", hdr, len(hdr) - 84)
+        if size != 84:
+            raise RuntimeError("Image header size is " + str(size) +
+                               ", not 84")
+        self.header["Image"] = {"width": width, "height": height,
+                                "bytes per pixel": bytes_per_pixel,
+                                "masses": n_masses, "planes": planes,
+                                "raster": raster}
+
+    def labels(self):
+        """ Returns the label of each mass in the file. """
+        return list(self.header["label list"])
+
+    def shape(self):
+        """ Returns the shape of the data for a single mass: \
+        (planes, height, width).
+        """
+        image = self.header["Image"]
+        return (image["planes"], image["height"], image["width"])
+
+    def time_per_pixel(self):
+        """ Returns the dwell time of the first b field, in seconds. """
+        return self.header["BFields"][0]["time per pixel"]
+
+    def _dtype(self):
+        if self.header["Image"]["bytes per pixel"] == 2:
+            return np.dtype(self.header["byte order"] + "u2")
+        return np.dtype(self.header["byte order"] + "u4")
+
+    def memmap(self):
+        """ Returns a read-only memory map of the image data, with shape \
+        (planes, masses, height, width).
+        """
+        image = self.header["Image"]
+        return np.memmap(self._filename, dtype=self._dtype(), mode="r",
+                         offset=self.header["header size"],
+                         shape=(image["planes"], image["masses"],
+                                image["height"], image["width"]))
+
+    def read_data(self, labels=None, start=0, stop=None):
+        """ Reads the image data for the given masses. Each plane is read \
+        straight from the file into a preallocated array per mass, masses \
+        that are not requested are skipped.
+
+        :param labels: labels of the masses to read (default all).
+        :type labels: list of strings
+
+        :param start: first plane to read (default 0).
+        :type start: int
+
+        :param stop: plane to stop reading at (default all planes).
+        :type stop: int
+
+        :returns: dictionary of (planes, height, width) count arrays by label.
+        """
+        all_labels = self.labels()
+        if labels is None:
+            labels = all_labels
+        for label in labels:
+            if label not in all_labels:
+                raise RuntimeError("Mass " + label + " not found in file")
+
+        dtype = self._dtype()
+        planes = range(self.shape()[0])[start:stop]
+        shape = (len(planes),) + self.shape()[1:]
+        data = {label: np.empty(shape, dtype=dtype) for label in labels}
+        plane_bytes = int(np.prod(self.shape()[1:]))*dtype.itemsize
+
+        with open(self._filename, "rb") as fh:
+            fh.seek(self.header["header size"] +
+                    len(all_labels)*plane_bytes*planes.start)
+            for plane in range(len(planes)):
+                for label in all_labels:
+                    if label not in data:
+                        fh.seek(plane_bytes, 1)
+                    elif fh.readinto(data[label][plane].view("u1")) < plane_bytes:
+                        raise RuntimeError("Unexpected end of file in plane " +
+                                           str(planes[plane]))
+        return data
 
 class Importer(object):
     """ Importer object for importing data from a NanoSIMS file.
+
+    :param dtype: dtype of imported, uncorrected data, see \
+                  :class:`~nanosims_analysis.data_structures.IsotopeData`.
+    :type dtype: `numpy` dtype or "compact"
+
+    :param corrected_dtype: dtype of deadtime corrected data.
+    :type corrected_dtype: `numpy` dtype
+
+    :param workers: number of threads running the work of the importer and \
+                    its isotopes: corrections, rolls, masks and reductions \
+                    run for several isotopes at once, or for blocks of \
+                    cycles of a single isotope at once. By default one per \
+                    CPU; 1 runs everything serially. Importers with the \
+                    same number of workers share one thread pool. The \
+                    `numpy` kernels release the GIL, so threads run them in \
+                    parallel.
+    :type workers: int
+
+    :param executor: executor to run the work on instead, e.g. a \
+                     `concurrent.futures.ThreadPoolExecutor` shared with \
+                     other work.
+    :type executor: `concurrent.futures.Executor`
     """
-    def __init__(self):
+    def __init__(self, dtype=float, corrected_dtype=float, workers=None,
+                 executor=None):
+        self._dtype = dtype
+        self._corrected_dtype = np.dtype(corrected_dtype)
+        if executor is None:
+            executor = _shared_executor(workers)
+        self._executor = executor
         self._isotopes = {}
+        self._stack = None
+        self._stack_views = {}
 
     def add_isotope(self, isotope_data):
         """ Directly add an IsotopeData object to the importer
@@ -24,6 +295,7 @@ class Importer(object):
         :param isotope_data: IsotopeData object to add.
         :type isotope_data: IsotopeData
         """
+        isotope_data._executor = self._executor
         self._isotopes.update({
             isotope_data.get_label() : isotope_data})
     
@@ -35,12 +307,111 @@ class Importer(object):
         """
         return self._isotopes[label]
 
-    def import_file(self, filename):
+    def stack_isotopes(self):
+        """ Copies the data of all isotopes into one contiguous array, shaped \
+        (isotope, cycle, x, y), and makes the data of each isotope a view into \
+        it. Deadtime correction, rolls and trims on the importer are then \
+        applied to the whole array at once, in place. All isotopes must have \
+        the same shape.
+
+        The store is dropped automatically if an isotope is added, or if the \
+        data of an isotope is replaced outside of the importer.
+        """
+        self._stack_into(np.empty)
+
+    def _stack_into(self, allocate):
+        """ Copies the data of all isotopes into a stack allocated by \
+        allocate(shape, dtype), and makes it the store of the isotopes. The \
+        stored data is copied, virtual rolls stay recorded on the isotopes. """
+        labels = list(self._isotopes)
+        shapes = set(self._isotopes[label]._shape() for label in labels)
+        if len(shapes) != 1:
+            raise RuntimeError("Isotopes must have the same shape to be stacked")
+
+        dtype = np.result_type(*[self._isotopes[label]._data.dtype
+                                 for label in labels])
+        stack = allocate((len(labels),) + shapes.pop(), dtype)
+        for i, label in enumerate(labels):
+            stack[i] = self._isotopes[label]._data
+        self._set_stack(labels, stack)
+
+    def share(self):
+        """ Stacks the data of all isotopes, as :meth:`stack_isotopes` does, \
+        in shared memory, and returns a handle to it that can be sent to \
+        worker processes, e.g. of a \
+        `concurrent.futures.ProcessPoolExecutor`, instead of the data. \
+        :meth:`~nanosims_analysis.shared.SharedImporter.attach` then gives an \
+        importer holding the isotopes in the worker without copying their \
+        data, so workers can compute different ratios, masks or regions of \
+        the same analysis in parallel. All isotopes must have the same shape.
+
+        Apply corrections before sharing: changes made to the data in place \
+        are seen by the workers, but the handle records the corrections of \
+        each isotope when it is created. The shared memory is freed by the \
+        handle's :meth:`~nanosims_analysis.shared.SharedImporter.release`, \
+        or when this process exits.
+
+        :returns: handle of the shared isotopes.
+        :rtype: :class:`~nanosims_analysis.shared.SharedImporter`
+        """
+        arrays = []
+        def allocate(shape, dtype):
+            arrays.append(shared.SharedArray.create(shape, dtype))
+            return arrays[-1].array()
+        self._stack_into(allocate)
+        return shared.SharedImporter(self, arrays[0])
+
+    def _set_stack(self, labels, stack):
+        """ Makes the data of each isotope in labels a view into stack. """
+        self._stack = stack
+        self._stack_views = {}
+        for i, label in enumerate(labels):
+            self._isotopes[label]._data = stack[i]
+            self._stack_views[label] = self._isotopes[label]._data
+
+    def _is_stacked(self):
+        """ Returns True if every isotope is still a view into the stacked \
+        store, otherwise drops the store. """
+        if self._stack is None:
+            return False
+        if (list(self._isotopes) == list(self._stack_views) and
+            all(self._isotopes[label]._data is view
+                for label, view in self._stack_views.items())):
+            return True
+        self._stack = None
+        self._stack_views = {}
+        return False
+
+    def _writable_stack(self):
+        """ Copies the stacked store before it is changed in place if the \
+        data of an isotope has been handed out, e.g. by get_data, so that \
+        arrays returned earlier keep their values, or if it is read only. """
+        if (not self._stack.flags.writeable or
+            any(isotope._exported for isotope in self._isotopes.values())):
+            self._set_stack(list(self._stack_views), np.array(self._stack))
+
+    def import_file(self, filename, lazy=False, reader="auto", stacked=False):
         """ Uploads and stores data from a NanoSIMS file.
         
         :param filename: Attempts to open this file to import data.
         :type filename: string
 
+        :param lazy: If True, only the header is read and the image data is \
+                     memory-mapped. Each isotope is read from the file the \
+                     first time its data is needed, isotopes that are never \
+                     used are never read. Requires an uncompressed image file.
+        :type lazy: bool
+
+        :param reader: "native" to read the file with :class:`ImReader`, \
+                       "sims" to read it with the `sims` package, or "auto" \
+                       (default) to use :class:`ImReader` when it supports \
+                       the file.
+        :type reader: string
+
+        :param stacked: If True, store all isotopes in one contiguous array, \
+                        see :meth:`stack_isotopes`.
+        :type stacked: bool
+
         """
         self._filename = filename
         
@@ -48,18 +419,204 @@ class Importer(object):
         if not Path(self._filename).is_file():
             raise RuntimeError('Bad filename')
 
-        self._sims_object = sims.SIMS(self._filename)
+        if reader == "auto":
+            if lazy or ImReader.is_supported(self._filename):
+                reader = "native"
+            else:
+                reader = "sims"
+
+        if reader == "sims":
+            if lazy:
+                raise RuntimeError("Lazy import requires the native reader")
+            # sims, with pandas and scipy, is slow to import, so it is only
+            # imported for files the native reader does not support
+            import sims
+            self._sims_object = sims.SIMS(self._filename)
+            self._header = self._sims_object.header
+            data = self._sims_object.data
+        elif reader == "native":
+            im_reader = ImReader(self._filename)
+            self._header = im_reader.header
+            if lazy:
+                # Image data is stored plane by plane, each holding all masses
+                self._memmap = im_reader.memmap()
+                data = [self._memmap[:, i]
+                        for i in range(len(self._header["label list"]))]
+            else:
+                data = im_reader.read_data()
+                data = [data[label] for label in self._header["label list"]]
+        else:
+            raise RuntimeError("Unknown reader: " + str(reader))
 
         # Create an IsotopeData object for each isotope in the file
-        for i, isotope_data in enumerate(self._sims_object.data):
-            label = self._sims_object.header["label list"][i]
+        for i, isotope_data in enumerate(data):
+            label = self._header["label list"][i]
                       
-            self._isotopes.update({
-                label:
-                IsotopeData(isotope_label = label,
-                            isotope_data = isotope_data)})
+            self.add_isotope(IsotopeData(isotope_label = label,
+                                         isotope_data = isotope_data,
+                                         lazy = lazy or stacked,
+                                         dtype = self._dtype,
+                                         corrected_dtype = self._corrected_dtype))
 
+        if stacked:
+            self.stack_isotopes()
         
+    def process_file(self, filename, dead_time=None, dwell_time=0, x_roll=0,
+                     y_roll=0, trim_front=0, trim_back=0, cache=None,
+                     reader="auto", lazy=False):
+        """ Imports a NanoSIMS file and applies trims, deadtime correction \
+        and rolls to every isotope, the same as :meth:`import_file` followed \
+        by :meth:`trim_front_all`, :meth:`trim_back_all`, \
+        :meth:`deadtime_correct_all` and :meth:`roll_all`.
+
+        With a cache, the corrected data is stored the first time, keyed on \
+        the content of the file and the parameters. Later calls with the same \
+        file and parameters memory-map the stored data instead of reading \
+        and correcting the file again.
+
+        :param filename: Attempts to open this file to import data.
+        :type filename: string
+
+        :param dead_time: Dead time in **seconds**, no deadtime correction if \
+                          not given.
+        :type dead_time: float
+
+        :param dwell_time: Dwell time, read from the file if not given.
+        :type dwell_time: float
+
+        :param x_roll: amount to roll in the x-direction.
+        :type x_roll: int
+
+        :param y_roll: amount to roll in the y-direction.
+        :type y_roll: int
+
+        :param trim_front: number of cycles to remove from the front.
+        :type trim_front: int
+
+        :param trim_back: number of cycles to remove from the back.
+        :type trim_back: int
+
+        :param cache: cache of corrected data.
+        :type cache: :class:`~nanosims_analysis.cache.CubeCache`
+
+        :param reader: see :meth:`import_file`.
+        :type reader: string
+
+        :param lazy: if True, the file is imported lazily, see \
+                     :meth:`import_file`, and the corrections are applied to \
+                     each isotope when it is first used. With a cache, the \
+                     data stored on a cache miss is memory-mapped from the \
+                     cache afterwards, so isotopes are not kept in memory.
+        :type lazy: bool
+        """
+        if not Path(filename).is_file():
+            raise RuntimeError('Bad filename')
+        parameters = {"dead_time": dead_time, "dwell_time": dwell_time,
+                      "x_roll": int(x_roll), "y_roll": int(y_roll),
+                      "trim_front": int(trim_front),
+                      "trim_back": int(trim_back),
+                      "dtype": str(self._dtype),
+                      "corrected_dtype": str(self._corrected_dtype)}
+        if cache is not None:
+            key = cache.key(filename, parameters)
+            entry = cache.load(key)
+            if entry is not None:
+                self._load_entry(filename, *entry)
+                return
+
+        self.import_file(filename, lazy=lazy, reader=reader)
+        self.trim_front_all(trim_front)
+        self.trim_back_all(trim_back)
+        if dead_time is not None:
+            self.deadtime_correct_all(dead_time, dwell_time)
+        self.roll_all(x_roll, y_roll)
+
+        if cache is not None:
+            metadata = {
+                "header": {"label list": list(self._header["label list"]),
+                           "BFields": [{"time per pixel": float(
+                               self._header["BFields"][0]["time per pixel"])}]},
+                "dwell_time": getattr(self, "_dwell_time", None),
+                "dead_time": dead_time}
+            cache.store(key, metadata,
+                        {label: isotope.get_data()
+                         for label, isotope in self._isotopes.items()})
+            if lazy:
+                entry = cache.load(key)
+                if entry is not None:
+                    self._load_entry(filename, *entry)
+
+    def _load_entry(self, filename, metadata, data):
+        """ Adds the isotopes of a cache entry, see :meth:`process_file`. """
+        self._filename = filename
+        if ImReader.is_supported(filename):
+            self._header = ImReader(filename).header
+        else:
+            self._header = metadata["header"]
+        for label, isotope_data in data.items():
+            isotope = IsotopeData(isotope_label = label,
+                                  isotope_data = isotope_data,
+                                  lazy = True,
+                                  dtype = self._dtype,
+                                  corrected_dtype = self._corrected_dtype)
+            if metadata["dead_time"] is not None:
+                isotope._dwell_time = metadata["dwell_time"]
+                isotope._dead_time = metadata["dead_time"]
+                isotope._is_deadtime_corrected = True
+            self.add_isotope(isotope)
+        if metadata["dead_time"] is not None:
+            self._dwell_time = metadata["dwell_time"]
+            self._dead_time = metadata["dead_time"]
+
+    def iter_file(self, filename, cycles_per_block=16, labels=None, start=0,
+                  stop=None):
+        """ Reads a NanoSIMS file a block of cycles at a time, for files too \
+        large to import at once. Yields, for each block in order, a new \
+        Importer holding the isotopes of those cycles only, created with the \
+        dtypes of this importer. Deadtime correction, rolls, masks and \
+        :meth:`masked_statistics` can be used on each block as on a full \
+        import, results over a mask can be combined across blocks with \
+        :func:`combine_statistics`. Only one block is held in memory at a \
+        time, as long as earlier blocks are not kept. This importer is not \
+        changed. Requires an uncompressed image file.
+
+        :param filename: file to read.
+        :type filename: string
+
+        :param cycles_per_block: number of cycles in each block (default 16).
+        :type cycles_per_block: int
+
+        :param labels: labels of the isotopes to read (default all).
+        :type labels: list of strings
+
+        :param start: first cycle to read (default 0).
+        :type start: int
+
+        :param stop: cycle to stop reading at (default all cycles).
+        :type stop: int
+        """
+        if not Path(filename).is_file():
+            raise RuntimeError('Bad filename')
+        im_reader = ImReader(filename)
+        if labels is None:
+            labels = im_reader.labels()
+        cycles = range(im_reader.shape()[0])[start:stop]
+        for first in range(0, len(cycles), cycles_per_block):
+            block = cycles[first:first + cycles_per_block]
+            data = im_reader.read_data(labels, block.start, block.stop)
+
+            block_importer = Importer(self._dtype, self._corrected_dtype,
+                                      executor = self._executor)
+            block_importer._filename = filename
+            block_importer._header = im_reader.header
+            for label in labels:
+                block_importer.add_isotope(
+                    IsotopeData(isotope_label = label,
+                                isotope_data = data.pop(label),
+                                dtype = self._dtype,
+                                corrected_dtype = self._corrected_dtype))
+            yield block_importer
+
     def deadtime_correct_all(self, dead_time, dwell_time=0):
         """ Performs deadtime correction on each data set. Dwell time can usually be \
         found in the header for the NanoSIMS file but dead time must be given. \
@@ -70,26 +627,489 @@ class Importer(object):
         """
         if not dwell_time:
             self._dwell_time = float(
-                self._sims_object.header["BFields"][0]["time per pixel"])
+                self._header["BFields"][0]["time per pixel"])
         else:
             self._dwell_time = dwell_time
         self._dead_time = dead_time
 
+        if self._is_stacked():
+            # Check every isotope before recording any correction
+            for label, isotope in self._isotopes.items():
+                if isotope._is_deadtime_corrected:
+                    raise RuntimeError("Error: Isotope " + label +
+                                       " is already deadtime corrected")
+            for label, isotope in self._isotopes.items():
+                isotope._record_deadtime_correction(self._dwell_time,
+                                                    self._dead_time)
+            if self._stack.dtype != self._corrected_dtype:
+                self._set_stack(list(self._stack_views),
+                                self._stack.astype(self._corrected_dtype))
+            else:
+                self._writable_stack()
+            _deadtime_correct_inplace(self._stack, self._dwell_time,
+                                      self._dead_time, self._executor)
+            for label, isotope in self._isotopes.items():
+                isotope._changed()
+            return
+
         for label, isotope in self._isotopes.items():
             isotope.perform_deadtime_correction(dwell_time = self._dwell_time,
                                                 dead_time = self._dead_time)
 
-    def roll_all(self, x_roll=0, y_roll=0):
+    def roll_all(self, x_roll=0, y_roll=0, virtual=False):
+        """ Rolls the data of every isotope, see \
+        :meth:`~nanosims_analysis.data_structures.IsotopeData.roll_data`.
+        """
+        if virtual:
+            for label, isotope in self._isotopes.items():
+                isotope.roll_data(x_roll, y_roll, virtual = True)
+            return
+        if self._is_stacked():
+            self._writable_stack()
+            _roll_inplace(self._stack, x_roll, y_roll, self._executor)
+            for label, isotope in self._isotopes.items():
+                isotope._changed()
+            return
         for label, isotope in self._isotopes.items():
             isotope.roll_data(x_roll, y_roll)
             
+    def correct_drift(self, label, reference_cycle=0, upsample=20):
+        """ Estimates the drift between cycles from one isotope and corrects \
+        every isotope for it, see \
+        :meth:`~nanosims_analysis.data_structures.IsotopeData.estimate_drift` \
+        and \
+        :meth:`~nanosims_analysis.data_structures.IsotopeData.correct_drift`. \
+        The isotopes are shifted together a block of cycles at a time, \
+        sharing the phase ramps of sub-pixel shifts.
+
+        :param label: label of the isotope the drift is estimated from, \
+                      usually the one with the most counts.
+        :type label: string
+
+        :param reference_cycle: cycle the others are aligned to (default 0).
+        :type reference_cycle: int
+
+        :param upsample: the shifts are found to 1/upsample of a pixel \
+                         (default 20), 1 gives whole pixel shifts.
+        :type upsample: int
+
+        :returns: x and y shifts of each cycle.
+        :rtype: float `numpy` array, shaped (cycle, 2)
+        """
+        shifts = self._isotopes[label].estimate_drift(reference_cycle,
+                                                      upsample)
+        subpixel = not np.array_equal(shifts, np.round(shifts))
+        if self._is_stacked() and (not subpixel or
+                                   self._stack.dtype.kind == "f"):
+            self._writable_stack()
+            arrays = list(self._stack)
+        else:
+            arrays = [isotope._drift_target(shifts)
+                      for isotope in self._isotopes.values()]
+        registration.shift_cycles(arrays, shifts)
+        for isotope in self._isotopes.values():
+            isotope._changed()
+        print("Drift correction: reference: " + label + " cycle " +
+              str(reference_cycle) + ";\tlargest shift: " +
+              str(np.abs(shifts).max()) + " pixels")
+        return shifts
+
+    def map(self, function, labels=None):
+        """ Calls function with each isotope, for several isotopes at once on \
+        the executor of the importer, e.g. \
+        ``importer.map(lambda isotope: isotope.get_mask(lower = 10))``.
+
+        :param function: function taking an \
+                         :class:`~nanosims_analysis.data_structures.IsotopeData`.
+        :type function: callable
+
+        :param labels: labels of the isotopes (default all).
+        :type labels: list of strings
+
+        :returns: the result of function for each label.
+        :rtype: dict
+        """
+        if labels is None:
+            labels = list(self._isotopes)
+        results = _parallel_map(self._executor, function,
+                                [self._isotopes[label] for label in labels])
+        return dict(zip(labels, results))
+
+    def load_all(self, labels=None):
+        """ Reads the data of lazily imported isotopes and applies their \
+        pending corrections, for several isotopes at once. Called by the \
+        methods of the importer that use several isotopes, corrections of a \
+        single isotope split its blocks of cycles between the workers \
+        instead.
+
+        :param labels: labels of the isotopes (default all).
+        :type labels: list of strings
+        """
+        self.map(lambda isotope: isotope._data, labels)
+
+    def sum_all(self, mask=None, labels=None):
+        """ Returns the sum of each isotope, with optional masking, see \
+        :meth:`~nanosims_analysis.data_structures.IsotopeData.sum`, found for \
+        several isotopes at once.
+
+        :param mask: mask to apply to the data.
+        :type mask: numpy bool array or \
+                    :class:`~nanosims_analysis.data_structures.Mask`
+
+        :param labels: labels of the isotopes (default all).
+        :type labels: list of strings
+
+        :returns: the sum of each isotope, by label.
+        :rtype: dict
+        """
+        return self.map(lambda isotope: isotope.sum(mask), labels)
+
+    def masked_statistics(self, mask, labels=None):
+        """ Returns the sum, count, mean and standard deviation of the data \
+        selected by mask for several isotopes, found together in one pass \
+        over the selected pixels. Gives the same values as calling \
+        :meth:`~nanosims_analysis.data_structures.IsotopeData.sum` and \
+        :meth:`~nanosims_analysis.data_structures.IsotopeData.std` for each \
+        isotope.
+
+        :param mask: mask to apply to the data, values that are True are \
+                     masked.
+        :type mask: numpy bool array or \
+                    :class:`~nanosims_analysis.data_structures.Mask`
+
+        :param labels: labels of the isotopes, all isotopes if not given.
+        :type labels: list of strings
+
+        :returns: for each label, a dictionary with keys "sum", "count", \
+                  "mean" and "std".
+        :rtype: dict
+        """
+        if labels is None:
+            labels = list(self._isotopes)
+        if not isinstance(mask, Mask):
+            mask = Mask(mask)
+        isotopes = [self._isotopes[label] for label in labels]
+        for isotope in isotopes:
+            if np.shape(mask) != isotope._shape():
+                raise RuntimeError("Mask shape " + str(np.shape(mask)) +
+                                   " does not match shape of isotope " +
+                                   isotope.get_label())
+
+        # Isotopes with the same virtual roll share the indices of the mask
+        groups = {}
+        for label, isotope in zip(labels, isotopes):
+            groups.setdefault(isotope._virtual_roll, []).append(label)
+
+        statistics = {}
+        count = mask.count()
+        for virtual_roll, group in groups.items():
+            group_mask = mask
+            if virtual_roll != (0, 0):
+                group_mask = Mask(self._isotopes[group[0]]._unview(mask))
+            self.load_all(group)
+            rows = [self._isotopes[label]._data.reshape(-1) for label in group]
+            sums, means, variances = _masked_moments(rows, group_mask.indices(),
+                                                     self._executor)
+            for i, label in enumerate(group):
+                statistics[label] = {"sum": sums[i],
+                                     "count": count,
+                                     "mean": means[i],
+                                     "std": np.sqrt(variances[i])}
+        return {label: statistics[label] for label in labels}
+
+    def ratio_statistics(self, ratios, mask, primary_current=None,
+                         dwell_time=None):
+        r""" Returns the statistics of several isotope ratios over the pixels \
+        selected by mask, found together in one pass over the selected \
+        pixels. For each ratio of the isotopes :math:`n` and :math:`d`, with \
+        :math:`N` and :math:`D` their total counts over the :math:`P` \
+        selected pixels:
+
+        * "numerator_sum", "denominator_sum" and "pixels": :math:`N`, \
+          :math:`D` and :math:`P`.
+        * "ratio": the bulk ratio :math:`R = N/D`, QSA corrected as \
+          :math:`R/(1 + \beta K)` with :math:`K = D/(I_p T P)` when the \
+          primary current is given.
+        * "ratio_sigma": the counting uncertainty of the ratio, \
+          :math:`R\sqrt{1/N + 1/D}`.
+        * "std": the standard deviation of the pixel by pixel ratio, as \
+          given by :meth:`~nanosims_analysis.data_structures.RatioData.std`.
+        * "standard_error": :math:`std/\sqrt{P}`.
+        * "combined_sigma": the standard error and the counting uncertainty \
+          combined quadratically.
+        * "delta", "delta_std", "delta_sigma" and "delta_2sigma": the delta \
+          value of the bulk ratio against the standard ratio in permil, the \
+          standard deviation and standard error in permil, and twice the \
+          standard error. These are nan for ratios without a standard.
+
+        :param ratios: ratios, as (numerator label, denominator label) or \
+                       (numerator label, denominator label, standard ratio) \
+                       tuples, e.g. ("17O", "16O", 0.00038288).
+        :type ratios: list of tuples
+
+        :param mask: mask to apply to the data, values that are True are \
+                     masked.
+        :type mask: numpy bool array or \
+                    :class:`~nanosims_analysis.data_structures.Mask`
+
+        :param primary_current: primary current in pA, for the QSA \
+                                correction of the bulk ratios with the beta \
+                                of :func:`~nanosims_analysis.data_structures.qsa_beta` \
+                                (default None, not corrected).
+        :type primary_current: float
+
+        :param dwell_time: dwell time, needed for the QSA correction.
+        :type dwell_time: float
+
+        :returns: one record per ratio, with the fields above and "label", \
+                  "numerator/denominator".
+        :rtype: `numpy` structured array
+        """
+        if not isinstance(mask, Mask):
+            mask = Mask(mask)
+        if primary_current is not None and dwell_time is None:
+            raise RuntimeError("Dwell time is needed for QSA correction")
+        ratios = [tuple(ratio) + (None,)*(3 - len(ratio)) for ratio in ratios]
+        labels = []
+        for numerator, denominator, standard in ratios:
+            for label in (numerator, denominator):
+                if label not in self._isotopes:
+                    raise RuntimeError("Isotope " + label + " not found")
+                if label not in labels:
+                    labels.append(label)
+        isotopes = [self._isotopes[label] for label in labels]
+        for isotope in isotopes:
+            if np.shape(mask) != isotope._shape():
+                raise RuntimeError("Mask shape " + str(np.shape(mask)) +
+                                   " does not match shape of isotope " +
+                                   isotope.get_label())
+        pairs = [(labels.index(numerator), labels.index(denominator))
+                 for numerator, denominator, standard in ratios]
+
+        # Counts of every isotope and the pixel by pixel ratios, reduced
+        # together block by block
+        self.load_all(labels)
+        rows = [isotope._data.reshape(-1) for isotope in isotopes]
+        n_cycles, nx, ny = np.shape(mask)
+        indices = mask.indices()
+        n_rows = len(rows) + len(pairs)
+        block_size = data_structures.BLOCK_SIZE
+
+        def reduce(start):
+            block = indices[start:start + block_size]
+            values = _scratch_buffer("moments", (n_rows, len(block)))
+            for i, (row, isotope) in enumerate(zip(rows, isotopes)):
+                values[i] = row[_stored_indices(block, isotope._virtual_roll,
+                                                nx, ny)]
+            for i, (numerator, denominator) in enumerate(pairs):
+                out = values[len(rows) + i]
+                out[...] = 0
+                np.divide(values[numerator], values[denominator], out=out,
+                          where=values[denominator]!=0)
+            return _block_moments(values)
+
+        moments = (0, np.zeros(n_rows), np.zeros(n_rows), np.zeros(n_rows))
+        for block_moments in _parallel_map(self._executor, reduce,
+                                           range(0, len(indices), block_size)):
+            moments = _combine_moments(moments, block_moments)
+        sums, means, variances = _finish_moments(moments)
+
+        pixels = mask.count()
+        numerator_sums = sums[[numerator for numerator, denominator in pairs]]
+        denominator_sums = sums[[denominator
+                                 for numerator, denominator in pairs]]
+        standards = np.array([np.nan if standard is None else standard
+                              for numerator, denominator, standard in ratios])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = numerator_sums / denominator_sums
+            if primary_current is not None:
+                betas = np.array([qsa_beta(numerator, denominator)
+                                  for numerator, denominator, standard
+                                  in ratios])
+                K = denominator_sums / (primary_current*IONS_PER_PICOAMPERE*
+                                        dwell_time*pixels)
+                ratio = ratio / (1 + betas*K)
+            ratio_sigma = ratio*np.sqrt(1/numerator_sums + 1/denominator_sums)
+            std = np.sqrt(variances[len(rows):])
+            standard_error = std / np.sqrt(pixels)
+            delta_sigma = standard_error/standards*1000
+
+            statistics = np.zeros(len(ratios), dtype=RATIO_STATISTICS_DTYPE)
+            statistics["label"] = [numerator + "/" + denominator
+                                   for numerator, denominator, standard
+                                   in ratios]
+            statistics["numerator_sum"] = numerator_sums
+            statistics["denominator_sum"] = denominator_sums
+            statistics["pixels"] = pixels
+            statistics["ratio"] = ratio
+            statistics["ratio_sigma"] = ratio_sigma
+            statistics["std"] = std
+            statistics["standard_error"] = standard_error
+            statistics["combined_sigma"] = np.sqrt(standard_error**2 +
+                                                   ratio_sigma**2)
+            statistics["delta"] = (ratio/standards - 1)*1000
+            statistics["delta_std"] = std/standards*1000
+            statistics["delta_sigma"] = delta_sigma
+            statistics["delta_2sigma"] = 2*delta_sigma
+        return statistics
+
+    def region_statistics(self, region_labels, labels=None, ratios=()):
+        """ Returns the number of values and the sums of isotopes in each \
+        region of a label image, with the ratios of the sums and their delta \
+        values. Each isotope is reduced over every region at once with \
+        `np.bincount`, see \
+        :meth:`~nanosims_analysis.data_structures.IsotopeData.region_statistics`, \
+        so thousands of regions, e.g. the grains found by \
+        :func:`~nanosims_analysis.data_structures.label_regions`, take a \
+        single pass over each isotope.
+
+        :param region_labels: label image, with the region of each value. A \
+                              2D image (x, y) applies to every cycle, a 3D \
+                              image has the shape of the isotopes. Values \
+                              labeled 0 belong to no region.
+        :type region_labels: numpy integer array
+
+        :param labels: labels of the isotopes to sum (default all).
+        :type labels: list of strings
+
+        :param ratios: ratios of sums, as (numerator label, denominator \
+                       label) or (numerator label, denominator label, \
+                       standard ratio) tuples, as for :meth:`ratio_statistics`.
+        :type ratios: list of tuples
+
+        :returns: one record per region, 1 to the largest label, with the \
+                  fields "region" and "pixels", the sum of each isotope by \
+                  its label, each ratio by "numerator/denominator", and the \
+                  delta value in permil of each ratio with a standard by \
+                  "delta numerator/denominator".
+        :rtype: `numpy` structured array
+        """
+        if labels is None:
+            labels = list(self._isotopes)
+        ratios = [tuple(ratio) + (None,)*(3 - len(ratio)) for ratio in ratios]
+        for numerator, denominator, standard in ratios:
+            for label in (numerator, denominator):
+                if label not in labels:
+                    labels = labels + [label]
+        for label in labels:
+            if label not in self._isotopes:
+                raise RuntimeError("Isotope " + label + " not found")
+        shapes = set(self._isotopes[label]._shape() for label in labels)
+        if len(shapes) != 1:
+            raise RuntimeError("Isotopes must have the same shape")
+        shape = shapes.pop()
+        region_labels, n_labels = _check_region_labels(region_labels, shape)
+
+        # Label images are unrolled once for each virtual roll
+        unviewed = {}
+        for label in labels:
+            isotope = self._isotopes[label]
+            if isotope._virtual_roll not in unviewed:
+                unviewed[isotope._virtual_roll] = isotope._unview(
+                    region_labels)
+        sums = self.map(lambda isotope: _region_sums(
+            isotope._stored_blocks(), unviewed[isotope._virtual_roll],
+            n_labels)[1:], labels)
+
+        fields = [("region", np.int64), ("pixels", np.int64)]
+        fields += [(label, float) for label in labels]
+        fields += [(numerator + "/" + denominator, float)
+                   for numerator, denominator, standard in ratios]
+        fields += [("delta " + numerator + "/" + denominator, float)
+                   for numerator, denominator, standard in ratios
+                   if standard is not None]
+        statistics = np.zeros(n_labels - 1, dtype=fields)
+        statistics["region"] = np.arange(1, n_labels)
+        statistics["pixels"] = _region_counts(region_labels, n_labels,
+                                              shape[0])[1:]
+        for label in labels:
+            statistics[label] = sums[label]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for numerator, denominator, standard in ratios:
+                name = numerator + "/" + denominator
+                statistics[name] = sums[numerator] / sums[denominator]
+                if standard is not None:
+                    statistics["delta " + name] = \
+                        (statistics[name]/standard - 1)*1000
+        return statistics
+
+    def to_VTK(self, filename, labels=None, ratios=(), x_roll=0, y_roll=0,
+               mask=None, pieces=1, processes=None):
+        """ Writes isotopes and ratios to a single VTK rectilinear grid file, \
+        with one cell data array for each, named by its label. Each array is \
+        written as by \
+        :meth:`~nanosims_analysis.data_structures.IsotopeData.to_VTK`, a \
+        block of cycles at a time, sharing the grid coordinates.
+
+        :param filename: file to write, without extension.
+        :type filename: string
+
+        :param labels: labels of the isotopes to write (default all).
+        :type labels: list of strings
+
+        :param ratios: ratios to write.
+        :type ratios: list of \
+                      :class:`~nanosims_analysis.data_structures.RatioData`
+
+        :param x_roll: amount to roll the output in the x-direction.
+        :type x_roll: int
+
+        :param y_roll: amount to roll the output in the y-direction.
+        :type y_roll: int
+
+        :param mask: masked values are written as -1.
+        :type mask: numpy bool array
+
+        :param pieces: number of pieces of cycles written at the same time \
+                       by worker processes, see \
+                       :meth:`~nanosims_analysis.data_structures.IsotopeData.to_VTK`.
+        :type pieces: int
+
+        :param processes: number of worker processes writing pieces \
+                          (default the number of CPUs).
+        :type processes: int
+
+        :returns: name of the file written, the .pvtr file for pieces.
+        """
+        if labels is None:
+            labels = list(self._isotopes)
+        self.load_all(labels)
+        datasets = [self._isotopes[label] for label in labels] + list(ratios)
+        shapes = set(dataset._shape() for dataset in datasets)
+        if len(shapes) != 1:
+            raise RuntimeError("Isotopes and ratios must have the same shape "
+                               "to be written to one file")
+        if pieces > 1:
+            return _write_partitioned_vtk(filename, datasets, x_roll, y_roll,
+                                          mask, pieces, processes)
+        fields = [dataset._vtk_field(x_roll, y_roll, mask)
+                  for dataset in datasets]
+        return _write_vtk(filename, fields, shapes.pop())
+
     def trim_back_all(self, n):
+        stacked = self._is_stacked()
         for label, isotope in self._isotopes.items():
             isotope.trim_back(int(n))
+        if stacked:
+            n_cycles = np.shape(self._stack)[1]
+            self._trim_stack(self._stack[:, :n_cycles - int(n)])
             
     def trim_front_all(self, n):
+        stacked = self._is_stacked()
         for label, isotope in self._isotopes.items():
             isotope.trim_front(int(n))
+        if stacked:
+            self._trim_stack(self._stack[:, int(n):])
+
+    def _trim_stack(self, stack):
+        """ Makes stack, a view of the trimmed stacked store, the store of \
+        the isotopes. The data is not copied, so isotopes whose data has been \
+        handed out stay marked as such. """
+        exported = {label: self._isotopes[label]._exported
+                    for label in self._stack_views}
+        self._set_stack(list(self._stack_views), stack)
+        for label, value in exported.items():
+            self._isotopes[label]._exported = value
 
     def __str__(self):
         return_string = "Importer object\nImported file: " + self._filename + "\n";
@@ -97,3 +1117,49 @@ class Importer(object):
         for label, data in self._isotopes.items():
             return_string += str(data) + "\n"
         return return_string[:-1]
+
+def _stored_indices(indices, virtual_roll, nx, ny):
+    """ Returns the flat indices in the stored data of an isotope with the \
+    given virtual roll of the flat indices of its rolled view. """
+    if virtual_roll == (0, 0):
+        return indices
+    cycles, rest = np.divmod(indices, nx*ny)
+    x, y = np.divmod(rest, ny)
+    x -= virtual_roll[0]
+    x %= nx
+    y -= virtual_roll[1]
+    y %= ny
+    return cycles*(nx*ny) + x*ny + y
+
+def combine_statistics(first, second):
+    """ Combines the results of :meth:`Importer.masked_statistics` over two \
+    different sets of pixels, e.g. two blocks of cycles given by \
+    :meth:`Importer.iter_file`, into the statistics over both sets.
+
+    :param first: statistics of the first set, or None to return second.
+    :type first: dict
+
+    :param second: statistics of the second set, with the same labels.
+    :type second: dict
+
+    :returns: for each label, a dictionary with keys "sum", "count", "mean" \
+              and "std".
+    :rtype: dict
+    """
+    if first is None:
+        return second
+    combined = {}
+    for label, a in first.items():
+        b = second[label]
+        count = a["count"] + b["count"]
+        if a["count"] == 0 or b["count"] == 0:
+            combined[label] = dict(a if b["count"] == 0 else b)
+            continue
+        delta = b["mean"] - a["mean"]
+        m2 = (a["std"]**2 * a["count"] + b["std"]**2 * b["count"] +
+              delta**2 * a["count"] * b["count"] / count)
+        combined[label] = {"sum": a["sum"] + b["sum"],
+                           "count": count,
+                           "mean": a["mean"] + delta * b["count"] / count,
+                           "std": np.sqrt(m2 / count)}
+    return combined
@@ -0,0 +1,173 @@
+"""
+
+.. module:: registration
+    :synopsis: Estimates and corrects the drift of images between cycles.
+
+.. moduleauthor:: Joshua Rehak <jsrehak@berkeley.edu>
+
+"""
+
+import numpy as np
+
+# Default number of values transformed at once, about 32 MB of complex
+# spectra
+BLOCK_SIZE = 2**21
+
+# Largest number of values rolled at once by whole pixel shifts, so that the
+# copy of each block stays in cache (512 kB of float64)
+ROLL_BLOCK_SIZE = 2**16
+
+def _blocks(n_cycles, nx, ny, block_size):
+    """ Yields slices of blocks of cycles holding about block_size values. """
+    n = max(1, block_size // max(1, nx*ny))
+    for start in range(0, n_cycles, n):
+        yield slice(start, min(start + n, n_cycles))
+
+def _roll_slices(n, shift):
+    """ Returns the (source, destination) slices of a roll of n values by \
+    shift, with 0 <= shift < n. """
+    if shift == 0:
+        return [(slice(0, n), slice(0, n))]
+    return [(slice(0, n - shift), slice(shift, n)),
+            (slice(n - shift, n), slice(0, shift))]
+
+def _roll_runs(data, rolls, block_size):
+    """ Rolls the cycles of data in place by whole pixel rolls. Consecutive \
+    cycles with the same roll are rolled together, a block of cycles at a \
+    time, by copying the block to a scratch buffer and writing its shifted \
+    slices back, without allocating an array per cycle. """
+    n_cycles, nx, ny = np.shape(data)
+    block_size = min(block_size, ROLL_BLOCK_SIZE)
+    scratch = np.empty((max(1, block_size // max(1, nx*ny)), nx, ny),
+                       dtype=data.dtype)
+    rolls = np.mod(rolls, (nx, ny))
+    changes = np.flatnonzero(np.any(rolls[1:] != rolls[:-1], axis=1)) + 1
+    starts = np.concatenate(([0], changes))
+    stops = np.concatenate((changes, [n_cycles]))
+    for start, stop in zip(starts, stops):
+        x_roll, y_roll = rolls[start]
+        if x_roll == 0 and y_roll == 0:
+            continue
+        for cycles in _blocks(stop - start, nx, ny, block_size):
+            block = data[start + cycles.start:start + cycles.stop]
+            source = scratch[:len(block)]
+            source[...] = block
+            for x_source, x_destination in _roll_slices(nx, x_roll):
+                for y_source, y_destination in _roll_slices(ny, y_roll):
+                    block[:, x_destination, y_destination] = \
+                        source[:, x_source, y_source]
+
+def _upsampled_correlation(cross, peaks, upsample, window):
+    """ Returns the correlation of the cross power spectra of a block of \
+    cycles, shaped (cycle, x, y), upsampled by upsample on a window of \
+    window by window values centred on peaks, by matrix multiplication DFTs \
+    (Guizar-Sicairos et al., 2008), without an upsampled FFT. """
+    n_planes, nx, ny = np.shape(cross)
+    offsets = (np.arange(window) - window // 2) / upsample
+    x = peaks[:, 0, np.newaxis] + offsets
+    y = peaks[:, 1, np.newaxis] + offsets
+    x_kernels = np.exp(2j*np.pi*x[:, :, np.newaxis]*np.fft.fftfreq(nx))
+    y_kernels = np.exp(2j*np.pi*np.fft.fftfreq(ny)[:, np.newaxis]*
+                       y[:, np.newaxis, :])
+    return np.matmul(np.matmul(x_kernels, cross), y_kernels).real
+
+def estimate_drift(data, reference_cycle=0, upsample=20,
+                   block_size=BLOCK_SIZE):
+    """ Estimates the drift of each cycle relative to a reference cycle by \
+    cross-correlation: the spectra of blocks of cycles are found with one \
+    batched FFT and multiplied by the spectrum of the reference cycle, which \
+    is found once. The shift of each cycle is the position of the peak of \
+    its correlation, refined to a fraction of a pixel by upsampling the \
+    correlation around the peak (Guizar-Sicairos et al., 2008).
+
+    :param data: data of one isotope, shaped (cycle, x, y).
+    :type data: 3D `numpy` array
+
+    :param reference_cycle: cycle the others are aligned to (default 0).
+    :type reference_cycle: int
+
+    :param upsample: the shifts are found to 1/upsample of a pixel \
+                     (default 20), 1 gives whole pixel shifts.
+    :type upsample: int
+
+    :param block_size: approximate number of values transformed at once.
+    :type block_size: int
+
+    :returns: for each cycle, the x and y shifts that align it with the \
+              reference cycle, in the sense of \
+              :meth:`~nanosims_analysis.data_structures.IsotopeData.roll_data`.
+    :rtype: float `numpy` array, shaped (cycle, 2)
+    """
+    n_cycles, nx, ny = np.shape(data)
+    reference = np.asarray(data[reference_cycle], dtype=float)
+    reference_spectrum = np.conj(np.fft.fft2(reference - reference.mean()))
+
+    shifts = np.empty((n_cycles, 2))
+    for cycles in _blocks(n_cycles, nx, ny, block_size):
+        block = np.asarray(data[cycles], dtype=float)
+        block = block - block.mean(axis=(1, 2), keepdims=True)
+        cross = np.fft.fft2(block)
+        cross *= reference_spectrum
+        correlation = np.fft.ifft2(cross).real
+
+        flat = correlation.reshape(len(correlation), -1).argmax(axis=1)
+        peaks = np.stack(np.divmod(flat, ny), axis=1).astype(float)
+        # Peaks past the middle are negative shifts
+        peaks[:, 0] = (peaks[:, 0] + nx // 2) % nx - nx // 2
+        peaks[:, 1] = (peaks[:, 1] + ny // 2) % ny - ny // 2
+        if upsample > 1:
+            window = int(np.ceil(1.5*upsample)) | 1
+            upsampled = _upsampled_correlation(cross, peaks, upsample, window)
+            flat = upsampled.reshape(len(upsampled), -1).argmax(axis=1)
+            refined = np.stack(np.divmod(flat, window), axis=1)
+            peaks += (refined - window // 2) / upsample
+        shifts[cycles] = -peaks
+    return shifts
+
+def shift_cycles(arrays, shifts, block_size=BLOCK_SIZE):
+    """ Shifts each cycle of one or more arrays in place, by the shifts of \
+    :func:`estimate_drift`. Whole pixel shifts are circular rolls, as by \
+    :meth:`~nanosims_analysis.data_structures.IsotopeData.roll_data`, which \
+    keep the values and dtype of the data. Other shifts are applied in \
+    Fourier space, as circular shifts of the interpolated image: the phase \
+    ramps of a block of cycles are found once and applied to the spectra of \
+    every array, so the arrays must hold floats.
+
+    :param arrays: arrays shaped (cycle, x, y), all with the same shape, \
+                   e.g. the data of every isotope of an importer.
+    :type arrays: list of 3D `numpy` arrays
+
+    :param shifts: x and y shifts of each cycle.
+    :type shifts: `numpy` array, shaped (cycle, 2)
+    """
+    shifts = np.asarray(shifts, dtype=float)
+    if len(arrays) == 0:
+        return
+    n_cycles, nx, ny = np.shape(arrays[0])
+    if any(np.shape(data) != (n_cycles, nx, ny) for data in arrays):
+        raise RuntimeError("Arrays must have the same shape to be shifted")
+    if shifts.shape != (n_cycles, 2):
+        raise RuntimeError("Shifts shape " + str(shifts.shape) +
+                           " does not match number of cycles " +
+                           str(n_cycles))
+
+    if np.array_equal(shifts, np.round(shifts)):
+        rolls = shifts.astype(int)
+        for data in arrays:
+            _roll_runs(data, rolls, block_size)
+        return
+
+    for data in arrays:
+        if data.dtype.kind != "f":
+            raise RuntimeError("Sub-pixel shifts need float data")
+    x_frequencies = np.fft.fftfreq(nx)
+    y_frequencies = np.fft.rfftfreq(ny)
+    for cycles in _blocks(n_cycles, nx, ny, block_size):
+        # Phase ramps of the block, shared by every array
+        x_ramps = np.exp(-2j*np.pi*np.outer(shifts[cycles, 0], x_frequencies))
+        y_ramps = np.exp(-2j*np.pi*np.outer(shifts[cycles, 1], y_frequencies))
+        ramps = x_ramps[:, :, np.newaxis] * y_ramps[:, np.newaxis, :]
+        for data in arrays:
+            spectra = np.fft.rfft2(data[cycles])
+            spectra *= ramps
+            data[cycles] = np.fft.irfft2(spectra, s=(nx, ny))
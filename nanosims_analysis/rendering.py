@@ -0,0 +1,107 @@
+"""
+
+.. module:: rendering
+    :synopsis: Renders isotope data to image files without a display.
+
+.. moduleauthor:: Joshua Rehak <jsrehak@berkeley.edu>
+
+"""
+
+import numpy as np
+
+# Views that can be rendered, see render
+VIEWS = ("slices", "projection", "montage")
+
+def _downsample(data, factor):
+    """ Averages data, shaped (cycle, x, y), over factor by factor pixels, \
+    ignoring nan values. Pixels left over at the edges are dropped. """
+    if factor == 1:
+        return data
+    n_cycles, nx, ny = np.shape(data)
+    nx, ny = nx // factor, ny // factor
+    blocks = data[:, :nx*factor, :ny*factor].reshape(n_cycles, nx, factor,
+                                                     ny, factor)
+    counts = np.sum(~np.isnan(blocks), axis=(2, 4))
+    sums = np.nansum(blocks, axis=(2, 4))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts
+
+def _montage(data, columns):
+    """ Tiles the cycles of data, shaped (cycle, x, y), into a single image \
+    with the given number of columns, filling unused tiles with nan. """
+    n_cycles, nx, ny = np.shape(data)
+    rows = -(-n_cycles // columns)
+    tiles = np.full((rows*columns, nx, ny), np.nan)
+    tiles[:n_cycles] = data
+    return (tiles.reshape(rows, columns, nx, ny).transpose(0, 2, 1, 3)
+                 .reshape(rows*nx, columns*ny))
+
+def render(data, filename, view="montage", mask=None, downsample=1,
+           label="Counts", title=None, columns=None, dpi=100):
+    """ Renders data, shaped (cycle, x, y), to an image file, e.g. a PNG. The \
+    figure is drawn without pyplot, so no display is needed.
+
+    :param data: data to render.
+    :type data: 3D `numpy` array
+
+    :param filename: image file to write, its extension sets the format.
+    :type filename: string
+
+    :param view: "slices" for slices through the middle of the data along \
+                 each axis, "projection" for the sums along each axis, or \
+                 "montage" (default) for an image of each cycle.
+    :type view: string
+
+    :param mask: masked values are left out.
+    :type mask: numpy bool array
+
+    :param downsample: average each downsample by downsample pixels before \
+                       rendering (default 1).
+    :type downsample: int
+
+    :param label: label of the colour bar.
+    :type label: string
+
+    :param title: title of the figure.
+    :type title: string
+
+    :param columns: number of columns of the montage (default about the \
+                    square root of the number of cycles).
+    :type columns: int
+
+    :param dpi: resolution of the image file.
+    :type dpi: int
+    """
+    if view not in VIEWS:
+        raise RuntimeError("Unknown view: " + str(view))
+    data = np.array(data, dtype=float)
+    if isinstance(mask, np.ndarray):
+        data[mask] = np.nan
+    data = _downsample(data, int(downsample))
+    n_cycles, nx, ny = np.shape(data)
+
+    if view == "montage":
+        if columns is None:
+            columns = int(np.ceil(np.sqrt(n_cycles)))
+        images = [("Cycles", _montage(data, columns))]
+    elif view == "slices":
+        images = [("Cycle " + str(n_cycles // 2), data[n_cycles // 2]),
+                  ("Y = " + str(ny // 2), data[:, :, ny // 2]),
+                  ("X = " + str(nx // 2), data[:, nx // 2, :])]
+    else:
+        images = [("Sum over cycles", np.nansum(data, axis=0)),
+                  ("Sum over y", np.nansum(data, axis=2)),
+                  ("Sum over x", np.nansum(data, axis=1))]
+
+    # Imported here, so that importing the package does not load matplotlib
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(5*len(images), 5))
+    axes = fig.subplots(1, len(images), squeeze=False)[0]
+    for ax, (name, image) in zip(axes, images):
+        shown = ax.imshow(image, cmap="CMRmap", interpolation="nearest",
+                          aspect="auto" if view != "montage" else "equal")
+        ax.set_title(name)
+        fig.colorbar(shown, ax=ax).ax.set_xlabel(label)
+    if title is not None:
+        fig.suptitle(title)
+    fig.savefig(filename, dpi=dpi)
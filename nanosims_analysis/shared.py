@@ -0,0 +1,233 @@
+"""
+
+.. module:: shared
+    :synopsis: Isotope data in shared memory, passed between processes by \
+               handle.
+
+.. moduleauthor:: Joshua Rehak <jsrehak@berkeley.edu>
+
+"""
+
+import atexit
+import os
+import sys
+import weakref
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# Mappings of the shared memory blocks created by this process, by name, with
+# the id of the creating process, unlinked by release or at exit
+_created = {}
+
+# Mappings of the shared memory blocks in use in this process, by name
+_mappings = weakref.WeakValueDictionary()
+
+class _Mapping(object):
+    """ A shared memory block mapped into this process. Arrays of the block \
+    hold a reference to it, the block is unmapped once it is no longer \
+    referenced: closing it while arrays use it would leave them pointing at \
+    unmapped memory. """
+    def __init__(self, block):
+        self.block = block
+        self.address = np.frombuffer(block.buf, dtype=np.uint8).ctypes.data
+        _mappings[block.name] = self
+
+class _Buffer(object):
+    """ Array interface of an array in a mapped block, the base of the \
+    arrays returned by SharedArray.array. """
+    def __init__(self, mapping, shape, dtype, writeable):
+        self.mapping = mapping
+        self.__array_interface__ = {"shape": shape, "typestr": dtype,
+                                    "data": (mapping.address, not writeable),
+                                    "version": 3}
+
+class SharedArray(object):
+    """ Handle of an array in a `multiprocessing.shared_memory` block. The \
+    handle only holds the name, shape and dtype of the array, so it is \
+    cheap to pickle and send to other processes, where :meth:`array` maps \
+    the same memory without copying it.
+
+    The process that creates the array owns the block: it is unlinked by \
+    :meth:`release`, or when that process exits. Arrays already mapped stay \
+    valid until they are no longer used, the memory is then freed.
+    """
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).str
+        self._creator = None
+
+    @classmethod
+    def create(cls, shape, dtype):
+        """ Allocates an uninitialized array in a new shared memory block and \
+        returns its handle.
+
+        :param shape: shape of the array.
+        :type shape: tuple
+
+        :param dtype: dtype of the array.
+        :type dtype: `numpy` dtype
+        """
+        size = max(1, int(np.prod(shape))*np.dtype(dtype).itemsize)
+        block = shared_memory.SharedMemory(create=True, size=size)
+        _created[block.name] = (_Mapping(block), os.getpid())
+        handle = cls(block.name, shape, dtype)
+        handle._creator = os.getpid()
+        return handle
+
+    def __getstate__(self):
+        # Other processes never own the block
+        state = dict(self.__dict__)
+        state["_creator"] = None
+        return state
+
+    def array(self, writeable=True):
+        """ Returns the array, mapped from the shared memory block. \
+        Attaching again in the same process reuses the mapping, as do \
+        processes forked from the creating process.
+
+        :param writeable: if False, the array returned is read only.
+        :type writeable: bool
+        """
+        mapping = _mappings.get(self.name)
+        if mapping is None:
+            mapping = _Mapping(_attach(self.name))
+        return np.asarray(_Buffer(mapping, self.shape, self.dtype, writeable))
+
+    def release(self):
+        """ Unlinks the shared memory block, if this process created it. \
+        Other processes can no longer attach to it, the memory is freed once \
+        every process stops using it. """
+        if self._creator != os.getpid():
+            return
+        mapping, pid = _created.pop(self.name, (None, None))
+        if mapping is not None:
+            _unlink(mapping.block)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+def _attach(name):
+    """ Attaches to an existing shared memory block. The block is owned by \
+    the process that created it, so it must not be unlinked by the resource \
+    tracker of this process when it exits. """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # Older versions always track the blocks they attach to. Processes
+    # started by multiprocessing share the tracker of their parent, where
+    # this also drops the registration of the creating process, which
+    # _unlink registers again
+    block = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(block._name, "shared_memory")
+    return block
+
+def _unlink(block):
+    """ Unlinks a block created by this process. Unlinking unregisters it \
+    from the resource tracker, so it is registered first, in case a process \
+    sharing the tracker dropped it when attaching. """
+    if sys.version_info < (3, 13):
+        resource_tracker.register(block._name, "shared_memory")
+    block.unlink()
+
+@atexit.register
+def _release_all():
+    for name, (mapping, pid) in list(_created.items()):
+        # Forked processes inherit the blocks of their parent without
+        # owning them
+        if pid == os.getpid():
+            try:
+                _unlink(mapping.block)
+            except FileNotFoundError:
+                pass
+    _created.clear()
+
+# Attributes of an isotope carried by its handle, when they are set
+_ISOTOPE_STATE = ("_virtual_roll", "_is_deadtime_corrected", "_dwell_time",
+                  "_dead_time", "_value_label", "_bin_reduction",
+                  "_isotope_labels", "_is_qsa_corrected")
+
+class SharedIsotope(object):
+    """ Handle of an isotope whose data is in shared memory, see \
+    :meth:`~nanosims_analysis.data_structures.IsotopeData.share`. It holds \
+    the label and corrections of the isotope and the :class:`SharedArray` \
+    of its data, or of the stacked data of an importer with the index of \
+    the isotope in it.
+    """
+    def __init__(self, isotope, array, index=None):
+        self.label = isotope.get_label()
+        self.array = array
+        self.index = index
+        self.corrected_dtype = isotope._corrected_dtype.str
+        self.state = {name: getattr(isotope, name) for name in _ISOTOPE_STATE
+                      if hasattr(isotope, name)}
+
+    def attach(self):
+        """ Returns an \
+        :class:`~nanosims_analysis.data_structures.IsotopeData` whose data \
+        is a read only view of the shared memory, without copying it. \
+        Corrections applied to it make a private copy first, so the shared \
+        data is never changed. Ratios are attached as IsotopeData holding \
+        their values. """
+        from nanosims_analysis.data_structures import IsotopeData
+        data = self.array.array(writeable=False)
+        if self.index is not None:
+            data = data[self.index]
+        isotope = IsotopeData(self.label, data, lazy=True, dtype=data.dtype,
+                              corrected_dtype=self.corrected_dtype)
+        isotope._data = data
+        for name, value in self.state.items():
+            setattr(isotope, name, value)
+        return isotope
+
+    def release(self):
+        """ Unlinks the shared memory, see :meth:`SharedArray.release`. """
+        self.array.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+class SharedImporter(object):
+    """ Handle of the isotopes of an importer, stacked in one shared memory \
+    block, see :meth:`~nanosims_analysis.importer.Importer.share`.
+    """
+    def __init__(self, importer, array):
+        self.array = array
+        self.isotopes = [SharedIsotope(isotope, array, i) for i, isotope in
+                         enumerate(importer._isotopes.values())]
+        self.filename = getattr(importer, "_filename", None)
+        self.dtype = importer._dtype
+        self.corrected_dtype = importer._corrected_dtype.str
+
+    def attach(self, workers=1):
+        """ Returns an :class:`~nanosims_analysis.importer.Importer` holding \
+        the isotopes, see :meth:`SharedIsotope.attach`.
+
+        :param workers: number of threads of the importer (default 1, as \
+                        the importer usually runs in one of several worker \
+                        processes).
+        :type workers: int
+        """
+        from nanosims_analysis.importer import Importer
+        importer = Importer(self.dtype, self.corrected_dtype, workers=workers)
+        if self.filename is not None:
+            importer._filename = self.filename
+        for isotope in self.isotopes:
+            importer.add_isotope(isotope.attach())
+        return importer
+
+    def release(self):
+        """ Unlinks the shared memory, see :meth:`SharedArray.release`. """
+        self.array.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
@@ -0,0 +1,90 @@
+from nose.tools import *
+import numpy as np
+import os
+import shutil
+import tempfile
+import warnings
+
+from nanosims_analysis import batch
+from nanosims_analysis.importer import Importer
+
+from synthetic_im import write_im_file
+
+class TestClass:
+
+    @classmethod
+    def setup_class(cls):
+        cls.labels = ["16O", "17O", "18O"]
+        cls.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(cls.directory, "session"))
+        cls.filenames = [os.path.join(cls.directory, "a.im"),
+                         os.path.join(cls.directory, "session", "b.im")]
+        for filename in cls.filenames:
+            write_im_file(filename, np.random.randint(0, 200,
+                                                      size=(3, 6, 8, 5)),
+                          cls.labels)
+        # Not an image file
+        with open(os.path.join(cls.directory, "notes.txt"), "w") as f:
+            f.write("notes")
+        cls.manifest = os.path.join(cls.directory, "manifest.csv")
+        with open(cls.manifest, "w") as f:
+            f.write("file,primary_current,trim_front,trim_back,mask_lower\n"
+                    "session/b.im,2.5,1,,50\n")
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.directory)
+
+    def expected(self, filename, trim_front=0, mask_lower=0,
+                 primary_current=None):
+        test_importer = Importer()
+        with warnings.catch_warnings():
+            # Headers of synthetic files lack sections the sims reader
+            # warns about
+            warnings.filterwarnings("ignore", category = UserWarning,
+                                    module = "sims")
+            test_importer.process_file(filename, dead_time = 44e-9,
+                                       x_roll = 1, y_roll = 1,
+                                       trim_front = trim_front)
+        mask = test_importer.get_isotope("16O").get_mask(lower = mask_lower)
+        return test_importer.ratio_statistics(
+            batch.VSMOW_RATIOS, mask, primary_current = primary_current,
+            dwell_time = 3000)
+
+    def test_find_im_files(self):
+        assert_equal(batch.find_im_files(self.directory), self.filenames)
+
+    def test_read_manifest(self):
+        manifest = batch.read_manifest(self.manifest)
+        assert_equal(manifest, {os.path.realpath(self.filenames[1]):
+                                {"primary_current": 2.5, "trim_front": 1,
+                                 "mask_lower": 50.0}})
+
+    def test_run_batch(self):
+        output = os.path.join(self.directory, "results.csv")
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", category = UserWarning,
+                                    module = "sims")
+            table = batch.run_batch(self.directory, manifest = self.manifest,
+                                    processes = 2, output = output)
+        assert_equal(len(table), 4)
+        assert_equal(list(table["file"]), [self.filenames[0]]*2 +
+                                          [self.filenames[1]]*2)
+        assert_true(all(table["error"] == ""))
+        expected = [self.expected(self.filenames[0]),
+                    self.expected(self.filenames[1], trim_front = 1,
+                                  mask_lower = 50, primary_current = 2.5)]
+        for records, reference in zip([table[:2], table[2:]], expected):
+            for name in ["label", "pixels", "ratio", "std", "delta"]:
+                assert_true(np.array_equal(records[name], reference[name]))
+        with open(output) as f:
+            assert_equal(len(f.readlines()), 5)
+
+    def test_run_batch_error(self):
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", category = UserWarning,
+                                    module = "sims")
+            table = batch.run_batch(self.directory, processes = 1,
+                                    mask_isotope = "28Si")
+        assert_equal(len(table), 2)
+        assert_true(all(table["error"] != ""))
@@ -0,0 +1,118 @@
+from nose.tools import *
+import numpy as np
+import os
+import shutil
+import tempfile
+import warnings
+
+from nanosims_analysis.cache import CubeCache
+from nanosims_analysis.importer import Importer
+
+from synthetic_im import write_im_file
+
+class TestClass:
+
+    @classmethod
+    def setup_class(cls):
+        cls.labels = ["16O", "17O", "18O"]
+        cls.test_data = np.random.randint(0, 200, size=(3, 6, 8, 5))
+        cls.directory = tempfile.mkdtemp()
+        cls.filename = os.path.join(cls.directory, "test.im")
+        write_im_file(cls.filename, cls.test_data, cls.labels)
+        cls.parameters = {"dead_time": 44e-9, "x_roll": 1, "y_roll": 1,
+                          "trim_front": 1, "trim_back": 2}
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.directory)
+
+    def make_cache(self):
+        return CubeCache(tempfile.mkdtemp(dir = self.directory))
+
+    def process_file(self, cache, filename=None, **kwargs):
+        parameters = dict(self.parameters, **kwargs)
+        test_importer = Importer()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            test_importer.process_file(filename or self.filename,
+                                       cache = cache, **parameters)
+        return test_importer
+
+    def test_process_file(self):
+        cache = self.make_cache()
+        reference = Importer()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            reference.import_file(self.filename)
+        reference.deadtime_correct_all(dead_time = 44e-9)
+        reference.roll_all(x_roll = 1, y_roll = 1)
+        reference.trim_front_all(1)
+        reference.trim_back_all(2)
+
+        first = self.process_file(cache)
+        assert_true(first.get_isotope("16O").is_loaded())
+        second = self.process_file(cache)
+        # Loaded from the cache, and only read when it is used
+        assert_false(second.get_isotope("16O").is_loaded())
+        for label in self.labels:
+            for test_importer in [first, second]:
+                assert_true(np.array_equal(
+                    test_importer.get_isotope(label).get_data(),
+                    reference.get_isotope(label).get_data()))
+
+    def test_process_file_lazy(self):
+        reference = self.process_file(None)
+        for cache in [None, self.make_cache()]:
+            # Corrected when used, or memory-mapped from the cache once
+            # stored on a miss
+            test_importer = self.process_file(cache, lazy = True)
+            assert_false(test_importer.get_isotope("16O").is_loaded())
+            for label in self.labels:
+                assert_true(np.array_equal(
+                    test_importer.get_isotope(label).get_data(),
+                    reference.get_isotope(label).get_data()))
+            if cache is not None:
+                second = self.process_file(cache, lazy = True)
+                assert_true(np.array_equal(
+                    second.get_isotope("16O").get_data(),
+                    reference.get_isotope("16O").get_data()))
+
+    @raises(RuntimeError)
+    def test_cached_deadtime(self):
+        cache = self.make_cache()
+        self.process_file(cache)
+        test_importer = self.process_file(cache)
+        test_importer.deadtime_correct_all(dead_time = 44e-9)
+
+    def test_keys(self):
+        cache = self.make_cache()
+        key = cache.key(self.filename, self.parameters)
+        assert_equal(key, cache.key(self.filename, self.parameters))
+        assert_not_equal(key, cache.key(self.filename,
+                                             dict(self.parameters, x_roll = 0)))
+
+        # A different file with the same parameters
+        other = os.path.join(self.directory, "other.im")
+        write_im_file(other, self.test_data + 1, self.labels)
+        assert_not_equal(key, cache.key(other, self.parameters))
+        test_importer = self.process_file(cache, other)
+        assert_true(test_importer.get_isotope("17O").is_loaded())
+
+    def test_eviction(self):
+        cache = self.make_cache()
+        self.process_file(cache)
+        entry_size = cache.size()
+        cache._max_size = 2*entry_size
+        self.process_file(cache, x_roll = 0)
+        self.process_file(cache)   # Marks the first entry as recently used
+        self.process_file(cache, y_roll = 0)
+        assert_true(cache.size() <= 2*entry_size)
+        assert_false(self.process_file(cache).get_isotope("16O").is_loaded())
+        assert_true(self.process_file(cache, x_roll = 0).get_isotope(
+            "16O").is_loaded())
+
+    def test_clear(self):
+        cache = self.make_cache()
+        self.process_file(cache)
+        cache.clear()
+        assert_equal(cache.size(), 0)
@@ -0,0 +1,67 @@
+from nose.tools import *
+import numpy as np
+import os
+import shutil
+import tempfile
+
+from nanosims_analysis.chunked import ChunkedFile, save_chunked
+from nanosims_analysis.data_structures import IsotopeData
+from nanosims_analysis.importer import Importer
+
+class TestClass:
+
+    @classmethod
+    def setup_class(cls):
+        # Sparse data, counts only in one corner of the image
+        cls.test_data = np.zeros((5, 8, 6), dtype=np.uint16)
+        cls.test_data[:3, :4, :3] = np.random.randint(1, 50, size=(3, 4, 3))
+        cls.directory = tempfile.mkdtemp()
+        cls.filename = os.path.join(cls.directory, "test.npz")
+
+        cls.importer = Importer()
+        cls.importer.add_isotope(IsotopeData("16O", cls.test_data,
+                                             dtype = "compact"))
+        cls.importer.add_isotope(IsotopeData("18O", cls.test_data // 2))
+        cls.importer.get_isotope("18O").perform_deadtime_correction(
+            dwell_time = 0.003, dead_time = 44e-9)
+        save_chunked(cls.filename, cls.importer, cycles_per_chunk = 2,
+                     tile_size = 4)
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_round_trip(self):
+        with ChunkedFile(self.filename) as chunked:
+            assert_equal(chunked.labels(), ["16O", "18O"])
+            test_importer = chunked.to_importer()
+        for label in ["16O", "18O"]:
+            isotope = test_importer.get_isotope(label)
+            reference = self.importer.get_isotope(label)
+            assert_equal(isotope.get_data().dtype, reference.get_data().dtype)
+            assert_true(np.array_equal(isotope.get_data(),
+                                       reference.get_data()))
+        assert_true(test_importer.get_isotope("18O")._is_deadtime_corrected)
+        assert_false(test_importer.get_isotope("16O")._is_deadtime_corrected)
+
+    def test_mask_and_sum(self):
+        reference = self.importer.get_isotope("16O")
+        with ChunkedFile(self.filename) as chunked:
+            O16 = chunked.get_isotope("16O")
+            for lower, upper in [(0, np.Inf), (10, 40), (-1, 100)]:
+                mask = O16.get_mask(lower = lower, upper = upper)
+                assert_true(np.array_equal(
+                    mask, reference.get_mask(lower = lower, upper = upper)))
+                assert_true(np.isclose(O16.sum(mask), reference.sum(mask)))
+            assert_true(np.isclose(O16.sum(), reference.sum()))
+
+            # 18 chunks, the mask and the sum only read the 2 holding counts
+            O16 = chunked.get_isotope("16O")
+            mask = O16.get_mask()
+            O16.sum(mask)
+            assert_equal(O16._chunks_read, 4)
+
+    @raises(RuntimeError)
+    def test_missing_isotope(self):
+        with ChunkedFile(self.filename) as chunked:
+            chunked.get_isotope("17O")
@@ -1,9 +1,13 @@
 from nose.tools import *
 import numpy as np
 import numpy.ma as ma
+import os
+import shutil
+import tempfile
 
 from nanosims_analysis.importer import Importer
-from nanosims_analysis.data_structures import IsotopeData
+from nanosims_analysis import data_structures, rendering
+from nanosims_analysis.data_structures import IsotopeData, Mask
 
 class TestClass:
 
@@ -195,3 +199,245 @@ class TestClass:
         assert_true(np.allclose(testIsotope.get_data(), self.dt_corrected))
         assert_true(ma.allclose(testIsotope.get_data(mask = y),
                                 ma.array(self.dt_corrected, mask = y)))
+
+    def test_deferred_corrections(self):
+        random_data = np.random.randint(0, 1000, size=(10, 6, 7))
+        testIsotope = IsotopeData("test", random_data)
+        testIsotope.trim_front(2)
+        testIsotope.roll_data(x_roll = 2, y_roll = -1)
+        testIsotope.perform_deadtime_correction(dwell_time = self.dwell_time,
+                                                dead_time = self.dead_time)
+        testIsotope.roll_data(x_roll = -1, y_roll = 3)
+        testIsotope.trim_back(3)
+        # Nothing has been applied yet
+        assert_true(testIsotope._cube is None)
+        assert_equal(testIsotope.n_cycles(), 5)
+
+        expected = np.roll(random_data[2:7].astype(float), [1, 2], axis = [1, 2])
+        count_rate = expected/self.dwell_time
+        expected = count_rate/(1 - count_rate*self.dead_time)*self.dwell_time
+        assert_true(np.allclose(testIsotope.get_data(), expected))
+        assert_true(testIsotope._cube is not None)
+
+    def test_deferred_corrections_in_place(self):
+        testIsotope = IsotopeData("test", self.test_data)
+        stored = testIsotope._data
+        testIsotope.roll_data(x_roll = 1)
+        testIsotope.perform_deadtime_correction(dwell_time = self.dwell_time,
+                                                dead_time = self.dead_time)
+        # Corrections reuse the memory of data that was never handed out
+        assert_true(testIsotope._data is stored)
+        assert_true(np.allclose(stored,
+                                np.roll(self.dt_corrected, 1, axis = 1)))
+
+    def test_deferred_corrections_copy(self):
+        testIsotope = IsotopeData("test", self.test_data)
+        raw = testIsotope.get_data()
+        testIsotope.roll_data(x_roll = 1)
+        testIsotope.perform_deadtime_correction(dwell_time = self.dwell_time,
+                                                dead_time = self.dead_time)
+        rolled = testIsotope.get_data()
+        testIsotope.correct_drift(np.ones((np.shape(raw)[0], 2)))
+        # Arrays returned earlier keep their values
+        assert_true(np.array_equal(raw, self.test_data))
+        assert_true(np.allclose(rolled,
+                                np.roll(self.dt_corrected, 1, axis = 1)))
+
+    def test_virtual_roll(self):
+        rolled = IsotopeData("rolled", self.test_data)
+        rolled.roll_data(x_roll = 1, y_roll = 2)
+        virtual = IsotopeData("virtual", self.test_data)
+        virtual.roll_data(x_roll = 1, y_roll = 2, virtual = True)
+        # Stored data is unchanged
+        assert_true(np.array_equal(virtual._data, self.test_data))
+
+        assert_true(np.array_equal(rolled.get_data(), virtual.get_data()))
+        mask = virtual.get_mask(lower = 0.1, upper = 0.7)
+        assert_true(np.array_equal(rolled.get_mask(lower = 0.1, upper = 0.7),
+                                   mask))
+        assert_true(np.isclose(rolled.sum(mask), virtual.sum(mask)))
+        assert_equal(rolled.n_pixels(mask), virtual.n_pixels(mask))
+        assert_true(np.array_equal(rolled < 0.5, virtual < 0.5))
+
+    def test_compact_dtype(self):
+        counts = np.random.randint(0, 200, size=(3, 4, 5))
+        testIsotope = IsotopeData("test", counts, dtype = "compact",
+                                  corrected_dtype = np.float32)
+        assert_equal(testIsotope.get_data().dtype, np.uint8)
+        testIsotope.roll_data(x_roll = 1)
+        assert_equal(testIsotope.get_data().dtype, np.uint8)
+        assert_equal(testIsotope.sum(), np.sum(counts))
+
+        reference = IsotopeData("reference", counts)
+        reference.roll_data(x_roll = 1)
+        for isotope in [testIsotope, reference]:
+            isotope.perform_deadtime_correction(dwell_time = self.dwell_time,
+                                                dead_time = self.dead_time)
+        assert_equal(testIsotope.get_data().dtype, np.float32)
+        assert_true(np.allclose(testIsotope.get_data(), reference.get_data()))
+        assert_equal(type(testIsotope.sum()), np.float64)
+        assert_true(np.isclose(testIsotope.sum(), reference.sum()))
+
+    def test_mask(self):
+        testIsotope = IsotopeData("test", self.test_data)
+        mask = testIsotope.get_mask(lower = 0.1, upper = 0.7)
+        assert_true(isinstance(mask, Mask))
+        assert_equal(mask.count(), 11)
+        assert_true(np.array_equal(np.sort(mask.indices()),
+                                   np.flatnonzero(~np.asarray(mask))))
+        # Plain array results, and plain masks still work
+        assert_equal(type(~mask), np.ndarray)
+        plain = np.array(mask)
+        assert_true(np.isclose(testIsotope.sum(mask), testIsotope.sum(plain)))
+        assert_true(np.isclose(testIsotope.std(mask), testIsotope.std(plain)))
+        assert_true(np.isclose(testIsotope.std(mask),
+                               np.std(self.test_data[~plain])))
+
+    def test_mask_edited(self):
+        testIsotope = IsotopeData("test", self.test_data)
+        mask = testIsotope.get_mask(lower = 0.1, upper = 0.7)
+        testIsotope.sum(mask)
+        mask[0] = True
+        other = testIsotope.get_mask(upper = 0.5)
+        mask |= other
+        # Indices and memoized reductions follow the changes
+        assert_true(isinstance(mask, Mask))
+        plain = np.array(mask)
+        assert_equal(mask.count(), np.sum(~plain))
+        assert_true(np.isclose(testIsotope.sum(mask),
+                               np.sum(self.test_data[~plain])))
+        mask[1:].fill(True)
+        assert_equal(mask.count(), 0)
+
+    def test_mask_memoized(self):
+        testIsotope = IsotopeData("test", self.test_data)
+        mask = testIsotope.get_mask(lower = 0.1, upper = 0.7)
+        total = testIsotope.sum(mask)
+        assert_true(testIsotope.sum(mask) is total)
+
+        # Reductions are recomputed once the data changes
+        testIsotope.roll_data(x_roll = 1)
+        assert_true(np.isclose(testIsotope.sum(mask),
+                               np.sum(np.roll(self.test_data, 1, axis = 1)[~mask])))
+        testIsotope.perform_deadtime_correction(dwell_time = self.dwell_time,
+                                                dead_time = self.dead_time)
+        expected = np.roll(self.dt_corrected, 1, axis = 1)
+        assert_true(np.isclose(testIsotope.sum(mask), np.sum(expected[~mask])))
+        assert_true(np.isclose(testIsotope.std(mask), np.std(expected[~mask])))
+
+    @raises(RuntimeError)
+    def test_mask_wrong_shape(self):
+        testIsotope = IsotopeData("test", self.test_data)
+        testIsotope.sum(Mask(np.zeros((2, 2, 2))))
+
+    def test_masked_moments_blocks(self):
+        # Blocks of a few values are combined to the full result
+        rows = [self.test_data.reshape(-1), 2*self.test_data.reshape(-1)]
+        indices = np.array([0, 2, 3, 5, 8, 9, 11, 14, 17])
+        block_size = data_structures.BLOCK_SIZE
+        data_structures.BLOCK_SIZE = 4
+        try:
+            sums, means, variances = data_structures._masked_moments(rows,
+                                                                     indices)
+        finally:
+            data_structures.BLOCK_SIZE = block_size
+        for i, row in enumerate(rows):
+            assert_true(np.isclose(sums[i], np.sum(row[indices])))
+            assert_true(np.isclose(means[i], np.mean(row[indices])))
+            assert_true(np.isclose(variances[i], np.var(row[indices])))
+
+    def test_render(self):
+        directory = tempfile.mkdtemp()
+        try:
+            testIsotope = IsotopeData("test", np.random.rand(5, 8, 6))
+            mask = testIsotope.get_mask(lower = 0.2)
+            for view in ["slices", "projection", "montage"]:
+                filename = os.path.join(directory, view + ".png")
+                testIsotope.render(filename, view = view, mask = mask,
+                                   downsample = 2)
+                with open(filename, "rb") as f:
+                    assert_equal(f.read(8), b"\x89PNG\r\n\x1a\n")
+        finally:
+            shutil.rmtree(directory)
+
+    @raises(RuntimeError)
+    def test_render_bad_view(self):
+        IsotopeData("test", self.test_data).render("test.png", view = "cube")
+
+    def test_montage(self):
+        data = np.arange(5*2*3, dtype = float).reshape(5, 2, 3)
+        montage = rendering._montage(data, 2)
+        assert_equal(montage.shape, (6, 6))
+        assert_true(np.array_equal(montage[2:4, 3:6], data[3]))
+        assert_true(np.all(np.isnan(montage[4:6, 3:6])))
+        downsampled = rendering._downsample(data, 2)
+        assert_equal(downsampled.shape, (5, 1, 1))
+        assert_equal(downsampled[1, 0, 0], np.mean(data[1, :2, :2]))
+
+    def test_binned(self):
+        data = np.random.randint(0, 10, size=(5, 6, 7))
+        testIsotope = IsotopeData("test", data, dtype = "compact")
+        binned = testIsotope.binned(n = 2, k = 2)
+        assert_equal(binned.get_data().shape, (2, 3, 3))
+        assert_equal(binned.get_data()[1, 2, 0], np.sum(data[2:4, 4:6, 0:2]))
+        assert_equal(binned.get_data().dtype, np.int64)
+        assert_equal(binned.get_label(), "test")
+        assert_true(testIsotope.binned(n = 2, k = 2) is binned)
+        assert_true(testIsotope.binned() is testIsotope)
+
+        # Cache is dropped when the data changes
+        testIsotope.trim_front(1)
+        assert_equal(testIsotope.binned(n = 2, k = 2).get_data()[0, 0, 0],
+                     np.sum(data[1:3, 0:2, 0:2]))
+
+    def test_pyramid(self):
+        data = np.random.rand(3, 8, 8)
+        testIsotope = IsotopeData("test", data)
+        testIsotope.perform_deadtime_correction(dwell_time = self.dwell_time,
+                                                dead_time = self.dead_time)
+        pyramid = testIsotope.pyramid(levels = 4)
+        assert_equal([level.get_data().shape for level in pyramid],
+                     [(3, 8, 8), (3, 4, 4), (3, 2, 2), (3, 1, 1)])
+        assert_true(np.allclose(pyramid[3].get_data()[:, 0, 0],
+                                np.sum(testIsotope.get_data(), axis = (1, 2))))
+        assert_true(pyramid[2] is testIsotope.pyramid(levels = 3)[2])
+        assert_true(pyramid[3]._is_deadtime_corrected)
+
+    @raises(RuntimeError)
+    def test_bad_bin(self):
+        IsotopeData("test", self.test_data).binned(n = 0)
+
+    def test_label_regions(self):
+        mask = np.ones((2, 4, 4), dtype = bool)
+        mask[:, 0, 0:2] = False
+        mask[0, 2:4, 3] = False
+        labels, n_regions = data_structures.label_regions(mask)
+        assert_equal(n_regions, 2)
+        assert_true(np.array_equal(labels == 0, mask))
+        assert_equal(len(np.unique(labels[:, 0, 0:2])), 1)
+
+        # Regions of pixels, the same in every cycle
+        labels, n_regions = data_structures.label_regions(mask.all(axis = 0))
+        assert_equal(labels.shape, (4, 4))
+        assert_equal(n_regions, 2)
+
+    def test_region_statistics(self):
+        testIsotope = IsotopeData("test", self.test_data)
+        testIsotope.roll_data(x_roll = 1, virtual = True)
+        data = testIsotope.get_data()
+        for labels in [np.array([[0, 1, 1], [2, 2, 0], [3, 0, 3]]),
+                       np.arange(18).reshape(2, 3, 3) % 4]:
+            statistics = testIsotope.region_statistics(labels)
+            full_labels = np.broadcast_to(labels, data.shape)
+            for region in range(4):
+                selected = full_labels == region
+                assert_equal(statistics["pixels"][region], selected.sum())
+                assert_true(np.isclose(statistics["sum"][region],
+                                       data[selected].sum()))
+                assert_true(np.isclose(statistics["mean"][region],
+                                       data[selected].mean()))
+
+    @raises(RuntimeError)
+    def test_region_statistics_wrong_shape(self):
+        testIsotope = IsotopeData("test", self.test_data)
+        testIsotope.region_statistics(np.zeros((2, 2), dtype = int))
@@ -0,0 +1,508 @@
+from nose.tools import *
+import numpy as np
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import warnings
+
+import sims
+
+from nanosims_analysis import data_structures
+from nanosims_analysis.data_structures import RatioData
+from nanosims_analysis.importer import Importer, ImReader, combine_statistics
+
+from synthetic_im import write_im_file
+
+# Budget for importing the importer in a fresh interpreter, e.g. a worker
+# process, in seconds, see benchmarks/import_benchmark.py
+IMPORT_TIME_BUDGET = 0.5
+
+class TestClass:
+
+    @classmethod
+    def setup_class(cls):
+        cls.labels = ["16O", "17O", "18O", "28Si"]
+        cls.test_data = np.random.randint(0, 200, size=(4, 6, 8, 5))
+        cls.time_per_pixel = 0.003
+        cls.directory = tempfile.mkdtemp()
+        cls.filename = os.path.join(cls.directory, "test.im")
+        write_im_file(cls.filename, cls.test_data, cls.labels,
+                      cls.time_per_pixel)
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.directory)
+
+    def import_file(self, **kwargs):
+        test_importer = Importer()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            test_importer.import_file(self.filename, **kwargs)
+        return test_importer
+
+    @raises(RuntimeError)
+    def test_bad_filename(self):
+        Importer().import_file(os.path.join(self.directory, "missing.im"))
+
+    def test_import(self):
+        test_importer = self.import_file()
+        for i, label in enumerate(self.labels):
+            assert_true(np.array_equal(
+                test_importer.get_isotope(label).get_data(),
+                self.test_data[i]))
+
+    def test_sims_reader(self):
+        native = self.import_file(reader = "native")
+        sims_importer = self.import_file(reader = "sims")
+        for label in self.labels:
+            assert_true(np.array_equal(
+                native.get_isotope(label).get_data(),
+                sims_importer.get_isotope(label).get_data()))
+
+    def test_im_reader_header(self):
+        reader = ImReader(self.filename)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            sims_object = sims.SIMS(self.filename)
+        assert_equal(reader.labels(), list(sims_object.header["label list"]))
+        assert_equal(reader.shape(), (6, 8, 5))
+        assert_true(np.isclose(
+            reader.time_per_pixel(),
+            sims_object.header["BFields"][0]["time per pixel"]))
+        for key in ["width", "height", "bytes per pixel", "masses", "planes"]:
+            assert_equal(reader.header["Image"][key],
+                         sims_object.header["Image"][key])
+
+    def test_im_reader_header_only(self):
+        # Header can be read without any image data in the file
+        truncated = os.path.join(self.directory, "truncated.im")
+        header_size = ImReader(self.filename).header["header size"]
+        with open(self.filename, "rb") as f, open(truncated, "wb") as g:
+            g.write(f.read(header_size))
+        assert_equal(ImReader(truncated).labels(), self.labels)
+
+    def test_im_reader_read_data(self):
+        data = ImReader(self.filename).read_data(labels = ["17O", "28Si"])
+        assert_equal(sorted(data.keys()), ["17O", "28Si"])
+        assert_true(np.array_equal(data["17O"], self.test_data[1]))
+        assert_true(np.array_equal(data["28Si"], self.test_data[3]))
+
+    @raises(RuntimeError)
+    def test_im_reader_bad_label(self):
+        ImReader(self.filename).read_data(labels = ["12C"])
+
+    def test_lazy_import(self):
+        test_importer = self.import_file(lazy = True)
+        for label in self.labels:
+            assert_false(test_importer.get_isotope(label).is_loaded())
+
+        O17 = test_importer.get_isotope("17O")
+        assert_equal(O17.n_cycles(), 6)
+        assert_false(O17.is_loaded())
+        assert_true(np.array_equal(O17.get_data(), self.test_data[1]))
+        assert_true(O17.is_loaded())
+        assert_false(test_importer.get_isotope("28Si").is_loaded())
+
+    def test_lazy_trim(self):
+        test_importer = self.import_file(lazy = True)
+        test_importer.trim_front_all(2)
+        test_importer.trim_back_all(1)
+        O16 = test_importer.get_isotope("16O")
+        assert_false(O16.is_loaded())
+        assert_true(np.array_equal(O16.get_data(), self.test_data[0, 2:5]))
+
+    def test_lazy_deadtime(self):
+        dead_time = 44e-9
+        eager = self.import_file()
+        eager.deadtime_correct_all(dead_time = dead_time)
+        lazy = self.import_file(lazy = True)
+        lazy.deadtime_correct_all(dead_time = dead_time)
+        for label in self.labels:
+            assert_true(np.allclose(eager.get_isotope(label).get_data(),
+                                    lazy.get_isotope(label).get_data()))
+
+    def test_lazy_corrections_not_read(self):
+        test_importer = self.import_file(lazy = True)
+        test_importer.deadtime_correct_all(dead_time = 44e-9)
+        test_importer.roll_all(x_roll = 1, y_roll = 1)
+        for label in self.labels:
+            assert_false(test_importer.get_isotope(label).is_loaded())
+
+        eager = self.import_file()
+        eager.deadtime_correct_all(dead_time = 44e-9)
+        eager.roll_all(x_roll = 1, y_roll = 1)
+        assert_true(np.allclose(eager.get_isotope("18O").get_data(),
+                                test_importer.get_isotope("18O").get_data()))
+
+    def test_stacked_corrections(self):
+        stacked = self.import_file(stacked = True)
+        unstacked = self.import_file()
+        raw = stacked.get_isotope("16O").get_data()
+        for test_importer in [stacked, unstacked]:
+            test_importer.deadtime_correct_all(dead_time = 44e-9)
+            test_importer.roll_all(x_roll = 1, y_roll = -2)
+            test_importer.trim_front_all(1)
+            test_importer.trim_back_all(2)
+        assert_true(stacked._is_stacked())
+        for label in self.labels:
+            assert_true(np.array_equal(stacked.get_isotope(label).get_data(),
+                                       unstacked.get_isotope(label).get_data()))
+            assert_true(np.shares_memory(stacked.get_isotope(label).get_data(),
+                                         stacked._stack))
+        # The stack is copied before it is corrected in place
+        assert_true(np.array_equal(raw, self.test_data[0]))
+
+    def test_stacked_trim_exported(self):
+        test_importer = self.import_file(stacked = True)
+        raw = test_importer.get_isotope("16O").get_data()
+        test_importer.trim_front_all(1)
+        test_importer.trim_back_all(1)
+        test_importer.roll_all(x_roll = 1, y_roll = -2)
+        test_importer.deadtime_correct_all(dead_time = 44e-9)
+        assert_true(test_importer._is_stacked())
+        # Data returned before the trims is unchanged by the corrections
+        assert_true(np.array_equal(raw, self.test_data[0]))
+
+    def test_stack_virtual_roll(self):
+        stacked = self.import_file()
+        unstacked = self.import_file()
+        for test_importer in [stacked, unstacked]:
+            test_importer.roll_all(x_roll = 1, y_roll = 2, virtual = True)
+        raw = stacked.get_isotope("16O").get_data()
+        stacked.stack_isotopes()
+        stacked.deadtime_correct_all(dead_time = 44e-9)
+        unstacked.deadtime_correct_all(dead_time = 44e-9)
+        # Rolled once, and still stacked with a virtual roll
+        assert_true(stacked._is_stacked())
+        for label in self.labels:
+            assert_true(np.array_equal(stacked.get_isotope(label).get_data(),
+                                       unstacked.get_isotope(label).get_data()))
+        # Data returned before the stack was corrected is unchanged
+        assert_true(np.array_equal(raw, np.roll(self.test_data[0], (1, 2),
+                                                axis = (1, 2))))
+
+    def test_stack_dropped(self):
+        test_importer = self.import_file(stacked = True)
+        test_importer.get_isotope("16O").trim_front(1)
+        assert_false(test_importer._is_stacked())
+        # Falls back to correcting each isotope
+        test_importer.trim_back_all(1)
+        assert_equal(test_importer.get_isotope("16O").n_cycles(), 4)
+        assert_equal(test_importer.get_isotope("17O").n_cycles(), 5)
+
+    @raises(RuntimeError)
+    def test_stacked_double_deadtime(self):
+        test_importer = self.import_file(stacked = True)
+        test_importer.deadtime_correct_all(dead_time = 44e-9)
+        test_importer.deadtime_correct_all(dead_time = 44e-9)
+
+    def test_compact_import(self):
+        for stacked in [False, True]:
+            test_importer = Importer(dtype = "compact",
+                                     corrected_dtype = np.float32)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                test_importer.import_file(self.filename, stacked = stacked)
+            O16 = test_importer.get_isotope("16O")
+            assert_true(O16.get_data().dtype in [np.uint8, np.uint16])
+            test_importer.deadtime_correct_all(dead_time = 44e-9)
+            assert_equal(O16.get_data().dtype, np.float32)
+
+            reference = self.import_file()
+            reference.deadtime_correct_all(dead_time = 44e-9)
+            assert_true(np.allclose(O16.get_data(),
+                                    reference.get_isotope("16O").get_data()))
+
+    def test_stacked_mask_invalidated(self):
+        test_importer = self.import_file(stacked = True)
+        O16 = test_importer.get_isotope("16O")
+        mask = O16.get_mask(lower = 50)
+        O16.sum(mask)
+        test_importer.roll_all(x_roll = 1)
+        assert_true(np.isclose(
+            O16.sum(mask),
+            np.sum(np.roll(self.test_data[0], 1, axis = 1)[~mask])))
+
+    def test_masked_statistics(self):
+        for stacked in [False, True]:
+            test_importer = self.import_file(stacked = stacked)
+            test_importer.roll_all(x_roll = 1, y_roll = 2, virtual = True)
+            test_importer.get_isotope("28Si").roll_data(x_roll = 1,
+                                                        virtual = True)
+            O16 = test_importer.get_isotope("16O")
+            mask = O16.get_mask(lower = 50)
+            statistics = test_importer.masked_statistics(
+                mask, ["16O", "18O", "28Si"])
+            assert_equal(list(statistics), ["16O", "18O", "28Si"])
+            for label, values in statistics.items():
+                isotope = test_importer.get_isotope(label)
+                assert_equal(values["count"], O16.n_pixels(mask))
+                assert_true(np.isclose(values["sum"], isotope.sum(mask)))
+                assert_true(np.isclose(values["mean"],
+                                       isotope.sum(mask)/O16.n_pixels(mask)))
+                assert_true(np.isclose(values["std"], isotope.std(mask)))
+
+        # Plain bool masks and all isotopes
+        plain = np.array(mask)
+        statistics = test_importer.masked_statistics(plain)
+        assert_equal(sorted(statistics), sorted(self.labels))
+        assert_true(np.isclose(statistics["17O"]["std"],
+                               test_importer.get_isotope("17O").std(plain)))
+
+    @raises(RuntimeError)
+    def test_masked_statistics_wrong_shape(self):
+        test_importer = self.import_file()
+        test_importer.masked_statistics(np.zeros((2, 2, 2), dtype = bool))
+
+    def test_ratio_statistics(self):
+        test_importer = self.import_file()
+        test_importer.get_isotope("28Si").roll_data(x_roll = 1, y_roll = 3,
+                                                    virtual = True)
+        O16 = test_importer.get_isotope("16O")
+        mask = O16.get_mask(lower = 50)
+        pixels = O16.n_pixels(mask)
+        statistics = test_importer.ratio_statistics(
+            [("17O", "16O", 0.00038288), ("28Si", "16O")], mask,
+            primary_current = 2.5, dwell_time = 3000)
+        assert_equal(list(statistics["label"]), ["17O/16O", "28Si/16O"])
+        assert_equal(statistics["pixels"][0], pixels)
+
+        for record, standard in zip(statistics, [0.00038288, None]):
+            numerator, denominator = record["label"].split("/")
+            N = test_importer.get_isotope(numerator).sum(mask)
+            D = O16.sum(mask)
+            ratio = RatioData(record["label"],
+                              test_importer.get_isotope(numerator), O16)
+            K = D / (2.5 * 6.2415*10**6 * 3000 * pixels)
+            R = N/D / (1 + 0.5*K)
+            sigR = R * np.sqrt((np.sqrt(N)/N)**2 + (np.sqrt(D)/D)**2)
+            sig = ratio.std(mask) / np.sqrt(pixels)
+            assert_true(np.isclose(record["ratio"], R))
+            assert_true(np.isclose(record["ratio_sigma"], sigR))
+            assert_true(np.isclose(record["std"], ratio.std(mask)))
+            assert_true(np.isclose(record["standard_error"], sig))
+            assert_true(np.isclose(record["combined_sigma"],
+                                   np.sqrt(sig**2 + sigR**2)))
+            if standard is None:
+                assert_true(np.isnan(record["delta"]))
+                continue
+            assert_true(np.isclose(record["delta"], (R/standard - 1)*1000))
+            assert_true(np.isclose(record["delta_std"],
+                                   ratio.delta_statistics(standard,
+                                                          mask)["std"]))
+            assert_true(np.isclose(record["delta_2sigma"],
+                                   2*sig/standard*1000))
+
+    def test_region_statistics(self):
+        test_importer = self.import_file()
+        test_importer.get_isotope("28Si").roll_data(y_roll = 2, virtual = True)
+        O16 = test_importer.get_isotope("16O")
+        regions = np.random.randint(0, 5, size = O16.get_data().shape[1:])
+        statistics = test_importer.region_statistics(
+            regions, ["16O", "28Si"], ratios = [("18O", "16O", 0.0020052)])
+        assert_equal(list(statistics["region"]), [1, 2, 3, 4])
+        for record in statistics:
+            mask = np.broadcast_to(regions != record["region"],
+                                   O16.get_data().shape)
+            assert_equal(record["pixels"], O16.n_pixels(mask))
+            for label in ["16O", "18O", "28Si"]:
+                assert_true(np.isclose(
+                    record[label], test_importer.get_isotope(label).sum(mask)))
+            ratio = record["18O"] / record["16O"]
+            assert_true(np.isclose(record["18O/16O"], ratio))
+            assert_true(np.isclose(record["delta 18O/16O"],
+                                   (ratio/0.0020052 - 1)*1000))
+
+    def test_iter_file(self):
+        dead_time = 44e-9
+        reference = self.import_file()
+        reference.deadtime_correct_all(dead_time = dead_time)
+        reference.trim_front_all(1)
+        mask = reference.get_isotope("16O").get_mask(lower = 50)
+        expected = reference.masked_statistics(mask, ["16O", "18O"])
+
+        statistics = None
+        n_cycles = 0
+        for block in Importer().iter_file(self.filename, cycles_per_block = 2,
+                                          labels = ["16O", "18O"], start = 1):
+            assert_equal(sorted(block._isotopes), ["16O", "18O"])
+            block.deadtime_correct_all(dead_time = dead_time)
+            O16 = block.get_isotope("16O")
+            block_mask = O16.get_mask(lower = 50)
+            assert_true(np.array_equal(
+                block_mask, mask[n_cycles:n_cycles + O16.n_cycles()]))
+            n_cycles += O16.n_cycles()
+            statistics = combine_statistics(
+                statistics, block.masked_statistics(block_mask))
+        assert_equal(n_cycles, 5)
+        for label in ["16O", "18O"]:
+            assert_equal(statistics[label]["count"], expected[label]["count"])
+            for key in ["sum", "mean", "std"]:
+                assert_true(np.isclose(statistics[label][key],
+                                       expected[label][key]))
+
+    def test_im_reader_read_planes(self):
+        data = ImReader(self.filename).read_data(labels = ["18O"], start = 2,
+                                                 stop = 5)
+        assert_true(np.array_equal(data["18O"], self.test_data[2, 2:5]))
+
+    def test_to_VTK(self):
+        from pyevtk.hl import gridToVTK
+        test_importer = self.import_file()
+        test_importer.deadtime_correct_all(dead_time = 44e-9)
+        O16 = test_importer.get_isotope("16O")
+        mask = O16.get_mask(lower = 50)
+        ratio = RatioData("18O to 16O", test_importer.get_isotope("18O"), O16,
+                          lazy = True)
+        written = test_importer.to_VTK(os.path.join(self.directory, "fields"),
+                                       labels = ["16O", "17O"],
+                                       ratios = [ratio], x_roll = 1,
+                                       mask = mask)
+
+        # Same file as gridToVTK writes
+        cell_data = {}
+        for label, data in [("16O", O16.get_data()),
+                            ("17O", test_importer.get_isotope("17O").get_data()),
+                            ("18O to 16O", ratio.get_data())]:
+            data = np.roll(data, 1, axis = 1)
+            data[np.roll(mask, 1, axis = 1)] = -1
+            cell_data[label] = np.ascontiguousarray(np.swapaxes(data, 0, 2))
+        nx, ny, nz = np.shape(cell_data["16O"])
+        expected = gridToVTK(os.path.join(self.directory, "expected"),
+                             np.arange(nx + 1, dtype = 'float64'),
+                             np.arange(ny + 1, dtype = 'float64'),
+                             np.arange(nz + 1, dtype = 'float64'),
+                             cellData = cell_data)
+        with open(written, "rb") as f, open(expected, "rb") as g:
+            assert_equal(f.read(), g.read())
+
+    def test_to_VTK_compact_mask(self):
+        from pyevtk.hl import gridToVTK
+        test_importer = Importer(dtype = "compact")
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            test_importer.import_file(self.filename)
+        O16 = test_importer.get_isotope("16O")
+        assert_true(O16.get_data().dtype.kind == "u")
+        mask = O16.get_mask(lower = 50)
+        for pieces in [1, 2]:
+            filename = os.path.join(self.directory, "compact_" + str(pieces))
+            written = test_importer.to_VTK(filename, labels = ["16O"],
+                                           mask = mask, pieces = pieces,
+                                           processes = 1)
+            if pieces > 1:
+                with open(written) as f:
+                    # Signed, so that masked values are -1
+                    assert_true('type="Int16"' in f.read())
+                continue
+            data = O16.get_data().astype(np.int16)
+            data[mask] = -1
+            cell_data = {"16O": np.ascontiguousarray(np.swapaxes(data, 0, 2))}
+            nx, ny, nz = np.shape(cell_data["16O"])
+            expected = gridToVTK(os.path.join(self.directory, "expected"),
+                                 np.arange(nx + 1, dtype = 'float64'),
+                                 np.arange(ny + 1, dtype = 'float64'),
+                                 np.arange(nz + 1, dtype = 'float64'),
+                                 cellData = cell_data)
+            with open(written, "rb") as f, open(expected, "rb") as g:
+                assert_equal(f.read(), g.read())
+
+    def test_to_VTK_pieces(self):
+        from pyevtk.hl import gridToVTK
+        test_importer = self.import_file()
+        O16 = test_importer.get_isotope("16O")
+        mask = O16.get_mask(lower = 50)
+        filename = os.path.join(self.directory, "pieces")
+        written = test_importer.to_VTK(filename, labels = ["16O", "28Si"],
+                                       y_roll = 1, mask = mask, pieces = 3,
+                                       processes = 2)
+        assert_equal(written, filename + ".pvtr")
+        with open(written) as f:
+            master = f.read()
+        assert_true('Source="pieces_0.vtr"' in master)
+        assert_true('Name="28Si"' in master)
+
+        # Pieces of 2 cycles each, as gridToVTK writes them
+        for i in range(3):
+            cell_data = {}
+            for label in ["16O", "28Si"]:
+                data = np.roll(test_importer.get_isotope(label).get_data(),
+                               1, axis = 2)
+                data[np.roll(mask, 1, axis = 2)] = -1
+                cell_data[label] = np.ascontiguousarray(
+                    np.swapaxes(data[2*i:2*i + 2], 0, 2))
+            expected = gridToVTK(os.path.join(self.directory, "expected"),
+                                 np.arange(6, dtype = 'float64'),
+                                 np.arange(9, dtype = 'float64'),
+                                 np.arange(2*i, 2*i + 3, dtype = 'float64'),
+                                 cellData = cell_data, start = (0, 0, 2*i))
+            with open(filename + "_" + str(i) + ".vtr", "rb") as f, \
+                 open(expected, "rb") as g:
+                assert_equal(f.read(), g.read())
+
+    def test_shared_executor(self):
+        # Importers with the same number of workers reuse one thread pool
+        importers = [Importer(workers = 3) for i in range(10)]
+        assert_true(importers[0]._executor is not None)
+        for test_importer in importers:
+            assert_true(test_importer._executor is importers[0]._executor)
+        assert_true(Importer(workers = 2)._executor is not
+                    importers[0]._executor)
+        assert_true(Importer(workers = 1)._executor is None)
+
+    def test_workers(self):
+        # Blocks of a single cycle, so single isotopes are split as well
+        block_size = data_structures.BLOCK_SIZE
+        data_structures.BLOCK_SIZE = 8
+        try:
+            results = []
+            for workers in [1, 3]:
+                for stacked in [False, True]:
+                    test_importer = Importer(workers = workers)
+                    with warnings.catch_warnings():
+                        warnings.simplefilter("ignore")
+                        test_importer.import_file(self.filename,
+                                                  stacked = stacked)
+                    test_importer.deadtime_correct_all(dead_time = 44e-9)
+                    test_importer.roll_all(x_roll = 1, y_roll = 2)
+                    O16 = test_importer.get_isotope("16O")
+                    mask = O16.get_mask(lower = 50)
+                    results.append((
+                        {label: isotope.get_data() for label, isotope in
+                         test_importer._isotopes.items()},
+                        np.array(mask),
+                        test_importer.sum_all(mask),
+                        test_importer.masked_statistics(mask),
+                        test_importer.ratio_statistics([("18O", "16O")],
+                                                       mask)))
+            for data, mask, sums, statistics, ratios in results[1:]:
+                for label in self.labels:
+                    assert_true(np.array_equal(data[label],
+                                               results[0][0][label]))
+                    assert_equal(sums[label], results[0][2][label])
+                    assert_equal(statistics[label], results[0][3][label])
+                assert_true(np.array_equal(mask, results[0][1]))
+                assert_equal(ratios["std"][0], results[0][4]["std"][0])
+        finally:
+            data_structures.BLOCK_SIZE = block_size
+
+    def test_import_time(self):
+        script = ("import sys, time\n"
+                  "start = time.perf_counter()\n"
+                  "import nanosims_analysis.importer\n"
+                  "print(time.perf_counter() - start)\n"
+                  "print([name for name in ('matplotlib', 'pyevtk', 'sims') "
+                  "if name in sys.modules])")
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        times = []
+        for n in range(3):
+            output = subprocess.run(
+                [sys.executable, "-c", script], capture_output = True,
+                text = True, check = True,
+                env = dict(os.environ, PYTHONPATH = root)).stdout.split("\n")
+            times.append(float(output[0]))
+            # Plotting, VTK and sims dependencies are loaded on first use
+            assert_equal(output[1], "[]")
+        assert_less(min(times), IMPORT_TIME_BUDGET)
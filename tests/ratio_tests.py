@@ -2,6 +2,7 @@ from nose.tools import *
 import numpy as np
 
 from nanosims_analysis.importer import Importer
+from nanosims_analysis import data_structures
 from nanosims_analysis.data_structures import IsotopeData
 from nanosims_analysis.data_structures import RatioData
 
@@ -48,3 +49,202 @@ class TestClass:
                               self.numerator_isotope,
                               self.denominator_isotope)
         testRatio.perform_deadtime_correction(2.0, 3.0)
+
+    def test_ratio_dtype(self):
+        testRatio = RatioData("test_ratio",
+                              self.numerator_isotope,
+                              self.denominator_isotope,
+                              dtype = np.float32)
+        reference = RatioData("test_ratio",
+                              self.numerator_isotope,
+                              self.denominator_isotope)
+        assert_equal(testRatio.get_data().dtype, np.float32)
+        assert_true(np.allclose(testRatio.get_data(), reference.get_data()))
+        testRatio.roll_data(x_roll = 1)
+        assert_true(np.allclose(testRatio.get_data(),
+                                np.roll(reference.get_data(), 1, axis = 1)))
+
+    def test_lazy_ratio(self):
+        reference = RatioData("test_ratio",
+                              self.numerator_isotope,
+                              self.denominator_isotope)
+        testRatio = RatioData("test_ratio",
+                              self.numerator_isotope,
+                              self.denominator_isotope,
+                              lazy = True)
+        mask = self.denominator_isotope.get_mask(lower = 100)
+        for test_mask in [None, mask, np.array(mask)]:
+            assert_true(np.isclose(testRatio.sum(test_mask),
+                                   reference.sum(test_mask)))
+            assert_true(np.isclose(testRatio.mean(test_mask),
+                                   reference.mean(test_mask)))
+            assert_true(np.isclose(testRatio.std(test_mask),
+                                   reference.std(test_mask)))
+        delta = testRatio.delta_statistics(0.5, mask)
+        delta_values = (reference.get_data(mask)/0.5 - 1)*1000
+        assert_true(np.isclose(delta["mean"], np.mean(delta_values)))
+        assert_true(np.isclose(delta["std"], np.std(delta_values)))
+        assert_false(testRatio.is_loaded())
+
+        assert_true(np.array_equal(testRatio.get_data(), reference.get_data()))
+        assert_true(testRatio.is_loaded())
+
+    def test_lazy_ratio_corrections(self):
+        # Blocks of a single cycle, trims, rolls and virtual rolls are
+        # streamed as well
+        block_size = data_structures.BLOCK_SIZE
+        data_structures.BLOCK_SIZE = 1
+        try:
+            numerator = IsotopeData("numerator",
+                                    self.numerator_isotope.get_data())
+            numerator.roll_data(y_roll = 1, virtual = True)
+            testRatio = RatioData("test_ratio", numerator,
+                                  self.denominator_isotope, lazy = True,
+                                  cache_size = 1000)
+            reference = RatioData("test_ratio", numerator,
+                                  self.denominator_isotope)
+            for ratio in [testRatio, reference]:
+                ratio.trim_front(1)
+                ratio.roll_data(x_roll = 1)
+                ratio.roll_data(x_roll = 1, virtual = True)
+            mask = reference.get_mask(lower = 0.5)
+            assert_true(np.isclose(testRatio.std(mask), reference.std(mask)))
+            assert_true(np.isclose(testRatio.sum(), reference.sum()))
+            assert_false(testRatio.is_loaded())
+            assert_true(np.array_equal(testRatio.get_data(),
+                                       reference.get_data()))
+        finally:
+            data_structures.BLOCK_SIZE = block_size
+
+    def test_lazy_ratio_snapshot(self):
+        numerator = IsotopeData("numerator", self.numerator_isotope.get_data())
+        denominator = IsotopeData("denominator",
+                                  self.denominator_isotope.get_data())
+        testRatio = RatioData("test_ratio", numerator, denominator,
+                              lazy = True)
+        reference = RatioData("test_ratio", self.numerator_isotope,
+                              self.denominator_isotope)
+        # Corrections of the isotopes after the ratio is made do not change it
+        numerator.perform_deadtime_correction(dwell_time = 0.001,
+                                              dead_time = 44e-9)
+        denominator.roll_data(x_roll = 1)
+        numerator.correct_drift(np.ones((2, 2)))
+        assert_true(np.isclose(testRatio.sum(), reference.sum()))
+        assert_true(np.array_equal(testRatio.get_data(), reference.get_data()))
+
+    def test_ratio_binned(self):
+        testRatio = RatioData("test_ratio",
+                              self.numerator_isotope,
+                              self.denominator_isotope)
+        binned = testRatio.binned(n = 2, k = 2)
+        assert_true(isinstance(binned, RatioData))
+        assert_true(np.isclose(binned.get_data()[0, 0, 0],
+                               np.mean(testRatio.get_data()[:, :2, :2])))
+
+        # Ratio of binned counts
+        counts = RatioData("test_ratio",
+                           self.numerator_isotope.binned(n = 2),
+                           self.denominator_isotope.binned(n = 2))
+        assert_true(np.isclose(
+            counts.get_data()[1, 0, 0],
+            np.sum(self.numerator_isotope.get_data()[1, :2, :2]) /
+            np.sum(self.denominator_isotope.get_data()[1, :2, :2])))
+
+    def test_ratio_qsa(self):
+        testRatio = RatioData("test_ratio",
+                              self.numerator_isotope,
+                              self.denominator_isotope)
+        returned = testRatio.get_data()
+        ratio = returned.copy()
+        counts = self.denominator_isotope.get_data()
+        testRatio.perform_qsa_correction(self.denominator_isotope, 2.5,
+                                         dwell_time = 3000, beta = 0.75)
+        ans = ratio / (1 + 0.75*(counts / (2.5*6.2415*10**6*3000)))
+        assert_true(np.array_equal(testRatio.get_data(), ans))
+        # The array returned before the correction is unchanged
+        assert_true(np.array_equal(returned, ratio))
+        assert_raises(RuntimeError, testRatio.perform_qsa_correction,
+                      self.denominator_isotope, 2.5, 3000)
+
+    def test_ratio_qsa_binned(self):
+        numerator = IsotopeData("17O", self.numerator_isotope.get_data())
+        denominator = IsotopeData("16O", self.denominator_isotope.get_data())
+        for isotope in [numerator, denominator]:
+            isotope.perform_deadtime_correction(dwell_time = 3000,
+                                                dead_time = 44e-9)
+        counts = denominator.binned(n = 2, k = 2)
+        testRatio = RatioData("test_ratio", numerator.binned(n = 2, k = 2),
+                              counts)
+        ratio = testRatio.get_data().copy()
+        testRatio.perform_qsa_correction(counts, 2.5)
+        # Each binned count is summed over 2*2*2 dwell times
+        ans = ratio / (1 + 0.75*(counts.get_data() /
+                                 (2.5*6.2415*10**6*3000*8)))
+        assert_true(np.array_equal(testRatio.get_data(), ans))
+        assert_equal(denominator._dwell_time, 3000)
+
+    def test_ratio_qsa_beta(self):
+        assert_equal(data_structures.qsa_beta("17O", "16O"), 0.75)
+        assert_equal(data_structures.qsa_beta("12C", "13C"), 1)
+        assert_equal(data_structures.qsa_beta("28Si", "30Si"), 0.6)
+        assert_equal(data_structures.qsa_beta("numerator", "denominator"),
+                     0.5)
+        testRatio = RatioData("test_ratio",
+                              self.numerator_isotope,
+                              self.denominator_isotope)
+        ratio = testRatio.get_data().copy()
+        counts = self.denominator_isotope.get_data()
+        testRatio.perform_qsa_correction(self.denominator_isotope, 2.5,
+                                         dwell_time = 3000)
+        ans = ratio / (1 + 0.5*(counts / (2.5*6.2415*10**6*3000)))
+        assert_true(np.array_equal(testRatio.get_data(), ans))
+
+    @raises(RuntimeError)
+    def test_ratio_qsa_dwell_time(self):
+        testRatio = RatioData("test_ratio",
+                              self.numerator_isotope,
+                              self.denominator_isotope)
+        testRatio.perform_qsa_correction(self.denominator_isotope, 2.5)
+
+    def test_corrected_ratio(self):
+        # Blocks of a single cycle, with a virtual roll on the numerator
+        block_size = data_structures.BLOCK_SIZE
+        data_structures.BLOCK_SIZE = 1
+        try:
+            for dtype in [float, np.float32]:
+                numerator = IsotopeData("17O",
+                                        self.numerator_isotope.get_data())
+                denominator = IsotopeData("16O",
+                                          self.denominator_isotope.get_data())
+                numerator.roll_data(y_roll = 1, virtual = True)
+                fused = data_structures.corrected_ratio(
+                    "test_ratio", numerator, denominator, dwell_time = 3000,
+                    dead_time = 44, primary_current = 2.5, dtype = dtype)
+                delta = data_structures.corrected_ratio(
+                    "test_delta", numerator, denominator, dwell_time = 3000,
+                    dead_time = 44, primary_current = 2.5,
+                    standard_ratio = 0.5, dtype = dtype)
+                # The isotopes are left uncorrected
+                assert_false(numerator._is_deadtime_corrected)
+
+                numerator.perform_deadtime_correction(3000, 44)
+                denominator.perform_deadtime_correction(3000, 44)
+                reference = RatioData("test_ratio", numerator, denominator,
+                                      dtype = dtype)
+                reference.perform_qsa_correction(denominator, 2.5)
+                assert_equal(fused.get_data().dtype, np.dtype(dtype))
+                assert_true(np.array_equal(fused.get_data(),
+                                           reference.get_data()))
+                assert_true(np.array_equal(
+                    delta.get_data(),
+                    (reference.get_data()/0.5 - 1)*1000))
+        finally:
+            data_structures.BLOCK_SIZE = block_size
+
+    @raises(RuntimeError)
+    def test_corrected_ratio_deadtime(self):
+        numerator = IsotopeData("17O", self.numerator_isotope.get_data())
+        numerator.perform_deadtime_correction(3000, 44)
+        data_structures.corrected_ratio("test_ratio", numerator,
+                                        self.denominator_isotope,
+                                        dwell_time = 3000, dead_time = 44)
@@ -0,0 +1,76 @@
+from nose.tools import *
+import numpy as np
+
+from nanosims_analysis import registration
+from nanosims_analysis.data_structures import IsotopeData
+from nanosims_analysis.importer import Importer
+
+class TestClass:
+
+    @classmethod
+    def setup_class(cls):
+        x = np.linspace(0, 1, 32)[:, np.newaxis]
+        y = np.linspace(0, 1, 24)[np.newaxis, :]
+        cls.image = (np.exp(-((x - 0.4)**2 + (y - 0.6)**2)/0.01) +
+                     0.5*np.exp(-((x - 0.7)**2 + (y - 0.3)**2)/0.005))
+        cls.drift = np.array([[0, 0], [2, -3], [1.5, 0.25], [-4.3, 2.7]])
+
+    def drifted(self, drift):
+        data = np.repeat(self.image[np.newaxis], len(drift), axis = 0)
+        registration.shift_cycles([data], drift)
+        return data
+
+    def test_estimate_drift(self):
+        data = self.drifted(self.drift)
+        shifts = registration.estimate_drift(data)
+        assert_true(np.allclose(shifts, -self.drift, atol = 0.05))
+        # Blocks of one cycle
+        assert_true(np.array_equal(
+            registration.estimate_drift(data, block_size = 1), shifts))
+
+        whole = registration.estimate_drift(data, upsample = 1)
+        assert_true(np.array_equal(whole, np.round(whole)))
+        assert_true(np.array_equal(whole[:2], -self.drift[:2]))
+
+    def test_shift_cycles_whole_pixels(self):
+        data = np.random.randint(0, 200, size = (3, 6, 5))
+        shifted = data.copy()
+        registration.shift_cycles([shifted], [[0, 0], [1, 2], [-1, 7]])
+        assert_true(np.array_equal(shifted[1], np.roll(data[1], (1, 2),
+                                                       axis = (0, 1))))
+        assert_true(np.array_equal(shifted[2], np.roll(data[2], (-1, 7),
+                                                       axis = (0, 1))))
+
+        # Runs of cycles with the same shift, rolled together or in blocks
+        data = np.random.randint(0, 200, size = (7, 6, 5))
+        rolls = [[0, 0], [1, 2], [1, 2], [1, 2], [-1, 0], [-1, 0], [6, 5]]
+        expected = np.array([np.roll(cycle, roll, axis = (0, 1))
+                             for cycle, roll in zip(data, rolls)])
+        for block_size in [registration.BLOCK_SIZE, 30]:
+            shifted = data.copy()
+            registration.shift_cycles([shifted], rolls,
+                                      block_size = block_size)
+            assert_true(np.array_equal(shifted, expected))
+
+    @raises(RuntimeError)
+    def test_shift_cycles_integers(self):
+        data = np.zeros((2, 4, 4), dtype = int)
+        registration.shift_cycles([data], [[0, 0], [0.5, 0]])
+
+    def test_correct_drift(self):
+        data = self.drifted(self.drift)
+        for stacked in [False, True]:
+            test_importer = Importer()
+            test_importer.add_isotope(IsotopeData("16O", data))
+            test_importer.add_isotope(IsotopeData("18O", data/2))
+            if stacked:
+                test_importer.stack_isotopes()
+            shifts = test_importer.correct_drift("16O")
+            assert_true(np.allclose(shifts, -self.drift, atol = 0.05))
+            for label, scale in [("16O", 1), ("18O", 0.5)]:
+                corrected = test_importer.get_isotope(label).get_data()
+                assert_true(np.allclose(corrected, scale*self.image,
+                                        atol = 0.05))
+                assert_true(np.isclose(test_importer.get_isotope(label).sum(),
+                                       scale*self.image.sum()*len(data)))
+            assert_equal(test_importer._is_stacked(), stacked)
@@ -0,0 +1,113 @@
+from nose.tools import *
+import concurrent.futures
+import multiprocessing
+import pickle
+import numpy as np
+
+from nanosims_analysis import shared
+from nanosims_analysis.data_structures import IsotopeData, RatioData
+from nanosims_analysis.importer import Importer
+
+def ratio_sum(handle, numerator, denominator, lower):
+    """ Sum of a ratio over a threshold mask, computed in a worker. """
+    importer = handle.attach()
+    mask = importer.get_isotope(denominator).get_mask(lower = lower)
+    ratio = RatioData(numerator + "/" + denominator,
+                      importer.get_isotope(numerator),
+                      importer.get_isotope(denominator))
+    return ratio.sum(mask)
+
+def corrected_sum(handle):
+    """ Sum of a deadtime corrected and rolled isotope, computed in a worker. """
+    isotope = handle.attach()
+    isotope.perform_deadtime_correction(dwell_time = 0.001, dead_time = 44e-9)
+    isotope.roll_data(x_roll = 1)
+    return isotope.sum()
+
+class TestClass:
+
+    @classmethod
+    def setup_class(cls):
+        cls.labels = ["16O", "17O", "18O"]
+        cls.data = [np.random.randint(1, 200, size=(4, 6, 5)).astype(float)
+                    for label in cls.labels]
+
+    def make_importer(self):
+        importer = Importer(workers = 1)
+        for label, data in zip(self.labels, self.data):
+            importer.add_isotope(IsotopeData(label, data))
+        return importer
+
+    def pool(self):
+        # Spawned workers attach to the shared memory by name
+        return concurrent.futures.ProcessPoolExecutor(
+            2, mp_context = multiprocessing.get_context("spawn"))
+
+    def test_share_isotope(self):
+        isotope = IsotopeData("16O", self.data[0])
+        isotope.roll_data(y_roll = 2, virtual = True)
+        with isotope.share() as handle:
+            attached = pickle.loads(pickle.dumps(handle)).attach()
+            # The same memory, mapped once in this process
+            assert_true(np.shares_memory(attached._data, isotope._data))
+            np.testing.assert_array_equal(attached.get_data(),
+                                          isotope.get_data())
+            assert_false(attached._data.flags.writeable)
+
+    def test_share_importer(self):
+        importer = self.make_importer()
+        with importer.share() as handle:
+            assert_equal(len(pickle.dumps(handle)) < 2000, True)
+            attached = handle.attach()
+            for label, data in zip(self.labels, self.data):
+                np.testing.assert_array_equal(
+                    attached.get_isotope(label).get_data(), data)
+                np.testing.assert_array_equal(
+                    importer.get_isotope(label).get_data(), data)
+
+    def test_share_virtual_roll(self):
+        importer = self.make_importer()
+        importer.roll_all(x_roll = 1, y_roll = 2, virtual = True)
+        with importer.share() as handle:
+            attached = pickle.loads(pickle.dumps(handle)).attach()
+            for label, data in zip(self.labels, self.data):
+                rolled = np.roll(data, (1, 2), axis = (1, 2))
+                # Rolled once, in this process and in the attached importer
+                np.testing.assert_array_equal(
+                    importer.get_isotope(label).get_data(), rolled)
+                np.testing.assert_array_equal(
+                    attached.get_isotope(label).get_data(), rolled)
+
+    def test_workers(self):
+        importer = self.make_importer()
+        with importer.share() as handle, self.pool() as executor:
+            sums = list(executor.map(ratio_sum, [handle]*2, ["17O", "18O"],
+                                     ["16O"]*2, [50, 100]))
+        for numerator, lower, total in zip(["17O", "18O"], [50, 100], sums):
+            mask = importer.get_isotope("16O").get_mask(lower = lower)
+            ratio = RatioData("ratio", importer.get_isotope(numerator),
+                              importer.get_isotope("16O"))
+            assert_almost_equal(total, ratio.sum(mask))
+
+    def test_worker_corrections(self):
+        isotope = IsotopeData("16O", self.data[0])
+        expected = IsotopeData("16O", self.data[0])
+        expected.perform_deadtime_correction(dwell_time = 0.001,
+                                             dead_time = 44e-9)
+        expected.roll_data(x_roll = 1)
+        with isotope.share() as handle, self.pool() as executor:
+            total = executor.submit(corrected_sum, handle).result()
+            # Corrected in the worker on a copy
+            np.testing.assert_array_equal(isotope.get_data(), self.data[0])
+            # And in this process too
+            assert_almost_equal(corrected_sum(handle), expected.sum())
+        assert_almost_equal(total, expected.sum())
+
+    @raises(FileNotFoundError)
+    def test_release(self):
+        handle = IsotopeData("16O", self.data[0]).share()
+        copy = pickle.loads(pickle.dumps(handle))
+        # Only the process that shared the data can release it
+        copy.release()
+        handle.release()
+        shared._attach(handle.array.name)
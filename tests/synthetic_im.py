@@ -0,0 +1,76 @@
+"""
+
+Writes small synthetic NanoSIMS image (.im) files for the tests. Only the
+parts of the header that are read by the `sims` package and by the importer
+are filled in, the rest is padded with zeros.
+
+"""
+
+import struct
+import numpy as np
+
+FILE_VERSION = 4108
+FILE_TYPE = 27
+
+def _species(label):
+    """ 144 byte species entry with the given label. """
+    return (struct.pack('<4i c 64s', 0, 0, 0, 0, b'-', label.encode('latin-1'))
+            + bytes(3 + 60))
+
+def _bfield(time_per_pixel):
+    """ 3128 byte b field entry, time per pixel in seconds. """
+    entry = struct.pack('<4i d 6i', 1, 0, 0, int(round(time_per_pixel*1e6)),
+                        0.0, 0, 0, 0, 0, 0, 0)
+    # unused bytes, 12 trolleys and 12 phd entries
+    return entry + bytes(8 + 12*(192 + 16) + 12*(24 + 24))
+
+def write_im_file(filename, data, labels, time_per_pixel=0.003):
+    """ Write data, with shape (masses, planes, height, width), to filename.
+
+    :param filename: file to write.
+    :type filename: string
+
+    :param data: counts for each mass.
+    :type data: 4D `numpy` array
+
+    :param labels: label of each mass.
+    :type labels: list of strings
+
+    :param time_per_pixel: dwell time in seconds.
+    :type time_per_pixel: float
+    """
+    masses, planes, height, width = np.shape(data)
+
+    # Main header
+    body = struct.pack('<4i 32s 16s i 12x 16s 16s', 0, 1, 0, 0,
+                       b'image', b'test', 0, b'01.01.18', b'12:00')
+    body += struct.pack('<16s 3i 3h 2x 3i', b'test.im', 0, planes,
+                        0, 0, 0, 0, 0, 0, 0)
+    body += bytes(76)                     # AutoCal
+    body += struct.pack('<i', 0) + _species('') + bytes(12)  # SigRef
+    body += struct.pack('<i', masses)
+    body += bytes(60*4)                   # mass table pointers
+    for n, label in enumerate(labels):
+        body += struct.pack('<2i d 2i 2d', n + 1, 0, 16.0, 0, 0, 0.0, 0.0)
+        body += struct.pack('<2i', 0, 0)
+        body += _species(label)
+
+    # Empty Poly_list, followed by the NanoSIMS header
+    body += b'Poly_list\x00'.ljust(16, b'\x00') + struct.pack('<i', 0)
+    body += bytes(4)
+    body += struct.pack('<25i', 8, 0, 0, 0, 0, 0, 0, width, height,
+                        0, width, 0, height, 0, width - 1, 0, height - 1,
+                        0, 0, 0, 0, 0, 0, 0, 1)
+    body += bytes(604 - 100)
+    body += bytes(948)
+    body += _bfield(time_per_pixel)
+
+    # Image header
+    body += struct.pack('<i 6h i 64s', 84, 0, width, height, 2, masses,
+                        planes, 0, b'test.im')
+
+    header_size = 12 + len(body)
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('<3i', FILE_VERSION, FILE_TYPE, header_size))
+        f.write(body)
+        np.swapaxes(np.asarray(data, dtype='<u2'), 0, 1).tofile(f)